@@ -14,11 +14,27 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import copy
+import functools
+import hashlib
+import inspect
+import itertools
 import json
 import logging
+import operator
+import os
 import re
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
+import numpy as np
+
 from .. import is_torch_available
 from ..utils import logging as transformers_logging
 from ..utils.import_utils import is_pygments_available
@@ -53,6 +69,12 @@ if is_pygments_available():
     from pygments.formatters import Terminal256Formatter
     from pygments.lexers import PythonLexer
 
+    _PYTHON_LEXER = PythonLexer(ensurenl=False)
+    _TERMINAL_FORMATTER = Terminal256Formatter(style="nord")
+
+# Code blobs longer than this are only highlighted when logs go to an interactive terminal
+MAX_HIGHLIGHTED_CODE_LENGTH = 2000
+
 
 class CustomFormatter(logging.Formatter):
     grey = "\x1b[38;20m"
@@ -75,9 +97,13 @@ class CustomFormatter(logging.Formatter):
         logging.CRITICAL: bold_red + format + reset,
     }
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._formatters = {level: logging.Formatter(log_fmt) for level, log_fmt in self.FORMATS.items()}
+        self._default_formatter = logging.Formatter()
+
     def format(self, record):
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_fmt)
+        formatter = self._formatters.get(record.levelno, self._default_formatter)
         return formatter.format(record)
 
 
@@ -88,12 +114,87 @@ ch.setFormatter(CustomFormatter())
 logger.addHandler(ch)
 
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _json_loads(json_blob: str) -> Any:
+    if orjson is not None:
+        try:
+            return orjson.loads(json_blob)
+        except orjson.JSONDecodeError:
+            # orjson has no non-strict mode: let the stdlib parser accept control characters or report the error
+            pass
+    return json.loads(json_blob, strict=False)
+
+
+_CODE_BLOB_PATTERN = r"```(?:py|python)?\n(.*?)\n```"
+_CODE_BLOB_RE = re.compile(_CODE_BLOB_PATTERN, re.DOTALL)
+_JSON_FENCE_RE = re.compile(r"```(?:json)?")
+# A line of a code action that calls the final answer tool
+_FINAL_ANSWER_RE = re.compile(r"^final_answer\b", re.MULTILINE)
+_JSON_START_RE = re.compile(r"[\[{]")
+_JSON_DECODER = json.JSONDecoder(strict=False)
+
+
+def is_json_action_complete(text: str, chunk: str) -> bool:
+    """
+    Returns whether the streamed LLM output `text`, whose last received chunk is `chunk`, already holds a complete
+    JSON action after its last `Action:` token.
+    """
+    if "}" not in chunk and "]" not in chunk:
+        return False
+    action_start = text.rfind("Action:")
+    if action_start == -1:
+        return False
+    json_start = _JSON_START_RE.search(text, action_start)
+    if json_start is None:
+        return False
+    try:
+        _JSON_DECODER.raw_decode(text, json_start.start())
+    except ValueError:
+        return False
+    return True
+
+
+def is_code_action_complete(text: str, chunk: str) -> bool:
+    """
+    Returns whether the streamed LLM output `text`, whose last received chunk is `chunk`, already holds a complete
+    code block after its last `Code:` token (or anywhere, if there is no such token).
+    """
+    if "```" not in chunk:
+        return False
+    return _CODE_BLOB_RE.search(text, max(text.rfind("Code:"), 0)) is not None
+
+
+def is_search_action_complete(text: str, chunk: str) -> bool:
+    """
+    Returns whether the streamed LLM output `text`, whose last received chunk is `chunk`, already holds a full search
+    query: a line of text after its last `Search:` token. A final answer is never complete before the end of the stream.
+    """
+    if "\n" not in chunk:
+        return False
+    start = text.rfind("Search:")
+    return start != -1 and "\n" in text[start + len("Search:") :].lstrip()
+
+
 def parse_json_blob(json_blob: str) -> Dict[str, str]:
+    # LLM retries often produce the exact same blob: parse it once and hand out a fresh deep copy each time, so that
+    # the nested tool arguments of the cached result are never mutated by a caller
+    return copy.deepcopy(_parse_json_blob_cached(json_blob))
+
+
+@functools.lru_cache(maxsize=256)
+def _parse_json_blob_cached(json_blob: str) -> Dict[str, str]:
     try:
         first_accolade_index = json_blob.find("{")
-        last_accolade_index = [a.start() for a in list(re.finditer("}", json_blob))][-1]
+        last_accolade_index = json_blob.rfind("}")
+        if first_accolade_index == -1 or last_accolade_index == -1:
+            raise ValueError("No JSON object delimited by '{' and '}' was found in the blob.")
         json_blob = json_blob[first_accolade_index : last_accolade_index + 1].replace('\\"', "'")
-        json_data = json.loads(json_blob, strict=False)
+        json_data = _json_loads(json_blob)
         return json_data
     except json.JSONDecodeError as e:
         place = e.pos
@@ -112,14 +213,13 @@ def parse_json_blob(json_blob: str) -> Dict[str, str]:
 
 def parse_code_blob(code_blob: str) -> str:
     try:
-        pattern = r"```(?:py|python)?\n(.*?)\n```"
-        match = re.search(pattern, code_blob, re.DOTALL)
+        match = _CODE_BLOB_RE.search(code_blob)
         return match.group(1).strip()
     except Exception as e:
         raise ValueError(
             f"""
 The code blob you used is invalid: due to the following error: {e}
-This means that the regex pattern {pattern} was not respected: make sure to include code with the correct pattern, for instance:
+This means that the regex pattern {_CODE_BLOB_PATTERN} was not respected: make sure to include code with the correct pattern, for instance:
 Thoughts: Your thoughts
 Code:
 ```py
@@ -128,9 +228,29 @@ Code:
         )
 
 
-def parse_json_tool_call(json_blob: str) -> Tuple[str, Dict[str, str]]:
-    json_blob = json_blob.replace("```json", "").replace("```", "")
-    tool_call = parse_json_blob(json_blob)
+def parse_json_tool_call(
+    json_blob: str,
+) -> Union[Tuple[str, Dict[str, str]], List[Tuple[str, Dict[str, str]]]]:
+    """
+    Expects a JSON blob in the format `{"action": ..., "action_input": ...}` and returns `(tool_name, arguments)`.
+    A JSON list of such objects is returned as a list of `(tool_name, arguments)` tuples.
+    """
+    json_blob = _JSON_FENCE_RE.sub("", json_blob)
+    list_start = json_blob.find("[")
+    object_start = json_blob.find("{")
+    if list_start != -1 and (object_start == -1 or list_start < object_start):
+        list_end = json_blob.rfind("]")
+        try:
+            tool_calls = _json_loads(json_blob[list_start : list_end + 1])
+        except json.JSONDecodeError as e:
+            raise ValueError(f"The JSON list of tool calls you used is invalid due to the following error: {e}.")
+        if not tool_calls or not all(isinstance(tool_call, dict) for tool_call in tool_calls):
+            raise ValueError(f"Expected a non-empty list of tool call objects, got: {tool_calls}")
+        return [_unpack_tool_call(tool_call) for tool_call in tool_calls]
+    return _unpack_tool_call(parse_json_blob(json_blob))
+
+
+def _unpack_tool_call(tool_call: Dict[str, Any]) -> Tuple[str, Dict[str, str]]:
     if "action" in tool_call and "action_input" in tool_call:
         return tool_call["action"], tool_call["action_input"]
     elif "action" in tool_call:
@@ -146,11 +266,12 @@ def parse_text_tool_call(text: str) -> Tuple[str, Union[str, Dict[str, str]]]:
     Expects a text in the format: 'Action:', 'Action input:', 'Observation:'. 'Action input:' contains a json string with input arguments.
     """
     try:
-        if "Observation:" in text:
-            text = text.split("Observation:")[0]
+        text = text.partition("Observation:")[0]
         if "Action:" in text:
-            text = text.split("Action:")[1]
-        tool_name, tool_input = text.split("Action input:")
+            text = text.partition("Action:")[2].partition("Action:")[0]
+        tool_name, separator, tool_input = text.partition("Action input:")
+        if not separator:
+            raise ValueError("No 'Action input:' found in the text.")
         if "{" in tool_input:
             tool_input = parse_json_blob(tool_input)
         else:
@@ -164,15 +285,16 @@ def parse_text_tool_call(text: str) -> Tuple[str, Union[str, Dict[str, str]]]:
 
 def to_text(input: Union[List[Dict[str, str]], Dict[str, str], str]) -> str:
     if isinstance(input, list):
-        return "\n".join([m["content"] for m in input])
+        return "\n".join(m["content"] for m in input)
     elif isinstance(input, dict):
         return input["content"]
     else:
         return input
 
 
-HUGGINGFACE_DEFAULT_TOOLS = {}
+HUGGINGFACE_DEFAULT_TOOLS = MappingProxyType({})
 _tools_are_initialized = False
+_tools_init_lock = threading.Lock()
 
 
 class Toolbox:
@@ -187,8 +309,13 @@ class Toolbox:
             Whether to add the tools available within `transformers` to the toolbox.
     """
 
+    __slots__ = ("_tools", "_version", "_desc_cache", "_needs_load")
+
     def __init__(self, tools: List[Tool], add_base_tools: bool = False):
         self._tools = {tool.name: tool for tool in tools}
+        self._version = 0
+        self._desc_cache: Dict[Tuple[int, str], str] = {}
+        self._needs_load = any(not isinstance(tool, Tool) for tool in tools)
         if add_base_tools:
             self.add_base_tools()
         self._load_tools_if_needed()
@@ -197,8 +324,10 @@ class Toolbox:
         global _tools_are_initialized
         global HUGGINGFACE_DEFAULT_TOOLS
         if not _tools_are_initialized:
-            HUGGINGFACE_DEFAULT_TOOLS = setup_default_tools(logger)
-            _tools_are_initialized = True
+            with _tools_init_lock:
+                if not _tools_are_initialized:
+                    HUGGINGFACE_DEFAULT_TOOLS = MappingProxyType(setup_default_tools(logger))
+                    _tools_are_initialized = True
         for tool in HUGGINGFACE_DEFAULT_TOOLS.values():
             if tool.name != "python_interpreter" or add_python_interpreter:
                 self.add_tool(tool)
@@ -209,6 +338,15 @@ class Toolbox:
         """Get all tools currently in the toolbox"""
         return self._tools
 
+    @property
+    def version(self) -> int:
+        """Counter bumped each time the toolbox contents change, usable as a cache key"""
+        return self._version
+
+    def _mark_changed(self):
+        self._version += 1
+        self._desc_cache.clear()
+
     def show_tool_descriptions(self, tool_description_template: str = None) -> str:
         """
         Returns the description of all tools in the toolbox
@@ -217,9 +355,14 @@ class Toolbox:
             tool_description_template (`str`, *optional*):
                 The template to use to describe the tools. If not provided, the default template will be used.
         """
-        return "\n".join(
-            [get_tool_description_with_args(tool, tool_description_template) for tool in self._tools.values()]
-        )
+        key = (self._version, tool_description_template or "")
+        descriptions = self._desc_cache.get(key)
+        if descriptions is None:
+            descriptions = "\n".join(
+                [get_tool_description_with_args(tool, tool_description_template) for tool in self._tools.values()]
+            )
+            self._desc_cache[key] = descriptions
+        return descriptions
 
     def add_tool(self, tool: Tool):
         """
@@ -232,6 +375,9 @@ class Toolbox:
         if tool.name in self._tools:
             raise KeyError(f"Error: tool '{tool.name}' already exists in the toolbox.")
         self._tools[tool.name] = tool
+        if not isinstance(tool, Tool):
+            self._needs_load = True
+        self._mark_changed()
 
     def remove_tool(self, tool_name: str):
         """
@@ -246,6 +392,7 @@ class Toolbox:
                 f"Error: tool {tool_name} not found in toolbox for removal, should be instead one of {list(self._tools.keys())}."
             )
         del self._tools[tool_name]
+        self._mark_changed()
 
     def update_tool(self, tool: Tool):
         """
@@ -260,16 +407,25 @@ class Toolbox:
                 f"Error: tool {tool.name} not found in toolbox for update, should be instead one of {list(self._tools.keys())}."
             )
         self._tools[tool.name] = tool
+        if not isinstance(tool, Tool):
+            self._needs_load = True
+        self._mark_changed()
 
     def clear_toolbox(self):
         """Clears the toolbox"""
         self._tools = {}
+        self._needs_load = False
+        self._mark_changed()
 
     def _load_tools_if_needed(self):
+        if not self._needs_load:
+            return
+        self._needs_load = False
         for name, tool in self._tools.items():
             if not isinstance(tool, Tool):
                 task_or_repo_id = tool.task if tool.repo_id is None else tool.repo_id
                 self._tools[name] = load_tool(task_or_repo_id)
+                self._mark_changed()
 
     def __repr__(self):
         toolbox_description = "Toolbox contents:\n"
@@ -310,19 +466,100 @@ class AgentGenerationError(AgentError):
     pass
 
 
+_SAFE_MODULES = frozenset(LIST_SAFE_MODULES)
+_FACTS_PREFIX = "[FACTS LIST]:\n"
+_PLAN_PREFIX = "[PLAN]:\n"
+_TASK_PREFIX = sys.intern("Task: ")
+_NEW_TASK_PREFIX = sys.intern("New task:\n")
+_TOOL_CALL_FMT = "[STEP {0} TOOL CALL]: {1}"
+_OBSERVATION_FMT = "[OUTPUT OF STEP {0}] Observation:\n{1}"
+_ERROR_FMT = (
+    "[OUTPUT OF STEP {0}] Error: {1}\nNow let's retry: take care not to repeat previous errors! "
+    "If you have retried several times, try a completely different approach.\n"
+)
+_PROMPT_PLACEHOLDER_RE = re.compile(r"<<(tool_descriptions|tool_names|authorized_imports)>>")
+# Planning templates are formatted with bound methods, without looking up the template and its method on each call
+_USER_PROMPT_PLAN_FORMAT = USER_PROMPT_PLAN.format
+_USER_PROMPT_PLAN_UPDATE_FORMAT = USER_PROMPT_PLAN_UPDATE.format
+_PLAN_UPDATE_FINAL_PLAN_REDACTION_FORMAT = PLAN_UPDATE_FINAL_PLAN_REDACTION.format
+
+
+@functools.lru_cache(maxsize=16)
+def render_plan_update_system_prompt(task: str) -> str:
+    """
+    Returns the system prompt of plan updates for the given task. The task is the same for all the plan updates of a
+    run, so the prompt is only formatted once.
+    """
+    return SYSTEM_PROMPT_PLAN_UPDATE.format(task=task)
+
+
+def fill_prompt_placeholders(prompt_template: str, values: Dict[str, str]) -> str:
+    """
+    Substitutes all the `<<placeholder>>` tags of the prompt template in a single pass. Tags missing from `values`
+    are left untouched.
+    """
+    return _PROMPT_PLACEHOLDER_RE.sub(lambda match: values.get(match.group(1), match.group(0)), prompt_template)
+
+
+@functools.lru_cache(maxsize=8)
+def get_authorized_imports(additional_authorized_imports: Tuple[str, ...]) -> Tuple[str, ...]:
+    """
+    Returns the sorted modules that code agents may import. Agents with the same additional imports share the result.
+    """
+    return tuple(sorted(_SAFE_MODULES.union(additional_authorized_imports)))
+
+
+@functools.lru_cache(maxsize=8)
+def render_code_system_prompt(
+    prompt_template: str, tool_descriptions: str, tool_names: Optional[str], authorized_imports: Tuple[str, ...]
+) -> str:
+    """
+    Fills the placeholders of a code agent system prompt. Agents built with the same tools and imports, such as the
+    ones created for each evaluation question, share the rendered prompt instead of rendering their own copy.
+    """
+    values = {"tool_descriptions": tool_descriptions, "authorized_imports": str(list(authorized_imports))}
+    if tool_names is not None:
+        values["tool_names"] = tool_names
+    return fill_prompt_placeholders(prompt_template, values)
+
+
+def get_tool_placeholder_values(toolbox: Toolbox, prompt_template: str, tool_description_template: str) -> Dict[str, str]:
+    values = {"tool_descriptions": toolbox.show_tool_descriptions(tool_description_template)}
+    if "<<tool_names>>" in prompt_template:
+        values["tool_names"] = ", ".join([f"'{tool_name}'" for tool_name in toolbox.tools.keys()])
+    return values
+
+
+def accepts_keyword_argument(func: Callable, name: str) -> bool:
+    """
+    Returns whether `func` can be called with the keyword argument `name`, either explicitly or through `**kwargs`.
+    """
+    try:
+        parameters = inspect.signature(func).parameters
+    except (TypeError, ValueError):
+        return False
+    return name in parameters or any(
+        parameter.kind is inspect.Parameter.VAR_KEYWORD for parameter in parameters.values()
+    )
+
+
+def hash_observation(observation: Any) -> str:
+    """
+    Returns a stable hash of an observation, used as its cache key in the agent memory.
+    """
+    return hashlib.blake2b(str(observation).encode("utf-8"), digest_size=16).hexdigest()
+
+
 def format_prompt_with_tools(toolbox: Toolbox, prompt_template: str, tool_description_template: str) -> str:
-    tool_descriptions = toolbox.show_tool_descriptions(tool_description_template)
-    prompt = prompt_template.replace("<<tool_descriptions>>", tool_descriptions)
-    if "<<tool_names>>" in prompt:
-        tool_names = [f"'{tool_name}'" for tool_name in toolbox.tools.keys()]
-        prompt = prompt.replace("<<tool_names>>", ", ".join(tool_names))
-    return prompt
+    return fill_prompt_placeholders(
+        prompt_template, get_tool_placeholder_values(toolbox, prompt_template, tool_description_template)
+    )
 
 
 def format_prompt_with_imports(prompt_template: str, authorized_imports: List[str]) -> str:
     if "<<authorized_imports>>" not in prompt_template:
         raise AgentError("Tag '<<authorized_imports>>' should be provided in the prompt.")
-    return prompt_template.replace("<<authorized_imports>>", str(authorized_imports))
+    return fill_prompt_placeholders(prompt_template, {"authorized_imports": str(authorized_imports)})
 
 
 class Agent:
@@ -338,6 +575,7 @@ class Agent:
         add_base_tools: bool = False,
         verbose: int = 0,
         memory_verbose: bool = False,
+        memory_cache_keys: bool = False,
     ):
         self.agent_name = self.__class__.__name__
         self.llm_engine = llm_engine
@@ -361,13 +599,19 @@ class Agent:
             self._toolbox = Toolbox(tools, add_base_tools=add_base_tools)
         self._toolbox.add_tool(FinalAnswerTool())
 
-        self.system_prompt = format_prompt_with_tools(
-            self._toolbox, self.system_prompt_template, self.tool_description_template
-        )
+        self._tools_prompt_key = None
+        self._tools_prompt = None
+        self._system_prompt_key = None
+        self._rendered_system_prompt = None
+        self._static_tools = None
+        self._static_tools_version = -1
+        self.system_prompt = self.format_system_prompt_with_tools()
         self.prompt = None
         self.logs = []
         self.task = None
         self.memory_verbose = memory_verbose
+        self.memory_cache_keys = memory_cache_keys
+        self._step_messages_cache = {}
 
         if verbose == 0:
             logger.setLevel(logging.WARNING)
@@ -381,18 +625,118 @@ class Agent:
         """Get the toolbox currently available to the agent"""
         return self._toolbox
 
-    def initialize_for_run(self):
-        self.token_count = 0
-        self.system_prompt = format_prompt_with_tools(
-            self._toolbox,
+    @property
+    def tool_descriptions(self) -> str:
+        """
+        The descriptions of the toolbox tools rendered with the agent's tool description template. The toolbox
+        caches the rendering, so it is only redone after tools are added, removed or updated.
+        """
+        return self._toolbox.show_tool_descriptions(self.tool_description_template)
+
+    def get_static_tools(self) -> Dict[str, Callable]:
+        """
+        Returns the base python tools merged with the toolbox tools, rebuilt only when the toolbox changed.
+        """
+        if self._static_tools_version != self._toolbox.version:
+            self._static_tools = {**BASE_PYTHON_TOOLS, **self._toolbox.tools}
+            self._static_tools_version = self._toolbox.version
+        return self._static_tools
+
+    def generate_action(
+        self, stop_sequences: List[str], is_action_complete: Callable[[str, str], bool], **kwargs
+    ) -> str:
+        """
+        Calls the LLM engine on the current prompt and returns its output. If the LLM engine accepts a `stream`
+        argument and returns an iterator of text chunks, the stream is only consumed until `is_action_complete`
+        reports that the output holds a full action, so that the action can be parsed and run without waiting for
+        the rest of the generation.
+
+        Args:
+            stop_sequences (`List[str]`): The stop sequences passed to the LLM engine.
+            is_action_complete (`Callable[[str, str], bool]`): Called with the output so far and the last chunk.
+            kwargs: Optional LLM engine arguments, filtered with `get_engine_kwargs`.
+        """
+        engine_kwargs = self.get_engine_kwargs(**kwargs)
+        if not accepts_keyword_argument(self.llm_engine, "stream"):
+            return self.llm_engine(self.prompt, stop_sequences=stop_sequences, **engine_kwargs)
+
+        chunks = self.llm_engine(self.prompt, stop_sequences=stop_sequences, stream=True, **engine_kwargs)
+        if isinstance(chunks, str):
+            return chunks
+        llm_output = ""
+        try:
+            for chunk in chunks:
+                llm_output += chunk
+                if is_action_complete(llm_output, chunk):
+                    break
+        finally:
+            close = getattr(chunks, "close", None)
+            if close is not None:
+                close()
+        return llm_output
+
+    def get_engine_kwargs(self, **kwargs) -> Dict[str, Any]:
+        """
+        Returns the given optional LLM engine arguments, leaving out the ones that are `None` or that the LLM engine
+        does not accept.
+        """
+        return {
+            name: value
+            for name, value in kwargs.items()
+            if value is not None and accepts_keyword_argument(self.llm_engine, name)
+        }
+
+    def format_system_prompt_with_tools(self) -> str:
+        """
+        Returns the system prompt template with the tool descriptions filled in. The result is reused until the
+        toolbox, the system prompt template or the tool description template changes.
+        """
+        key = (self._toolbox.version, self.system_prompt_template, self.tool_description_template)
+        if key != self._tools_prompt_key:
+            self._tools_prompt = format_prompt_with_tools(
+                self._toolbox,
+                self.system_prompt_template,
+                self.tool_description_template,
+            )
+            self._tools_prompt_key = key
+        return self._tools_prompt
+
+    def render_system_prompt(self) -> str:
+        """
+        Returns the fully rendered system prompt (tool descriptions and, for agents that execute code, authorized
+        imports). The previous rendering is reused as long as none of its inputs changed.
+        """
+        authorized_imports = getattr(self, "authorized_imports", None)
+        key = (
+            self._toolbox.version,
             self.system_prompt_template,
             self.tool_description_template,
+            None if authorized_imports is None else tuple(authorized_imports),
         )
-        if hasattr(self, "authorized_imports"):
-            self.system_prompt = format_prompt_with_imports(
-                self.system_prompt, list(set(LIST_SAFE_MODULES) | set(self.authorized_imports))
-            )
+        if key != self._system_prompt_key:
+            if authorized_imports is None:
+                system_prompt = self.format_system_prompt_with_tools()
+            else:
+                if "<<authorized_imports>>" not in self.system_prompt_template:
+                    raise AgentError("Tag '<<authorized_imports>>' should be provided in the prompt.")
+                values = get_tool_placeholder_values(
+                    self._toolbox, self.system_prompt_template, self.tool_description_template
+                )
+                system_prompt = render_code_system_prompt(
+                    self.system_prompt_template,
+                    values["tool_descriptions"],
+                    values.get("tool_names"),
+                    tuple(authorized_imports),
+                )
+            self._rendered_system_prompt = system_prompt
+            self._system_prompt_key = key
+        return self._rendered_system_prompt
+
+    def initialize_for_run(self):
+        self.token_count = 0
+        self.system_prompt = self.render_system_prompt()
         self.logs = [{"system_prompt": self.system_prompt, "task": self.task}]
+        self._step_messages_cache = {}
         self.logger.warn("======== New task ========")
         self.logger.log(33, self.task)
         self.logger.debug("System prompt is as follows:")
@@ -402,60 +746,78 @@ class Agent:
         """
         Reads past llm_outputs, actions, and observations or errors from the logs into a series of messages
         that can be used as input to the LLM.
+        If `memory_cache_keys` is set, observation messages also get a `cache_key` entry, a stable hash of the
+        observation that a prefix-caching LLM engine can use to reuse its KV cache. Only enable it with an engine
+        that accepts messages with keys other than `role` and `content`.
+        The messages of each step are cached and reused as long as the step log holds the same keys and values, so
+        completed steps are only converted once per run.
+        An observation whose step log holds an `observation_summary` is replaced by that summary.
         """
-        if not is_mistral:
-            prompt_message = {"role": MessageRole.SYSTEM, "content": self.logs[0]["system_prompt"]}
-        else:
-            prompt_message = {"role": MessageRole.USER, "content": self.logs[0]["system_prompt"].replace("<<tool_descriptions>>", "")}
-
+        system_role, user_role, assistant_role, tool_response_role = (
+            MessageRole.SYSTEM,
+            MessageRole.USER,
+            MessageRole.ASSISTANT,
+            MessageRole.TOOL_RESPONSE,
+        )
+        first_log = self.logs[0]
         task_message = {
-            "role": MessageRole.USER,
-            "content": "Task: " + self.logs[0]["task"],
+            "role": user_role,
+            "content": _TASK_PREFIX + first_log["task"],
         }
         if summary_mode:
             memory = [task_message]
         else:
+            system_prompt = first_log["system_prompt"]
+            if not is_mistral:
+                prompt_message = {"role": system_role, "content": system_prompt}
+            else:
+                prompt_message = {"role": user_role, "content": system_prompt.replace("<<tool_descriptions>>", "")}
             memory = [prompt_message, task_message]
-        for i, step_log in enumerate(self.logs[1:]):
-            if "llm_output" in step_log and not summary_mode:
-                thought_message = {"role": MessageRole.ASSISTANT, "content": step_log["llm_output"].strip()}
-                memory.append(thought_message)
-            if "facts" in step_log:
-                thought_message = {
-                    "role": MessageRole.ASSISTANT,
-                    "content": "[FACTS LIST]:\n" + step_log["facts"].strip(),
-                }
-                memory.append(thought_message)
-
-            if "plan" in step_log and not summary_mode:
-                thought_message = {"role": MessageRole.ASSISTANT, "content": "[PLAN]:\n" + step_log["plan"].strip()}
-                memory.append(thought_message)
-
-            if "tool_call" in step_log and summary_mode:
-                tool_call_message = {
-                    "role": MessageRole.ASSISTANT,
-                    "content": f"[STEP {i} TOOL CALL]: " + str(step_log["tool_call"]).strip(),
-                }
-                memory.append(tool_call_message)
-
-            if "task" in step_log:
-                tool_call_message = {
-                    "role": MessageRole.USER,
-                    "content": "New task:\n" + step_log["task"],
+        step_messages_cache = self._step_messages_cache
+        variant = (summary_mode, self.memory_cache_keys)
+        for i, step_log in enumerate(itertools.islice(self.logs, 1, None)):
+            cached = step_messages_cache.get((i, variant))
+            if (
+                cached is not None
+                and cached[0] is step_log
+                and cached[1] == tuple(step_log)
+                and all(map(operator.is_, cached[2], step_log.values()))
+            ):
+                memory.extend(cached[3])
+                continue
+            has_key = step_log.keys().__contains__
+            step_messages = []
+            if not summary_mode and has_key("llm_output"):
+                step_messages.append({"role": assistant_role, "content": step_log["llm_output"].strip()})
+            if has_key("facts"):
+                step_messages.append(
+                    {"role": assistant_role, "content": _FACTS_PREFIX + step_log["facts"].strip()}
+                )
+            if not summary_mode and has_key("plan"):
+                step_messages.append({"role": assistant_role, "content": _PLAN_PREFIX + step_log["plan"].strip()})
+            if summary_mode and has_key("tool_call"):
+                step_messages.append(
+                    {"role": assistant_role, "content": _TOOL_CALL_FMT.format(i, str(step_log["tool_call"]).strip())}
+                )
+            if has_key("task"):
+                step_messages.append({"role": user_role, "content": _NEW_TASK_PREFIX + step_log["task"]})
+            if has_key("error"):
+                step_messages.append(
+                    {"role": tool_response_role, "content": _ERROR_FMT.format(i, str(step_log["error"]))}
+                )
+            elif has_key("observation"):
+                observation = step_log.get("observation_summary", step_log["observation"])
+                observation_message = {
+                    "role": tool_response_role,
+                    "content": _OBSERVATION_FMT.format(i, observation),
                 }
-                memory.append(tool_call_message)
-
-            if "error" in step_log or "observation" in step_log:
-                if "error" in step_log:
-                    message_content = (
-                        f"[OUTPUT OF STEP {i}] Error: "
-                        + str(step_log["error"])
-                        + "\nNow let's retry: take care not to repeat previous errors! If you have retried several times, try a completely different approach.\n"
-                    )
-                elif "observation" in step_log:
-                    message_content = f"[OUTPUT OF STEP {i}] Observation:\n{step_log['observation']}"
-                tool_response_message = {"role": MessageRole.TOOL_RESPONSE, "content": message_content}
-                memory.append(tool_response_message)
+                if self.memory_cache_keys:
+                    if not has_key("obs_hash"):
+                        step_log["obs_hash"] = hash_observation(observation)
+                    observation_message["cache_key"] = step_log["obs_hash"]
+                step_messages.append(observation_message)
+            memory.extend(step_messages)
+            step_messages_cache[(i, variant)] = (step_log, tuple(step_log), tuple(step_log.values()), step_messages)
 
         return memory
 
@@ -470,17 +832,13 @@ class Agent:
             llm_output (`str`): Output of the LLM
             split_token (`str`): Separator for the action. Should match the example in the system prompt.
         """
-        try:
-            split = llm_output.split(split_token)
-            rationale, action = (
-                split[-2],
-                split[-1],
-            )  # NOTE: using indexes starting from the end solves for when you have more than one split_token in the output
-        except Exception as e:
-            self.logger.error(e, exc_info=1)
-            raise AgentParsingError(
-                f"Error: No '{split_token}' token provided in your output.\nYour output:\n{llm_output}\n. Be sure to include an action, prefaced with '{split_token}'!"
-            )
+        # NOTE: splitting from the end solves for when you have more than one split_token in the output
+        split = llm_output.rsplit(split_token, 2)
+        if len(split) < 2:
+            error_msg = f"Error: No '{split_token}' token provided in your output.\nYour output:\n{llm_output}\n. Be sure to include an action, prefaced with '{split_token}'!"
+            self.logger.error(error_msg)
+            raise AgentParsingError(error_msg)
+        rationale, action = split[-2], split[-1]
         return rationale, action
 
     def execute_tool_call(self, tool_name: str, arguments: Dict[str, str]) -> Any:
@@ -501,10 +859,12 @@ class Agent:
             if isinstance(arguments, str):
                 observation = self.toolbox.tools[tool_name](arguments)
             else:
-                for key, value in arguments.items():
-                    # if the value is the name of a state variable like "image.png", replace it with the actual value
-                    if isinstance(value, str) and value in self.state:
-                        arguments[key] = self.state[value]
+                # if a value is the name of a state variable like "image.png", replace it with the actual value
+                state = self.state
+                arguments = {
+                    key: state[value] if isinstance(value, str) and value in state else value
+                    for key, value in arguments.items()
+                }
                 observation = self.toolbox.tools[tool_name](**arguments)
             return observation
         except Exception as e:
@@ -515,12 +875,13 @@ class Agent:
 
     def log_code_action(self, code_action: str) -> None:
         self.logger.warning("==== Agent is executing the code below:")
-        if is_pygments_available():
-            self.logger.log(
-                31, highlight(code_action, PythonLexer(ensurenl=False), Terminal256Formatter(style="nord"))
-            )
-        else:
-            self.logger.log(31, code_action)
+        if self.logger.isEnabledFor(31):
+            if is_pygments_available() and (
+                len(code_action) <= MAX_HIGHLIGHTED_CODE_LENGTH or getattr(ch.stream, "isatty", lambda: False)()
+            ):
+                self.logger.log(31, highlight(code_action, _PYTHON_LEXER, _TERMINAL_FORMATTER))
+            else:
+                self.logger.log(31, code_action)
         self.logger.warning("====")
 
     def run(self, **kwargs):
@@ -559,8 +920,8 @@ class CodeAgent(Agent):
 
         self.python_evaluator = evaluate_python_code
         self.additional_authorized_imports = additional_authorized_imports if additional_authorized_imports else []
-        self.authorized_imports = list(set(LIST_SAFE_MODULES) | set(self.additional_authorized_imports))
-        self.system_prompt = self.system_prompt.replace("<<authorized_imports>>", str(self.authorized_imports))
+        self.authorized_imports = get_authorized_imports(tuple(sorted(self.additional_authorized_imports)))
+        self.system_prompt = self.render_system_prompt()
 
     def parse_code_blob(self, result: str) -> str:
         """
@@ -603,7 +964,7 @@ class CodeAgent(Agent):
 
         task_message = {
             "role": MessageRole.USER,
-            "content": "Task: " + self.task,
+            "content": _TASK_PREFIX + self.task,
         }
 
         self.prompt = [prompt_message, task_message]
@@ -633,10 +994,9 @@ class CodeAgent(Agent):
         # Execute
         self.log_code_action(code_action)
         try:
-            available_tools = {**BASE_PYTHON_TOOLS.copy(), **self.toolbox.tools}
             output = self.python_evaluator(
                 code_action,
-                static_tools=available_tools,
+                static_tools=self.get_static_tools(),
                 custom_tools={},
                 state=self.state,
                 authorized_imports=self.authorized_imports,
@@ -649,6 +1009,16 @@ class CodeAgent(Agent):
             return error_msg
 
 
+def normalize_plan(plan: Optional[str]) -> Optional[str]:
+    """
+    Returns the plan with case and whitespace normalized, so that two wordings of the same plan that only differ in
+    layout compare equal.
+    """
+    if plan is None:
+        return None
+    return "\n".join(" ".join(line.split()) for line in plan.lower().splitlines() if line.strip())
+
+
 class ReactAgent(Agent):
     """
     This agent that solves the given task step by step, using the ReAct framework:
@@ -663,6 +1033,9 @@ class ReactAgent(Agent):
         system_prompt: str = DEFAULT_REACT_CODE_SYSTEM_PROMPT,
         tool_description_template: str = DEFAULT_TOOL_DESCRIPTION_TEMPLATE,
         planning_interval: Optional[int] = None,
+        enable_speculative_planning: bool = False,
+        max_action_tokens: Optional[int] = None,
+        max_plan_tokens: Optional[int] = 1024,
         **kwargs,
     ):
         super().__init__(
@@ -673,6 +1046,56 @@ class ReactAgent(Agent):
             **kwargs,
         )
         self.planning_interval = planning_interval
+        self.enable_speculative_planning = enable_speculative_planning
+        self.max_action_tokens = max_action_tokens
+        self.max_plan_tokens = max_plan_tokens
+        self._planning_prefix_version = None
+        self._planning_prefix_ids = {}
+        self._system_prompt_prefix = (None, None)
+
+    def get_planning_prefix_id(self, system_prompt: str) -> Optional[str]:
+        """
+        Returns a stable hash of the planning prefix (the planning system prompt and the tool descriptions), passed to
+        the LLM engine as `prefix_cache_key` so that a serving backend can reuse the KV cache of this prefix across
+        planning steps. Returns `None` if the LLM engine does not accept a `prefix_cache_key` argument.
+        """
+        if not accepts_keyword_argument(self.llm_engine, "prefix_cache_key"):
+            return None
+        version = (self._toolbox.version, self.tool_description_template)
+        if version != self._planning_prefix_version:
+            self._planning_prefix_ids = {}
+            self._planning_prefix_version = version
+        prefix_id = self._planning_prefix_ids.get(system_prompt)
+        if prefix_id is None:
+            tool_descriptions = self.tool_descriptions
+            prefix_id = hashlib.blake2b(
+                (system_prompt + tool_descriptions).encode("utf-8"), digest_size=16
+            ).hexdigest()
+            self._planning_prefix_ids[system_prompt] = prefix_id
+        return prefix_id
+
+    def get_system_prompt_prefix_id(self) -> Optional[str]:
+        """
+        Returns a stable hash of the rendered system prompt, the static prefix of every step prompt, passed to the LLM
+        engine as `prefix_cache_key` so that a serving backend can reuse its KV cache across steps. Returns `None` if
+        the LLM engine does not accept a `prefix_cache_key` argument.
+        """
+        if not accepts_keyword_argument(self.llm_engine, "prefix_cache_key"):
+            return None
+        if self._system_prompt_prefix[0] != self.system_prompt:
+            prefix_id = hashlib.blake2b(self.system_prompt.encode("utf-8"), digest_size=16).hexdigest()
+            self._system_prompt_prefix = (self.system_prompt, prefix_id)
+        return self._system_prompt_prefix[1]
+
+    def get_planning_engine_kwargs(self, system_prompt: str) -> Dict[str, str]:
+        """
+        Returns the extra keyword arguments passed to the LLM engine for a planning call starting with `system_prompt`.
+        """
+        return self.get_engine_kwargs(
+            prefix_cache_key=self.get_planning_prefix_id(system_prompt),
+            max_new_tokens=self.max_plan_tokens,
+            use_ngram_spec=True,
+        )
 
     def provide_final_answer(self, task, is_mistral=False) -> str:
         """
@@ -711,12 +1134,22 @@ class ReactAgent(Agent):
         except Exception as e:
             return f"Error in generating final llm output: {e}."
 
-    def run(self, task: str, stream: bool = False, reset: bool = True, is_mistral: bool = False, **kwargs):
+    def run(
+        self,
+        task: str,
+        stream: bool = False,
+        reset: bool = True,
+        is_mistral: bool = False,
+        yield_every: int = 1,
+        **kwargs,
+    ):
         """
         Runs the agent for the given task.
 
         Args:
             task (`str`): The task to perform
+            yield_every (`int`, *optional*, defaults to 1): In streaming mode, number of step logs to group in each
+                yielded list. With the default of 1, each step log is yielded on its own.
 
         Example:
         ```py
@@ -734,17 +1167,19 @@ class ReactAgent(Agent):
         else:
             self.logs.append({"task": task})
         if stream:
-            return self.stream_run(task, is_mistral=is_mistral)
+            return self.stream_run(task, is_mistral=is_mistral, yield_every=yield_every)
         else:
             return self.direct_run(task, is_mistral=is_mistral)
 
-    def stream_run(self, task: str, is_mistral: bool = False):
+    def stream_run(self, task: str, is_mistral: bool = False, yield_every: int = 1):
         """
         Runs the agent in streaming mode, yielding steps as they are executed: should be launched only in the `run` method.
+        When `yield_every` is greater than 1, step logs are yielded as lists of up to `yield_every` steps.
         """
         final_answer = None
         iteration = 0
         step_observation_logs = [] # >>>
+        buffered_logs = []
         while final_answer is None and iteration < self.max_iterations:
             try:
                 step_logs, ob = self.step()
@@ -756,7 +1191,16 @@ class ReactAgent(Agent):
                 self.logs[-1]["error"] = e
             finally:
                 iteration += 1
-                yield self.logs[-1]
+                if yield_every == 1:
+                    yield self.logs[-1]
+                else:
+                    buffered_logs.append(self.logs[-1])
+                    if len(buffered_logs) >= yield_every or final_answer is not None:
+                        yield buffered_logs
+                        buffered_logs = []
+
+        if buffered_logs:
+            yield buffered_logs
 
         if final_answer is None and iteration == self.max_iterations:
             error_message = "Reached max iterations."
@@ -765,7 +1209,7 @@ class ReactAgent(Agent):
             self.logger.error(error_message, exc_info=1)
             final_answer = self.provide_final_answer(task, is_mistral=is_mistral)
             final_step_log["final_answer"] = final_answer
-            yield final_step_log
+            yield final_step_log if yield_every == 1 else [final_step_log]
 
         yield final_answer, step_observation_logs # >>>
 
@@ -779,18 +1223,26 @@ class ReactAgent(Agent):
         sm_logs = [] # >>>
         while final_answer is None and iteration < self.max_iterations:
             try:
-                if self.planning_interval is not None and iteration % self.planning_interval == 0:
-                    self.planning_step(task, is_first_step=(iteration == 0), iteration=iteration, is_mistral=is_mistral)
-                step_logs, ob, sm = self.step()
+                is_planning_iteration = self.planning_interval is not None and iteration % self.planning_interval == 0
+                if is_planning_iteration and self.enable_speculative_planning and iteration > 0:
+                    step_result = self.speculative_planning_step(task, iteration=iteration, is_mistral=is_mistral)
+                else:
+                    if is_planning_iteration:
+                        self.planning_step(
+                            task, is_first_step=(iteration == 0), iteration=iteration, is_mistral=is_mistral
+                        )
+                    step_result = self.step()
+                step_logs, ob, sm = step_result
                 step_observation_logs.append(ob) # >>>
                 sm_logs.append(sm) # >>>
                 if "final_answer" in step_logs:
                     final_answer = step_logs["final_answer"]
+                    if final_answer is not None:
+                        break
             except AgentError as e:
                 self.logger.error(e, exc_info=1)
                 self.logs[-1]["error"] = e
-            finally:
-                iteration += 1
+            iteration += 1
 
         if final_answer is None and iteration == self.max_iterations:
             error_message = "Reached max iterations."
@@ -806,7 +1258,58 @@ class ReactAgent(Agent):
 
         return final_answer, step_observation_logs, sm_logs # >>>
 
-    def planning_step(self, task, is_first_step: bool = False, iteration: int = None, is_mistral: bool = False):
+    def speculative_planning_step(self, task, iteration: int, is_mistral: bool = False):
+        """
+        Updates the plan while the next step is speculatively run on the current plan, in another thread.
+        If the updated plan is the same as the current one, up to case and whitespace, the speculative step is kept. Otherwise its logs and its
+        changes to the state are rolled back and the step is run again on the new plan. The LLM engine must be safe to
+        call from two threads, and side effects of the tools called by a discarded step are not rolled back.
+
+        Args:
+            task (`str`): The task to perform
+            iteration (`int`): The number of the current step, used as an indication for the LLM.
+        """
+        agent_memory = self.write_inner_memory_from_logs(summary_mode=False, is_mistral=is_mistral)
+        previous_plan = next((log["plan"] for log in reversed(self.logs) if "plan" in log), None)
+        logs_length = len(self.logs)
+        state_snapshot = self.state.copy()
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            plan_future = executor.submit(
+                self.planning_step,
+                task,
+                iteration=iteration,
+                is_mistral=is_mistral,
+                agent_memory=agent_memory,
+                append_log=False,
+            )
+            try:
+                step_result, step_error = self.step(), None
+            except AgentError as e:
+                step_result, step_error = None, e
+            plan_log = plan_future.result()
+
+        if normalize_plan(plan_log["plan"]) == normalize_plan(previous_plan):
+            self.logs.insert(logs_length, plan_log)
+            if step_error is not None:
+                raise step_error
+            return step_result
+
+        self.logger.debug("===== Plan changed, discarding the speculative step =====")
+        del self.logs[logs_length:]
+        self.state = state_snapshot
+        self.logs.append(plan_log)
+        return self.step()
+
+    def planning_step(
+        self,
+        task,
+        is_first_step: bool = False,
+        iteration: int = None,
+        is_mistral: bool = False,
+        agent_memory: Optional[List[Dict[str, str]]] = None,
+        append_log: bool = True,
+    ):
         """
         Used periodically by the agent to plan the next steps to reach the objective.
 
@@ -814,6 +1317,12 @@ class ReactAgent(Agent):
             task (`str`): The task to perform
             is_first_step (`bool`): If this step is not the first one, the plan should be an update over a previous plan.
             iteration (`int`): The number of the current step, used as an indication for the LLM.
+            agent_memory (`List[Dict[str, str]]`, *optional*): The memory to update the plan from. Built from the
+                logs if not given.
+            append_log (`bool`, *optional*, defaults to `True`): Whether to append the plan log to the logs.
+
+        Returns:
+            The plan log, with the `plan` and `facts` keys.
         """
         if is_first_step:
             if not is_mistral:
@@ -831,18 +1340,23 @@ class ReactAgent(Agent):
 Now begin!""",
             }
 
-            answer_facts = self.llm_engine([message_prompt_facts, message_prompt_task])
+            answer_facts = self.llm_engine(
+                [message_prompt_facts, message_prompt_task],
+                **self.get_engine_kwargs(max_new_tokens=self.max_plan_tokens, use_ngram_spec=True),
+            )
 
             message_user_prompt_plan = {
                 "role": MessageRole.USER,
-                "content": USER_PROMPT_PLAN.format(
+                "content": _USER_PROMPT_PLAN_FORMAT(
                     task=task,
-                    tool_descriptions=self._toolbox.show_tool_descriptions(self.tool_description_template),
+                    tool_descriptions=self.tool_descriptions,
                     answer_facts=answer_facts,
                 ),
             }
             answer_plan = self.llm_engine(
-                [message_system_prompt_plan, message_user_prompt_plan], stop_sequences=["<end_plan>"]
+                [message_system_prompt_plan, message_user_prompt_plan],
+                stop_sequences=["<end_plan>"],
+                **self.get_planning_engine_kwargs(SYSTEM_PROMPT_PLAN),
             )
 
             final_plan_redaction = f"""Here is the plan of action that I will follow to solve the task:
@@ -853,14 +1367,15 @@ Now begin!""",
 ```
 {answer_facts}
 ```""".strip()
-            self.logs.append({"plan": final_plan_redaction, "facts": final_facts_redaction})
+            plan_log = {"plan": final_plan_redaction, "facts": final_facts_redaction}
             self.logger.debug("===== Initial plan: =====")
             self.logger.debug(final_plan_redaction)
         else:  # update plan
-            agent_memory = self.write_inner_memory_from_logs(
-                summary_mode=False,
-                is_mistral=is_mistral
-            )  # This will not log the plan but will log facts
+            if agent_memory is None:
+                agent_memory = self.write_inner_memory_from_logs(
+                    summary_mode=False,
+                    is_mistral=is_mistral
+                )  # This will not log the plan but will log facts
 
             # Redact updated facts
             if not is_mistral:
@@ -877,42 +1392,52 @@ Now begin!""",
                 "role": MessageRole.USER,
                 "content": USER_PROMPT_FACTS_UPDATE,
             }
-            facts_update = self.llm_engine([facts_update_system_prompt] + agent_memory + [facts_update_message])
+            facts_update = self.llm_engine(
+                [facts_update_system_prompt] + agent_memory + [facts_update_message],
+                **self.get_engine_kwargs(max_new_tokens=self.max_plan_tokens, use_ngram_spec=True),
+            )
 
             # Redact updated plan
+            system_prompt_plan_update = render_plan_update_system_prompt(task)
             if not is_mistral:
                 plan_update_message = {
                     "role": MessageRole.SYSTEM,
-                    "content": SYSTEM_PROMPT_PLAN_UPDATE.format(task=task),
+                    "content": system_prompt_plan_update,
                 }
             else:
                 plan_update_message = {
                     "role": MessageRole.USER,
-                    "content": SYSTEM_PROMPT_PLAN_UPDATE.format(task=task),
+                    "content": system_prompt_plan_update,
                 }
             plan_update_message_user = {
                 "role": MessageRole.USER,
-                "content": USER_PROMPT_PLAN_UPDATE.format(
+                "content": _USER_PROMPT_PLAN_UPDATE_FORMAT(
                     task=task,
-                    tool_descriptions=self._toolbox.show_tool_descriptions(self.tool_description_template),
+                    tool_descriptions=self.tool_descriptions,
                     facts_update=facts_update,
                     remaining_steps=(self.max_iterations - iteration),
                 ),
             }
             plan_update = self.llm_engine(
-                [plan_update_message] + agent_memory + [plan_update_message_user], stop_sequences=["<end_plan>"]
+                [plan_update_message] + agent_memory + [plan_update_message_user],
+                stop_sequences=["<end_plan>"],
+                **self.get_planning_engine_kwargs(system_prompt_plan_update),
             )
 
             # Log final facts and plan
-            final_plan_redaction = PLAN_UPDATE_FINAL_PLAN_REDACTION.format(task=task, plan_update=plan_update)
+            final_plan_redaction = _PLAN_UPDATE_FINAL_PLAN_REDACTION_FORMAT(task=task, plan_update=plan_update)
             final_facts_redaction = f"""Here is the updated list of the facts that I know:
 ```
 {facts_update}
 ```"""
-            self.logs.append({"plan": final_plan_redaction, "facts": final_facts_redaction})
+            plan_log = {"plan": final_plan_redaction, "facts": final_facts_redaction}
             self.logger.debug("===== Updated plan: =====")
             self.logger.debug(final_plan_redaction)
 
+        if append_log:
+            self.logs.append(plan_log)
+        return plan_log
+
 
 class ReactJsonAgent(ReactAgent):
     """
@@ -928,6 +1453,8 @@ class ReactJsonAgent(ReactAgent):
         system_prompt: str = DEFAULT_REACT_JSON_SYSTEM_PROMPT,
         tool_description_template: str = DEFAULT_TOOL_DESCRIPTION_TEMPLATE,
         planning_interval: Optional[int] = None,
+        tool_concurrency: Optional[int] = None,
+        max_action_tokens: Optional[int] = 512,
         **kwargs,
     ):
         super().__init__(
@@ -936,8 +1463,65 @@ class ReactJsonAgent(ReactAgent):
             system_prompt=system_prompt,
             tool_description_template=tool_description_template,
             planning_interval=planning_interval,
+            max_action_tokens=max_action_tokens,
             **kwargs,
         )
+        if tool_concurrency is None:
+            tool_concurrency = int(os.environ.get("TOOL_CONCURRENCY_LIMIT", 4))
+        self.tool_concurrency = max(1, tool_concurrency)
+
+    def get_final_answer(self, arguments: Union[str, Dict[str, Any]]) -> Any:
+        """
+        Returns the final answer from the arguments of a `final_answer` tool call.
+        """
+        if isinstance(arguments, dict):
+            if "answer" in arguments:
+                answer = arguments["answer"]
+                if isinstance(answer, str) and answer in self.state.keys():
+                    # if the answer is a state variable, return the value
+                    answer = self.state[answer]
+            else:
+                answer = arguments
+        else:
+            answer = arguments
+        return answer
+
+    def process_observation(self, observation: Any) -> str:
+        """
+        Turns a tool output into the text shown to the LLM, storing non-text outputs in the state.
+        """
+        observation_type = type(observation)
+        if observation_type == AgentText:
+            return str(observation).strip()
+        # TODO: observation naming could allow for different names of same type
+        if observation_type == AgentImage:
+            observation_name = "image.png"
+        elif observation_type == AgentAudio:
+            observation_name = "audio.mp3"
+        else:
+            observation_name = "object.object"
+
+        self.state[observation_name] = observation
+        return f"Stored '{observation_name}' in memory."
+
+    def execute_tool_calls(self, tool_calls: List[Tuple[str, Dict[str, str]]]) -> List[Union[Any, AgentError]]:
+        """
+        Executes independent tool calls concurrently, using up to `self.tool_concurrency` threads.
+        Results are returned in the order of `tool_calls`; a failing call yields its `AgentError` in place of an
+        output, so that it does not cancel the other calls.
+        """
+        results: List[Union[Any, AgentError]] = [None] * len(tool_calls)
+        with ThreadPoolExecutor(max_workers=min(self.tool_concurrency, len(tool_calls))) as executor:
+            futures = {
+                executor.submit(self.execute_tool_call, tool_name, arguments): index
+                for index, (tool_name, arguments) in enumerate(tool_calls)
+            }
+            for future in as_completed(futures):
+                try:
+                    results[futures[future]] = future.result()
+                except AgentError as e:
+                    results[futures[future]] = e
+        return results
 
     def step(self):
         """
@@ -952,13 +1536,16 @@ class ReactJsonAgent(ReactAgent):
         # Add new step in logs
         current_step_logs = {}
         self.logs.append(current_step_logs)
-        current_step_logs["agent_memory"] = agent_memory.copy()
+        # The memory list is freshly built for this step and never mutated afterwards, so the log shares it
+        current_step_logs["agent_memory"] = agent_memory
 
         self.logger.info("===== Calling LLM with this last message: =====")
         self.logger.info(self.prompt[-1])
 
         try:
-            llm_output = self.llm_engine(self.prompt, stop_sequences=["<end_action>", "Observation:"])
+            llm_output = self.generate_action(
+                ["<end_action>", "Observation:"], is_json_action_complete, max_new_tokens=self.max_action_tokens
+            )
         except Exception as e:
             raise AgentGenerationError(f"Error in generating llm output: {e}.")
         self.logger.debug("===== Output message of the LLM: =====")
@@ -970,49 +1557,64 @@ class ReactJsonAgent(ReactAgent):
         rationale, action = self.extract_action(llm_output=llm_output, split_token="Action:")
 
         try:
-            tool_name, arguments = self.tool_parser(action)
+            tool_call = self.tool_parser(action)
         except Exception as e:
             raise AgentParsingError(f"Could not parse the given action: {e}.")
 
         current_step_logs["rationale"] = rationale
+        if isinstance(tool_call, list):
+            return self.multi_tool_step(tool_call, current_step_logs)
+        tool_name, arguments = tool_call
         current_step_logs["tool_call"] = {"tool_name": tool_name, "tool_arguments": arguments}
 
         # Execute
         self.logger.warning(f"Calling tool: '{tool_name}' with arguments: {arguments}")
         if tool_name == "final_answer":
-            if isinstance(arguments, dict):
-                if "answer" in arguments:
-                    answer = arguments["answer"]
-                    if (
-                        isinstance(answer, str) and answer in self.state.keys()
-                    ):  # if the answer is a state variable, return the value
-                        answer = self.state[answer]
-                else:
-                    answer = arguments
-            else:
-                answer = arguments
-            current_step_logs["final_answer"] = answer
+            current_step_logs["final_answer"] = self.get_final_answer(arguments)
             return current_step_logs
         else:
             observation = self.execute_tool_call(tool_name, arguments)
-            observation_type = type(observation)
-            if observation_type == AgentText:
-                updated_information = str(observation).strip()
-            else:
-                # TODO: observation naming could allow for different names of same type
-                if observation_type == AgentImage:
-                    observation_name = "image.png"
-                elif observation_type == AgentAudio:
-                    observation_name = "audio.mp3"
-                else:
-                    observation_name = "object.object"
+            updated_information = self.process_observation(observation)
+            self.logger.info(updated_information)
+            current_step_logs["observation"] = updated_information
+            return current_step_logs
 
-                self.state[observation_name] = observation
-                updated_information = f"Stored '{observation_name}' in memory."
+    def multi_tool_step(self, tool_calls: List[Tuple[str, Dict[str, str]]], current_step_logs: Dict[str, Any]):
+        """
+        Executes several tool calls emitted in a single action. Calls listed after a `final_answer` call are dropped,
+        the ones before it are run concurrently and their outputs are logged in order.
+        """
+        final_answer_index = next(
+            (index for index, (tool_name, _) in enumerate(tool_calls) if tool_name == "final_answer"), None
+        )
+        if final_answer_index is not None:
+            tool_calls = tool_calls[: final_answer_index + 1]
+        current_step_logs["tool_call"] = [
+            {"tool_name": tool_name, "tool_arguments": arguments} for tool_name, arguments in tool_calls
+        ]
 
+        # Execute
+        tools_to_run = tool_calls if final_answer_index is None else tool_calls[:-1]
+        for tool_name, arguments in tools_to_run:
+            self.logger.warning(f"Calling tool: '{tool_name}' with arguments: {arguments}")
+        observations = []
+        for (tool_name, _), result in zip(tools_to_run, self.execute_tool_calls(tools_to_run)):
+            if isinstance(result, AgentError):
+                self.logger.error(result.message)
+                observations.append(f"Error in call to '{tool_name}': {result.message}")
+            else:
+                observations.append(self.process_observation(result))
+        if observations:
+            current_step_logs["observations"] = observations
+            updated_information = "\n".join(
+                f"[Call {index} - {tool_name}] {observation}"
+                for index, ((tool_name, _), observation) in enumerate(zip(tools_to_run, observations))
+            )
             self.logger.info(updated_information)
             current_step_logs["observation"] = updated_information
-            return current_step_logs
+        if final_answer_index is not None:
+            current_step_logs["final_answer"] = self.get_final_answer(tool_calls[-1][1])
+        return current_step_logs
 
 
 class ReactCodeAgent(ReactAgent):
@@ -1031,6 +1633,8 @@ class ReactCodeAgent(ReactAgent):
         additional_authorized_imports: Optional[List[str]] = None,
         planning_interval: Optional[int] = None,
         is_mistral: bool = False,
+        max_action_tokens: Optional[int] = 1024,
+        use_draft_model: bool = True,
         **kwargs,
     ):
         super().__init__(
@@ -1039,6 +1643,7 @@ class ReactCodeAgent(ReactAgent):
             system_prompt=system_prompt,
             tool_description_template=tool_description_template,
             planning_interval=planning_interval,
+            max_action_tokens=max_action_tokens,
             **kwargs,
         )
 
@@ -1051,10 +1656,11 @@ class ReactCodeAgent(ReactAgent):
 
         self.python_evaluator = evaluate_python_code
         self.additional_authorized_imports = additional_authorized_imports if additional_authorized_imports else []
-        self.authorized_imports = list(set(LIST_SAFE_MODULES) | set(self.additional_authorized_imports))
-        self.system_prompt = self.system_prompt.replace("<<authorized_imports>>", str(self.authorized_imports))
+        self.authorized_imports = get_authorized_imports(tuple(sorted(self.additional_authorized_imports)))
+        self.system_prompt = self.render_system_prompt()
         self.custom_tools = {}
         self.is_mistral = is_mistral
+        self.use_draft_model = use_draft_model
 
     def step(self):
         """
@@ -1063,20 +1669,26 @@ class ReactCodeAgent(ReactAgent):
         """
         agent_memory = self.write_inner_memory_from_logs(is_mistral=self.is_mistral)
 
-        self.prompt = agent_memory.copy()
+        self.prompt = agent_memory
 
         self.logger.debug("===== New step =====")
 
         # Add new step in logs
         current_step_logs = {}
         self.logs.append(current_step_logs)
-        current_step_logs["agent_memory"] = agent_memory.copy()
+        # The memory list is freshly built for this step and never mutated afterwards, so the log shares it
+        current_step_logs["agent_memory"] = agent_memory
 
         self.logger.info("===== Calling LLM with these last messages: =====")
         self.logger.info(self.prompt[-2:])
 
         try:
-            llm_output = self.llm_engine(self.prompt, stop_sequences=["<end_action>", "Observation:"])
+            llm_output = self.generate_action(
+                ["<end_action>", "Observation:"],
+                is_code_action_complete,
+                max_new_tokens=self.max_action_tokens,
+                use_draft_model=self.use_draft_model,
+            )
         except Exception as e:
             raise AgentGenerationError(f"Error in generating llm output: {e}.")
 
@@ -1106,10 +1718,7 @@ class ReactCodeAgent(ReactAgent):
         try:
             result = self.python_evaluator(
                 code_action,
-                static_tools={
-                    **BASE_PYTHON_TOOLS.copy(),
-                    **self.toolbox.tools,
-                },
+                static_tools=self.get_static_tools(),
                 custom_tools=self.custom_tools,
                 state=self.state,
                 authorized_imports=self.authorized_imports,
@@ -1123,11 +1732,10 @@ class ReactCodeAgent(ReactAgent):
             if "'dict' object has no attribute 'read'" in str(e):
                 error_msg += "\nYou get this error because you passed a dict as input for one of the arguments instead of a string."
             raise AgentExecutionError(error_msg)
-        for line in code_action.split("\n"):
-            if line[: len("final_answer")] == "final_answer":
-                self.logger.warning(">>> Final answer:")
-                self.logger.log(32, result)
-                current_step_logs["final_answer"] = result
+        if _FINAL_ANSWER_RE.search(code_action) is not None:
+            self.logger.warning(">>> Final answer:")
+            self.logger.log(32, result)
+            current_step_logs["final_answer"] = result
         
         obs = current_step_logs["observation"] if "observation" in current_step_logs else ''
         return current_step_logs, obs # >>
@@ -1135,7 +1743,11 @@ class ReactCodeAgent(ReactAgent):
 
 ###########################################
 TAVILY_API_URL = "https://api.tavily.com"
+import asyncio
 import json
+import math
+import weakref
+from collections import Counter
 from typing import Dict, List, Optional
 
 import aiohttp
@@ -1155,6 +1767,119 @@ from langchain.agents.format_scratchpad import format_log_to_str
 from langchain.agents.output_parsers import ReActSingleInputOutputParser
 from langchain.tools.render import ToolsRenderer, render_text_description
 
+# Results pointing to these files are dropped, their extracted content is rarely usable.
+_SKIPPED_URL_SUFFIXES = (".pdf",)
+
+# Chinese sentences are not followed by a space: they end right after their punctuation
+_SENTENCE_END_RE = re.compile(r"(?<=[.!?])\s+|(?<=[。！？；])\s*|\n+")
+_CJK_CHARS = "\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff"
+# Runs of CJK characters (first group), or words of the other word characters (second group)
+_TERM_RE = re.compile(rf"([{_CJK_CHARS}]+)|([^\W{_CJK_CHARS}]+)")
+
+
+def text_terms(text: str) -> List[str]:
+    """Lowercased words of `text`, each run of CJK characters being split into its character bigrams."""
+    terms = []
+    for cjk_run, word in _TERM_RE.findall(text.lower()):
+        if len(cjk_run) > 1:
+            terms.extend(cjk_run[i : i + 2] for i in range(len(cjk_run) - 1))
+        else:
+            terms.append(cjk_run or word)
+    return terms
+
+
+def select_relevant_text(text: str, query: str, limit: int, k1: float = 1.5, b: float = 0.75) -> str:
+    """Shorten `text` to at most `limit` characters, keeping its sentences most relevant to `query`.
+
+    The sentences are ranked by their BM25 score against the words of the query, over the sentences of the text, and
+    the best ones fitting in `limit` are kept in their original order.
+
+    Args:
+        text: The text to shorten.
+        query: The query the kept sentences should answer. Without any word, the text is cut at `limit` instead.
+        limit: The maximum number of characters kept.
+        k1: The BM25 term frequency saturation.
+        b: The BM25 length normalization.
+    Returns:
+        The kept sentences, separated by spaces, or `text` itself if it already fits.
+    """
+    if len(text) <= limit:
+        return text
+    query_words = set(text_terms(query))
+    sentences = [sentence for sentence in _SENTENCE_END_RE.split(text) if sentence.strip()]
+    if not query_words or len(sentences) < 2:
+        return text[:limit]
+
+    sentence_words = [text_terms(sentence) for sentence in sentences]
+    average_length = sum(len(words) for words in sentence_words) / len(sentences) or 1
+    document_frequency = {word: sum(word in words for words in sentence_words) for word in query_words}
+    idf = {
+        word: math.log((len(sentences) - frequency + 0.5) / (frequency + 0.5) + 1)
+        for word, frequency in document_frequency.items()
+    }
+
+    def score(words: List[str]) -> float:
+        length_norm = k1 * (1 - b + b * len(words) / average_length)
+        counts = Counter(words)
+        return sum(
+            idf[word] * counts[word] * (k1 + 1) / (counts[word] + length_norm) for word in query_words if counts[word]
+        )
+
+    scores = [score(words) for words in sentence_words]
+    if not any(scores):
+        # No sentence shares a word with the query: nothing to rank them by
+        return text[:limit]
+    # Best sentences first, ties in their original order
+    ranked = sorted(range(len(sentences)), key=lambda i: -scores[i])
+    kept, size = [], 0
+    for i in ranked:
+        if size + len(sentences[i]) + 1 > limit:
+            continue
+        kept.append(i)
+        size += len(sentences[i]) + 1
+    if not kept:
+        return text[:limit]
+    return " ".join(sentences[i] for i in sorted(kept))
+
+# Connections to the Tavily API are pooled and reused across calls instead of paying a TCP/TLS handshake per query.
+# Synchronous calls go over HTTP/2 when httpx and h2 are installed, and fall back to a requests session otherwise.
+# aiohttp sessions are bound to an event loop, so there is one async session per running loop.
+try:
+    import h2  # noqa: F401  (needed by httpx for HTTP/2)
+    import httpx
+except ImportError:
+    httpx = None
+
+if httpx is not None:
+    _http_session = httpx.Client(http2=True, timeout=None, limits=httpx.Limits(max_connections=32))
+else:
+    _http_session = requests.Session()
+    # Room for one connection per concurrent evaluation question instead of the default pool of 10
+    _http_session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=32, pool_maxsize=32))
+_async_sessions: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, aiohttp.ClientSession]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def get_async_session() -> aiohttp.ClientSession:
+    """Return the pooled aiohttp session of the running event loop, creating it if needed."""
+    loop = asyncio.get_running_loop()
+    session = _async_sessions.get(loop)
+    if session is None or session.closed:
+        # Idle connections are kept a minute and resolved hostnames five minutes, so that consecutive searches skip
+        # the DNS lookup and the TLS handshake
+        connector = aiohttp.TCPConnector(limit=100, limit_per_host=50, keepalive_timeout=60, ttl_dns_cache=300)
+        session = aiohttp.ClientSession(connector=connector)
+        _async_sessions[loop] = session
+    return session
+
+
+async def close_async_session() -> None:
+    """Close the pooled aiohttp session of the running event loop, if any."""
+    session = _async_sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None and not session.closed:
+        await session.close()
+
 class TavilySearchAPIWrapper(BaseModel):
 
     """Wrapper for Tavily Search API."""
@@ -1188,7 +1913,9 @@ class TavilySearchAPIWrapper(BaseModel):
         include_raw_content: Optional[bool] = False,
         include_images: Optional[bool] = False,
     ) -> Dict:
-        query = query.ljust(5, ' ')
+        # The Tavily API rejects queries shorter than 5 characters
+        if len(query) < 5:
+            query = query.ljust(5, ' ')
         params = {
             "api_key": self.tavily_api_key.get_secret_value(),
             "query": query,
@@ -1200,13 +1927,13 @@ class TavilySearchAPIWrapper(BaseModel):
             "include_raw_content": include_raw_content,
             "include_images": include_images,
         }
-        response = requests.post(
+        response = _http_session.post(
             # type: ignore
             f"{TAVILY_API_URL}/search",
             json=params,
         )
         response.raise_for_status()
-        return response.json()
+        return _json_loads(response.content)
 
     def results(
         self,
@@ -1243,7 +1970,6 @@ class TavilySearchAPIWrapper(BaseModel):
                 score: The score of the result.
                 raw_content: The raw content of the result.
         """  # noqa: E501
-        query = query.ljust(5, ' ')
         raw_search_results = self.raw_results(
             query,
             max_results=max_results,
@@ -1255,7 +1981,7 @@ class TavilySearchAPIWrapper(BaseModel):
             include_images=include_images,
         )
         # return raw_search_results["results"]
-        return self.clean_results(raw_search_results["results"])
+        return self.clean_results(raw_search_results["results"], query)
 
     def results_content_only(
         self,
@@ -1292,7 +2018,6 @@ class TavilySearchAPIWrapper(BaseModel):
                 score: The score of the result.
                 raw_content: The raw content of the result.
         """  # noqa: E501
-        query = query.ljust(5, ' ')
         raw_search_results = self.raw_results(
             query,
             max_results=max_results,
@@ -1304,7 +2029,7 @@ class TavilySearchAPIWrapper(BaseModel):
             include_images=include_images,
         )
         # return raw_search_results["results"]
-        return self.clean_results_content_only(raw_search_results["results"])
+        return self.clean_results_content_only(raw_search_results["results"], query)
 
     async def raw_results_async(
         self,
@@ -1319,8 +2044,11 @@ class TavilySearchAPIWrapper(BaseModel):
     ) -> Dict:
         """Get results from the Tavily Search API asynchronously."""
 
+        # The Tavily API rejects queries shorter than 5 characters
+        if len(query) < 5:
+            query = query.ljust(5, ' ')
+
         # Function to perform the API call
-        query = query.ljust(5, ' ')
         async def fetch() -> str:
             params = {
                 "api_key": self.tavily_api_key.get_secret_value(),
@@ -1333,16 +2061,15 @@ class TavilySearchAPIWrapper(BaseModel):
                 "include_raw_content": include_raw_content,
                 "include_images": include_images,
             }
-            async with aiohttp.ClientSession() as session:
-                async with session.post(f"{TAVILY_API_URL}/search", json=params) as res:
-                    if res.status == 200:
-                        data = await res.text()
-                        return data
-                    else:
-                        raise Exception(f"Error {res.status}: {res.reason}")
+            async with get_async_session().post(f"{TAVILY_API_URL}/search", json=params) as res:
+                if res.status == 200:
+                    data = await res.read()
+                    return data
+                else:
+                    raise Exception(f"Error {res.status}: {res.reason}")
 
-        results_json_str = await fetch()
-        return json.loads(results_json_str)
+        results_json = await fetch()
+        return _json_loads(results_json)
 
     async def results_async(
         self,
@@ -1355,7 +2082,6 @@ class TavilySearchAPIWrapper(BaseModel):
         include_raw_content: Optional[bool] = False,
         include_images: Optional[bool] = False,
     ) -> List[Dict]:
-        query = query.ljust(5, ' ')
         results_json = await self.raw_results_async(
             query=query,
             max_results=max_results,
@@ -1366,59 +2092,74 @@ class TavilySearchAPIWrapper(BaseModel):
             include_raw_content=include_raw_content,
             include_images=include_images,
         )
-        return self.clean_results(results_json["results"])
+        return self.clean_results(results_json["results"], query)
 
-    def clean_results(self, results: List[Dict], query: str ='') -> List[Dict]:
-        """Clean results from Tavily Search API and truncate content."""
-        truncated_results = []
+    async def results_many(
+        self, queries: List[str], content_only: bool = False, max_concurrency: int = 8, **kwargs
+    ) -> List[List[Dict]]:
+        """Run several queries concurrently over the pooled session.
 
-        for result in results:
+        Args:
+            queries: The queries to search for.
+            content_only: Whether to keep only the content of the results, as `results_content_only` does.
+            max_concurrency: The maximum number of requests in flight, to stay within the API rate limits.
+            kwargs: Search options forwarded to `raw_results_async`.
+        Returns:
+            The cleaned results of each query, in the order of `queries`.
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
 
-            if result["url"].endswith('.pdf'):
-                print('>>>>>>HERE IS PDF>>>>>>>')
-                continue
+        async def search(query: str) -> List[Dict]:
+            async with semaphore:
+                if not content_only:
+                    return await self.results_async(query, **kwargs)
+                raw_search_results = await self.raw_results_async(query, **kwargs)
+                return self.clean_results_content_only(raw_search_results["results"], query)
 
-            if result['raw_content'] is not None:
-                raw_content = result['raw_content']
-                if len(raw_content) > self.context_str_limit:
-                    raw_content = raw_content[:self.context_str_limit]
-                assert len(raw_content) <= self.context_str_limit
-                truncated_results.append({"title": result["title"],
-                                        "url": result["url"], 
-                                        "raw_content": raw_content})
-            else:
-                content = result['content']
-                if len(content) > self.context_str_limit:
-                    content = content[:self.context_str_limit]
-                assert len(content) <= self.context_str_limit
-                truncated_results.append({"title": result["title"],
-                                        "url": result["url"], 
-                                        "content": content})
-        return truncated_results
-    
-    def clean_results_content_only(self, results: List[Dict], query: str ='') -> List[Dict]:
-        """Clean results from Tavily Search API and truncate content."""
-        truncated_results = []
+        return await asyncio.gather(*(search(query) for query in queries))
 
-        for result in results:
+    def results_many_sync(self, queries: List[str], **kwargs) -> List[List[Dict]]:
+        """Blocking version of `results_many`. From a running event loop, the searches run in a worker thread."""
 
-            if result["url"].endswith('.pdf'):
-                print('>>>>>>HERE IS PDF>>>>>>>')
-                continue
+        async def run() -> List[List[Dict]]:
+            try:
+                return await self.results_many(queries, **kwargs)
+            finally:
+                await close_async_session()
 
-            if result['raw_content'] is not None:
-                raw_content = result['raw_content']
-                if len(raw_content) > self.context_str_limit:
-                    raw_content = raw_content[:self.context_str_limit]
-                assert len(raw_content) <= self.context_str_limit
-                truncated_results.append({"raw_content": raw_content})
-            else:
-                content = result['content']
-                if len(content) > self.context_str_limit:
-                    content = content[:self.context_str_limit]
-                assert len(content) <= self.context_str_limit
-                truncated_results.append({"content": content})
-        return truncated_results
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(run())
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            return executor.submit(lambda: asyncio.run(run())).result()
+
+    def clean_results(self, results: List[Dict], query: str ='') -> List[Dict]:
+        """Clean results from Tavily Search API and shorten content to its sentences most relevant to `query`.
+
+        Each result is capped separately at `context_str_limit` characters, there is no budget shared by the results.
+        """
+        limit = self.context_str_limit
+        return [
+            {"title": result["title"], "url": result["url"],
+             "raw_content": select_relevant_text(result["raw_content"], query, limit)}
+            if result["raw_content"] is not None
+            else {"title": result["title"], "url": result["url"],
+                  "content": select_relevant_text(result["content"], query, limit)}
+            for result in results
+            if not result["url"].endswith(_SKIPPED_URL_SUFFIXES)
+        ]
+    
+    def clean_results_content_only(self, results: List[Dict], query: str ='') -> List[Dict]:
+        """Same as `clean_results`, keeping only the content of each result."""
+        limit = self.context_str_limit
+        return [
+            {"raw_content": select_relevant_text(result["raw_content"], query, limit)}
+            if result["raw_content"] is not None
+            else {"content": select_relevant_text(result["content"], query, limit)}
+            for result in results
+            if not result["url"].endswith(_SKIPPED_URL_SUFFIXES)
+        ]
 
 class TavilySearchHuggingfaceTool(Tool):
     """Tool that queries the Tavily Search API and gets back json."""
@@ -1440,6 +2181,11 @@ class TavilySearchHuggingfaceTool(Tool):
     search_depth: str = 'basic'
     context_str_limit: int = 5000
 
+    @functools.cached_property
+    def api_wrapper(self) -> TavilySearchAPIWrapper:
+        """The Tavily API wrapper, built on first use and then reused by every search of this tool."""
+        return TavilySearchAPIWrapper()
+
     def truncate_context(self, data: List[Dict], max_length=5000):
         """
         Truncates the text content in each dictionary of the given list
@@ -1468,11 +2214,18 @@ class TavilySearchHuggingfaceTool(Tool):
 
     def forward(
         self,
-        query: str
-    ) -> Union[List[Dict], str]:
-        """Use the tool."""
+        query: Union[str, List[str]]
+    ) -> Union[List[Dict], List[List[Dict]], str]:
+        """Use the tool. A list of queries is searched concurrently and gives one result list per query."""
         try:
-            self.api_wrapper = TavilySearchAPIWrapper()
+            if isinstance(query, list):
+                results = self.api_wrapper.results_many_sync(
+                    query,
+                    content_only=True,
+                    max_results=self.max_results,
+                    search_depth=self.search_depth,
+                )
+                return [self.truncate_context(result, self.context_str_limit) for result in results]
             query = query.ljust(5, '?') 
             results = self.api_wrapper.results_content_only( # results
                 query,
@@ -1495,7 +2248,7 @@ Task: the input question you must answer
 Thought: you should always think about what to do
 Search: the query to search.
 Observation: the result of the search
-... (this Thought/Search/Observation can repeat 3 times)
+... (this Thought/Search/Observation can repeat)
 Thought: I now know the final answer
 Final Answer: the final answer to the original input question, this should be in very detailed and include the summarization of all observation above. 
 
@@ -1521,10 +2274,224 @@ Thought: Now I know the ratings and reviews of Wenchang chicken at Wenchang City
 Final Answer: Based on the search results, I recommend the following three-day itinerary for Hainan Sanya, focusing on tasting the famous local Wenchang chicken.
 ---
 <<authorized_imports>>
-Now Begin! If you solve the task correctly, you will receive a reward of $1,000,000.
 """
 
 
+# The semantic cache lookup fuses the dot products with the argmax in a parallel kernel when numba is installed, so
+# that the cached embeddings are streamed once without materializing the similarities; numpy is used otherwise.
+try:
+    import numba
+except ImportError:
+    numba = None
+
+if numba is not None:
+
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _best_match(embeddings, embedding):
+        n_rows, dim = embeddings.shape
+        n_chunks = numba.get_num_threads()
+        chunk_size = (n_rows + n_chunks - 1) // n_chunks
+        best_indices = np.zeros(n_chunks, dtype=np.int64)
+        best_scores = np.full(n_chunks, -np.inf, dtype=np.float32)
+        for chunk in numba.prange(n_chunks):
+            for i in range(chunk * chunk_size, min((chunk + 1) * chunk_size, n_rows)):
+                score = np.float32(0.0)
+                for j in range(dim):
+                    score += embeddings[i, j] * embedding[j]
+                if score > best_scores[chunk]:
+                    best_scores[chunk] = score
+                    best_indices[chunk] = i
+        best = 0
+        for chunk in range(1, n_chunks):
+            if best_scores[chunk] > best_scores[best]:
+                best = chunk
+        return best_indices[best], best_scores[best]
+
+else:
+
+    def _best_match(embeddings, embedding):
+        similarities = embeddings @ embedding
+        best = int(similarities.argmax())
+        return best, similarities[best]
+
+
+class SemanticCache:
+    """
+    In-process semantic cache of LLM outputs. Prompts are embedded with a small sentence-transformers model, and a
+    cached output is reused when the cosine similarity between its prompt and the new one reaches `threshold`.
+    Embeddings are L2-normalized and stored in one contiguous float32 matrix grown by doubling up to `maxsize` rows, so
+    that a lookup is a single pass over that matrix. Once it is full, the oldest entry is overwritten. Entries older
+    than `ttl` seconds are not returned.
+
+    Args:
+        model_name (`str`, *optional*): The sentence-transformers model used to embed the prompts.
+        threshold (`float`, *optional*, defaults to 0.95): The minimum cosine similarity of a cache hit.
+        initial_capacity (`int`, *optional*, defaults to 64): The number of rows first allocated for embeddings.
+        maxsize (`int`, *optional*, defaults to 4096): The number of entries kept.
+        ttl (`float`, *optional*, defaults to 24 hours): The lifetime of an entry, in seconds.
+    """
+
+    def __init__(
+        self,
+        model_name: str = "sentence-transformers/all-MiniLM-L6-v2",
+        threshold: float = 0.95,
+        initial_capacity: int = 64,
+        maxsize: int = 4096,
+        ttl: float = 24 * 3600,
+    ):
+        self.model_name = model_name
+        self.threshold = threshold
+        self.initial_capacity = min(initial_capacity, maxsize)
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._encoder = None
+        self._embeddings = None
+        self._outputs = []
+        self._created = []
+        # Row overwritten by the next entry once the cache is full
+        self._oldest = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._outputs)
+
+    @property
+    def encoder(self):
+        """The sentence-transformers model, loaded on first use."""
+        if self._encoder is None:
+            from sentence_transformers import SentenceTransformer
+
+            self._encoder = SentenceTransformer(self.model_name)
+        return self._encoder
+
+    def embed(self, text: str) -> np.ndarray:
+        """Returns the L2-normalized float32 embedding of `text`."""
+        return np.asarray(self.encoder.encode(text, normalize_embeddings=True), dtype=np.float32)
+
+    def get(self, embedding: np.ndarray) -> Optional[str]:
+        """Returns the output cached for the most similar prompt, or `None` if none is similar enough."""
+        size = len(self._outputs)
+        if size == 0:
+            return None
+        best, similarity = _best_match(self._embeddings[:size], embedding)
+        if similarity < self.threshold or time.time() - self._created[int(best)] >= self.ttl:
+            return None
+        return self._outputs[int(best)]
+
+    def put(self, embedding: np.ndarray, output: str):
+        """Caches `output` for the prompt embedded as `embedding`, replacing the entry of the same prompt if any."""
+        with self._lock:
+            size = len(self._outputs)
+            if size > 0:
+                # An expired entry of the same prompt is refreshed instead of shadowing the new one
+                best, similarity = _best_match(self._embeddings[:size], embedding)
+                if similarity >= self.threshold:
+                    self._outputs[int(best)] = output
+                    self._created[int(best)] = time.time()
+                    return
+            if self._embeddings is None:
+                self._embeddings = np.empty((self.initial_capacity, embedding.shape[0]), dtype=np.float32)
+            elif size == self._embeddings.shape[0] and size < self.maxsize:
+                grown = np.empty((min(2 * size, self.maxsize), self._embeddings.shape[1]), dtype=np.float32)
+                grown[:size] = self._embeddings
+                self._embeddings = grown
+            if size < self.maxsize:
+                self._embeddings[size] = embedding
+                self._outputs.append(output)
+                self._created.append(time.time())
+                return
+            self._embeddings[self._oldest] = embedding
+            self._outputs[self._oldest] = output
+            self._created[self._oldest] = time.time()
+            self._oldest = (self._oldest + 1) % self.maxsize
+
+
+class SearchCache:
+    """
+    Exact-match cache of search results, keyed by the hash of the stripped and lowercased query. Results are kept in
+    an in-memory LRU and, if `path` is given, in an SQLite file that persists across runs. Entries older than `ttl`
+    seconds are ignored.
+
+    Args:
+        maxsize (`int`, *optional*, defaults to 4096): The number of queries kept in memory.
+        path (`str`, *optional*): The SQLite file backing the cache. Memory only if not given.
+        ttl (`float`, *optional*, defaults to 24 hours): The lifetime of an entry, in seconds.
+    """
+
+    def __init__(self, maxsize: int = 4096, path: Optional[str] = None, ttl: float = 24 * 3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS search_cache (key TEXT PRIMARY KEY, created REAL, results TEXT)"
+            )
+            self._db.commit()
+
+    @staticmethod
+    def make_key(query: str) -> str:
+        return hashlib.sha1(query.strip().lower().encode("utf-8")).hexdigest()
+
+    def get(self, query: str) -> Optional[List[Dict]]:
+        """Returns the cached results of `query`, or `None` if there are none or they expired."""
+        key = self.make_key(query)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if now - entry[0] < self.ttl:
+                    self._entries.move_to_end(key)
+                    return entry[1]
+                del self._entries[key]
+            if self._db is None:
+                return None
+            row = self._db.execute("SELECT created, results FROM search_cache WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[0] >= self.ttl:
+                return None
+            results = json.loads(row[1])
+            self._remember(key, row[0], results)
+            return results
+
+    def put(self, query: str, results: List[Dict]):
+        """Caches the results of `query`."""
+        key = self.make_key(query)
+        created = time.time()
+        with self._lock:
+            self._remember(key, created, results)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO search_cache (key, created, results) VALUES (?, ?, ?)",
+                    (key, created, json.dumps(results)),
+                )
+                self._db.commit()
+
+    def _remember(self, key: str, created: float, results: List[Dict]):
+        self._entries[key] = (created, results)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+
+def parse_search_step(llm_output: str) -> Tuple[str, str, str]:
+    """
+    Splits a search step output ("Summarization: ... Thought: ... Search: ...") into its summarization, thought and
+    search query. As in a ReAct transcript, the last "Search:" of the output is the one acted upon, and its sections
+    are the ones written since the previous "Search:".
+    """
+    before_search, _, search_section = llm_output.rpartition("Search:")
+    rationale = before_search.rpartition("Search:")[2]
+    # The summarization comes before the first thought, the thought acted upon is the last one
+    summarization = rationale.partition("Thought:")[0].rpartition("Summarization")[2].removeprefix(":")
+    thought = rationale.rpartition("Thought:")[2]
+    # The query is the line after "Search:", a streamed output may already hold the start of the next one
+    search_query = search_section.partition("Observation:")[0].strip().partition("\n")[0]
+    return summarization, thought, search_query
+
+
 class ReactCodeSearchAgent(ReactAgent):
     """
     This agent that solves the given task step by step, using the ReAct framework:
@@ -1542,6 +2509,11 @@ class ReactCodeSearchAgent(ReactAgent):
         planning_interval: Optional[int] = None,
         is_mistral: bool = False,
         search_tool: Optional[Tool] = TavilySearchHuggingfaceTool(),
+        max_action_tokens: Optional[int] = 1024,
+        use_draft_model: bool = True,
+        semantic_cache: Optional[SemanticCache] = None,
+        search_cache: Optional[SearchCache] = None,
+        summarize_observations: bool = False,
         **kwargs,
     ):
         super().__init__(
@@ -1550,6 +2522,7 @@ class ReactCodeSearchAgent(ReactAgent):
             system_prompt=system_prompt,
             tool_description_template=tool_description_template,
             planning_interval=planning_interval,
+            max_action_tokens=max_action_tokens,
             **kwargs,
         )
 
@@ -1562,12 +2535,50 @@ class ReactCodeSearchAgent(ReactAgent):
 
         self.python_evaluator = evaluate_python_code
         self.additional_authorized_imports = additional_authorized_imports if additional_authorized_imports else []
-        self.authorized_imports = list(set(LIST_SAFE_MODULES) | set(self.additional_authorized_imports))
-        self.system_prompt = self.system_prompt.replace("<<authorized_imports>>", str(self.authorized_imports))
+        self.authorized_imports = get_authorized_imports(tuple(sorted(self.additional_authorized_imports)))
+        self.system_prompt = self.render_system_prompt()
         self.custom_tools = {}
         self.is_mistral = is_mistral
+        self.use_draft_model = use_draft_model
         self.search_tool = search_tool 
+        self.semantic_cache = semantic_cache
+        self.search_cache = search_cache
+        # With a system prompt that asks for a 'Summarization:' of the last observation, the raw observation is
+        # replaced by that summary in the memory of the next steps, so the prompt grows by summaries only
+        self.summarize_observations = summarize_observations
 
+    def search(self, query: str) -> Union[List[Dict], str]:
+        """
+        Runs the search tool on `query`, reusing the results of an identical earlier query if `search_cache` is set.
+        Failed searches, which the tool reports as a string, are not cached.
+        """
+        if self.search_cache is None:
+            return self.search_tool.forward(query)
+        results = self.search_cache.get(query)
+        if results is None:
+            results = self.search_tool.forward(query)
+            if not isinstance(results, str):
+                self.search_cache.put(query, results)
+        return results
+
+    def summarize_last_observation(self, summarization: str):
+        """
+        Stores `summarization` as the `observation_summary` of the previous step, which is used in place of its
+        observation when the memory is written. An empty summarization leaves the observation as it is.
+        """
+        summarization = summarization.strip()
+        previous_step_log = self.logs[-2] if len(self.logs) > 2 else {}
+        if summarization and "observation" in previous_step_log:
+            previous_step_log["observation_summary"] = summarization
+            # the cache key was computed from the raw observation
+            previous_step_log.pop("obs_hash", None)
+
+    def get_semantic_cache_text(self) -> str:
+        """
+        Returns the text used as the semantic cache key of the current prompt: the task and the last two messages.
+        """
+        messages = self.prompt[1:2] + self.prompt[max(2, len(self.prompt) - 2):]
+        return "\n".join(message["content"] for message in messages)
 
     def step(self):
         """
@@ -1576,22 +2587,40 @@ class ReactCodeSearchAgent(ReactAgent):
         """
         agent_memory = self.write_inner_memory_from_logs(is_mistral=self.is_mistral)
 
-        self.prompt = agent_memory.copy()
+        self.prompt = agent_memory
 
         self.logger.debug("===== New step =====")
 
         # Add new step in logs
         current_step_logs = {}
         self.logs.append(current_step_logs)
-        current_step_logs["agent_memory"] = agent_memory.copy()
+        # The memory list is freshly built for this step and never mutated afterwards, so the log shares it
+        current_step_logs["agent_memory"] = agent_memory
 
         self.logger.info("===== Calling LLM with these last messages: =====")
         self.logger.info(self.prompt[-2:])
 
-        try:
-            llm_output = self.llm_engine(self.prompt, stop_sequences=["<end_action>", "Observation:"])
-        except Exception as e:
-            raise AgentGenerationError(f"Error in generating llm output: {e}.")
+        llm_output = None
+        if self.semantic_cache is not None:
+            cache_embedding = self.semantic_cache.embed(self.get_semantic_cache_text())
+            llm_output = self.semantic_cache.get(cache_embedding)
+            if llm_output is not None:
+                self.logger.debug("===== Reusing a cached LLM output =====")
+
+        if llm_output is None:
+            try:
+                # With a streaming engine, generation stops as soon as the search query line is out
+                llm_output = self.generate_action(
+                    stop_sequences=["<end_action>", "Observation:"],
+                    is_action_complete=is_search_action_complete,
+                    max_new_tokens=self.max_action_tokens,
+                    use_draft_model=self.use_draft_model,
+                    prefix_cache_key=self.get_system_prompt_prefix_id(),
+                )
+            except Exception as e:
+                raise AgentGenerationError(f"Error in generating llm output: {e}.")
+            if self.semantic_cache is not None:
+                self.semantic_cache.put(cache_embedding, llm_output)
 
         self.logger.debug("===== Output message of the LLM: =====")
         self.logger.debug(llm_output)
@@ -1600,43 +2629,33 @@ class ReactCodeSearchAgent(ReactAgent):
         #########################################################################
         search_flag = False
         self.logger.debug("===== Extracting action =====")
-        try:
-            if "Search:" not in llm_output:
-                self.logger.log(32, llm_output)
-                raise AgentParsingError("Search query not found in the output.")
-            split = llm_output.split('Search:')
-            rationale, search_query = (
-                split[-2],
-                split[-1],
-            )
-            search_query = search_query.split('Observation:')[0]
-            current_step_logs["rationale"] = rationale.split('Thought:')[-1]
-            current_step_logs["summarization"] = rationale.split('Thought:')[0].split('Summarization')[-1]
+        # A search takes precedence over a final answer, wherever they appear in the output
+        if "Search:" in llm_output:
+            summarization, thought, search_query = parse_search_step(llm_output)
+            current_step_logs["rationale"] = thought
+            current_step_logs["summarization"] = summarization
+            if self.summarize_observations:
+                self.summarize_last_observation(current_step_logs["summarization"])
             self.logger.warning(">>>> summarization: ")
-            self.logger.log(32, rationale.split('Thought:')[0].split('Summarization')[-1])
+            self.logger.log(32, current_step_logs["summarization"])
             self.logger.warning(">>>> Thought: ")
-            self.logger.log(32, rationale.split('Thought:')[-1])
+            self.logger.log(32, current_step_logs["rationale"])
             self.logger.warning(">>>> Search: ")
             self.logger.log(32, search_query)
             search_flag = True
-        except:
-            try:
-                if "Final Answer:" not in llm_output:
-                    raise AgentParsingError("Final answer not found in the output.")
-                # rationale, final_result = self.extract_action(llm_output=llm_output, split_token="Final Answer:")
-                final_result = llm_output.split("Final Answer:")[-1]
-                self.logger.warning(">>> Final answer:")
-                self.logger.log(32, final_result)
-                current_step_logs["final_answer"] = final_result
-            except Exception as e:
-                self.logger.error(e, exc_info=1)
-                self.logger.debug(f"Error in extracting rational and search_query or final answer, trying to parse the whole output. Error trace: {e}")
-                rationale, search_query = llm_output, llm_output
-                current_step_logs["rationale"] = rationale
+        elif "Final Answer:" in llm_output:
+            final_result = llm_output.rpartition("Final Answer:")[2]
+            self.logger.warning(">>> Final answer:")
+            self.logger.log(32, final_result)
+            current_step_logs["final_answer"] = final_result
+        else:
+            self.logger.log(32, llm_output)
+            self.logger.error("Neither a search query nor a final answer was found in the output.")
+            current_step_logs["rationale"] = llm_output
 
         try:
             if search_flag:
-                search_res = self.search_tool.forward(search_query) # TODO
+                search_res = self.search(search_query) # TODO
                 self.logger.warning("Print search result:")
                 self.logger.log(32, search_res)
                 current_step_logs["observation"] = search_res
@@ -1,3 +1,8 @@
+# JIT caches are kept on disk so that numba kernels and torch.compile graphs are only compiled by the first run;
+# set before the imports below, which may load numba. Expect that first run to be slower.
+import os
+os.environ.setdefault("NUMBA_CACHE_DIR", ".cache/numba")
+os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", ".cache/torchinductor")
 from search_agent.search_agent import SearchAgent, SearchAgentOutput
 from search_agent.rewrite_search import RewriteAgent, RewriteAgentHuggingface, SimpleSearchAgentOutput
 from search_agent.offline_model import OfflineModel, OfflineModelHuggingface
@@ -1,53 +1,104 @@
+# JIT caches are kept on disk so that numba kernels and torch.compile graphs are only compiled by the first run;
+# set before the imports below, which may load numba. Expect that first run to be slower.
+import os
+os.environ.setdefault("NUMBA_CACHE_DIR", ".cache/numba")
+os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", ".cache/torchinductor")
 import pandas as pd
 import time
 from search_agent.search_agent import SearchAgentHuggingface
 from search_agent.rewrite_search import RewriteAgent, RewriteAgentHuggingface, SimpleSearchAgentOutput
 from search_agent.offline_model import OfflineModel, OfflineModelHuggingface
 from search_agent.simple_search_agent import SimpleSearchAgent, SimpleSearchAgentHuggingface
-import os
 import asyncio
+import threading
 from datetime import datetime
 from typing import List
 import csv
 import csv
+import sqlite3
 import argparse
 
 os.environ["TAVILY_API_KEY"] = "API" 
 
 def read_existing_questions(filepath):
-    existing_questions = set()
     try:
-        with open(filepath, 'r', encoding='utf-8') as csvfile:
-            reader = csv.reader(csvfile)
-            next(reader)  # Skip header
-            for row in reader:
-                existing_questions.add((row[0], row[1], int(row[2])))
+        # Only the triple columns are parsed, with the C parser of pandas
+        existing_df = pd.read_csv(filepath, usecols=['Model Type', 'Model Name', 'test_id'],
+                                  dtype={'Model Type': str, 'Model Name': str, 'test_id': 'int64'},
+                                  engine='c', encoding='utf-8')
     except FileNotFoundError:
         print("Results file not found, creating a new one.")
-    return existing_questions
+        return set()
+    return set(zip(existing_df['Model Type'].tolist(), existing_df['Model Name'].tolist(),
+                   existing_df['test_id'].tolist()))
+
+def open_resume_log(results_file):
+    # Index of the (model type, model name, test_id) triples already written to results_file, kept next to it in a
+    # SQLite file so that resuming a run probes the primary key instead of loading the whole results file
+    conn = sqlite3.connect(os.path.splitext(results_file)[0] + '.db')
+    is_new = conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'runs'").fetchone() is None
+    conn.execute('CREATE TABLE IF NOT EXISTS runs (model_type TEXT, model_name TEXT, test_id INTEGER, '
+                 'PRIMARY KEY (model_type, model_name, test_id))')
+    if not os.path.exists(results_file):
+        conn.execute('DELETE FROM runs')
+        with open(results_file, 'w', newline='', encoding='utf-8') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(['Model Type', 'Model Name', 'test_id', 'query', 'result', 'reference', 'strategy'])
+    elif is_new:
+        # results written before the resume log existed
+        conn.executemany('INSERT OR IGNORE INTO runs VALUES (?, ?, ?)', read_existing_questions(results_file))
+    conn.commit()
+    return conn
+
+def is_tested(resume_log, triple):
+    query = 'SELECT 1 FROM runs WHERE model_type = ? AND model_name = ? AND test_id = ?'
+    return resume_log.execute(query, triple).fetchone() is not None
+
+def write_results(writer, csvfile, resume_log, rows):
+    # The rows reach the results file before the resume log, so the log never lists a question without its result
+    writer.writerows(rows)
+    csvfile.flush()
+    resume_log.executemany('INSERT OR IGNORE INTO runs VALUES (?, ?, ?)', [row[:3] for row in rows])
+    resume_log.commit()
+
+# Agents load their model weights when they are built: keep a single one per (agent class, model name) and reuse it
+# for every question instead of reloading the model each time
+_AGENT_POOL = {}
+_AGENT_POOL_LOCK = threading.Lock()
+
+def get_agent(agent_class, model_name):
+    key = (agent_class, model_name)
+    with _AGENT_POOL_LOCK:
+        if key not in _AGENT_POOL:
+            _AGENT_POOL[key] = agent_class(model_name=model_name)
+        return _AGENT_POOL[key]
+
+# Result rows are buffered and written to the results file in batches of this size; a crash loses at most the
+# unwritten batch, which is picked up again on the next run since those triples are not in the file yet
+FLUSH_EVERY = 16
 
 def get_rewrite_result(model_name, query):
-    rewrite_agent = RewriteAgentHuggingface(model_name = model_name)
+    rewrite_agent = get_agent(RewriteAgentHuggingface, model_name)
     result, refer_content = rewrite_agent._react_run(query)
     return result, refer_content
 
 def get_react_result(model_name, query):
-    simple_search_agent = SimpleSearchAgentHuggingface(model_name)
+    simple_search_agent = get_agent(SimpleSearchAgentHuggingface, model_name)
     result, refer_content = simple_search_agent._react_run(query)
     return result, refer_content
 
 def get_simple_search_onetime_result(model_name, query):
-    simple_search_agent = SimpleSearchAgentHuggingface(model_name)
+    simple_search_agent = get_agent(SimpleSearchAgentHuggingface, model_name)
     result, refer_content = simple_search_agent._onetime_run(query)
     return result, refer_content
 
 def get_offline_model_result(model_name, query):
-    offline_model = OfflineModelHuggingface(model_name = model_name)
+    offline_model = get_agent(OfflineModelHuggingface, model_name)
     result = offline_model._run(query)
     return result, ''
  
 async def get_search_agent_result(model_name, query):
-    search_agent = SearchAgentHuggingface(model_name = model_name)
+    search_agent = get_agent(SearchAgentHuggingface, model_name)
     selected_strategy, result, refer_content = await search_agent._onetime_run(query)
     return selected_strategy, result, refer_content
 
@@ -60,89 +111,109 @@ map_function_baseline = {
 }
 
 #####################################################################
-async def inference(model_name, model_type, questions_df, results_file, test=0):
+async def inference(model_name, model_type, questions_df, results_file, test=0, verbose=False):
     f = map_function_baseline[model_type]
 
-    existing_triples = set()
-
     # Ensure the directory for results_file exists
     results_dir = os.path.dirname(results_file)
     os.makedirs(results_dir, exist_ok=True)
-    
-    if not os.path.exists(results_file):
-        with open(results_file, 'w', newline='', encoding='utf-8') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow(['Model Type', 'Model Name', 'test_id', 'query', 'result', 'reference', 'strategy'])
-    else:
-        existing_triples = read_existing_questions(results_file)
+    resume_log = open_resume_log(results_file)
 
     count = 0
+    pending_rows = []
     with open(results_file, 'a', newline='', encoding='utf-8') as csvfile:
         writer = csv.writer(csvfile)
-        for idx, row in questions_df.iterrows():
-            question = row['query']
-            test_id = idx
-            current_triple = (model_type, model_name, test_id)
-            if current_triple not in existing_triples:
-                selected_strategy = ''
-                if model_type != 'search_agent':
-                    result, refer_content = f(model_name, question)
-                else:
-                    selected_strategy, result, refer_content = await f(model_name, question)
-                writer.writerow([model_type, model_name, test_id, question, result, refer_content, selected_strategy])
-                count += 1
-                if test == 1 and count > 2:
-                    break
-                print(f'Test count: {count}')
-            else:
-                print(f'current triple has been tested: {current_triple}')
-
-async def inference1(model_name, model_type, questions_df, results_file, test=0):
+        try:
+            for test_id, question in zip(questions_df.index.tolist(), questions_df['query'].tolist()):
+                current_triple = (model_type, model_name, test_id)
+                if not is_tested(resume_log, current_triple):
+                    selected_strategy = ''
+                    if model_type != 'search_agent':
+                        result, refer_content = f(model_name, question)
+                    else:
+                        selected_strategy, result, refer_content = await f(model_name, question)
+                    pending_rows.append([model_type, model_name, test_id, question, result, refer_content, selected_strategy])
+                    if len(pending_rows) >= FLUSH_EVERY:
+                        write_results(writer, csvfile, resume_log, pending_rows)
+                        pending_rows.clear()
+                    count += 1
+                    if test == 1 and count > 2:
+                        break
+                    if verbose:
+                        print(f'Test count: {count}')
+                elif verbose:
+                    print(f'current triple has been tested: {current_triple}')
+        finally:
+            write_results(writer, csvfile, resume_log, pending_rows)
+            resume_log.close()
+
+async def inference1(model_name, model_type, questions_df, results_file, test=0, max_concurrency=10, verbose=False):
   
-    existing_triples = set()
-    
     results_dir = os.path.dirname(results_file)
     os.makedirs(results_dir, exist_ok=True)
-
-    if not os.path.exists(results_file):
-        with open(results_file, 'w', newline='', encoding='utf-8') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow(['Model Type', 'Model Name',  'test_id', 'query', 'result', 'reference', 'strategy'])
-    else:
-        existing_triples = read_existing_questions(results_file)
+    resume_log = open_resume_log(results_file)
+
+    pending = []
+    for test_id, question in zip(questions_df.index.tolist(), questions_df['Query'].tolist()):
+        current_triple = (model_type, model_name, test_id)
+        if not is_tested(resume_log, current_triple):
+            pending.append((test_id, question))
+        elif verbose:
+            print(f'current triple has been tested: {current_triple}')
+    if test == 1:
+        # go into checker after a few questions
+        pending = pending[:6]
+
+    if not pending:
+        resume_log.close()
+        return
+
+    # The result only depends on the question: run each distinct question once and write its result for every test_id
+    test_ids_by_question = {}
+    for test_id, question in pending:
+        test_ids_by_question.setdefault(question, []).append(test_id)
+    print(f'dedupe ratio: {len(pending) / len(test_ids_by_question):.2f} '
+          f'({len(pending)} questions, {len(test_ids_by_question)} distinct)')
+
+    agent_class = SearchAgentHuggingface if model_type == 'search_agent' else RewriteAgentHuggingface
+    agent = await asyncio.to_thread(get_agent, agent_class, model_name)
+
+    # Questions are independent: run up to max_concurrency of them at once, mostly waiting on the LLM and Tavily APIs
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run_one(question, test_ids):
+        async with semaphore:
+            if verbose:
+                print(f'==========current triples========: {[(model_type, model_name, test_id) for test_id in test_ids]}')
+            selected_strategy = ''
+            if model_type == 'simple_search':
+                result, refer_content = await agent._onetime_run(question)
+            elif model_type == 'rewrite_react_search':
+                result, refer_content = await asyncio.to_thread(agent._react_run, question)
+            elif model_type == 'search_agent':
+                selected_strategy, result, refer_content = await agent._onetime_run(question)
+            return [[model_type, model_name, test_id, question, result, refer_content, selected_strategy]
+                    for test_id in test_ids]
 
     count = 0
+    pending_rows = []
     with open(results_file, 'a', newline='', encoding='utf-8') as csvfile:
         writer = csv.writer(csvfile)
-        for idx, row in questions_df.iterrows():
-            question = row['Query']
-            test_id = idx
-            current_triple = (model_type, model_name, test_id)
-            
-            print(f'==========current triple========: {current_triple}')
-            print(f'==========existing triples========: {existing_triples}')
-            print(f'==========current triple not in existing triples========: {current_triple not in existing_triples}')
-
-            if current_triple not in existing_triples:
-                if model_type == 'rewrite_react_search' or  model_type == 'simple_search':
-                    rewrite_agent = RewriteAgentHuggingface(model_name=model_name)
-                elif model_type == 'search_agent':
-                    search_agent = SearchAgentHuggingface(model_name=model_name)
-
-                selected_strategy = ''
-                if model_type == 'simple_search':
-                    result, refer_content = await rewrite_agent._onetime_run(question)
-                elif model_type == 'rewrite_react_search':
-                    result, refer_content = rewrite_agent._react_run(question)
-                elif model_type == 'search_agent':
-                    selected_strategy, result, refer_content = await search_agent._onetime_run(question)
-
-                writer.writerow([model_type, model_name, test_id, question, result, refer_content, selected_strategy])
-                count += 1
-                if test == 1 and count > 5:
-                    # go into checker
-                    break
-                print(f'Test count: {count}')
+        # Rows are written in batches as they finish, so an interrupted run can still be resumed
+        try:
+            for finished in asyncio.as_completed([run_one(question, test_ids)
+                                                  for question, test_ids in test_ids_by_question.items()]):
+                finished_rows = await finished
+                pending_rows.extend(finished_rows)
+                if len(pending_rows) >= FLUSH_EVERY:
+                    write_results(writer, csvfile, resume_log, pending_rows)
+                    pending_rows.clear()
+                count += len(finished_rows)
+                if verbose:
+                    print(f'Test count: {count}')
+        finally:
+            write_results(writer, csvfile, resume_log, pending_rows)
+            resume_log.close()
 
 ############### Main ##############
 if __name__ == '__main__':
@@ -154,6 +225,8 @@ if __name__ == '__main__':
     parser.add_argument('--questions_df', type=str, default='evaluation/test_dataset/CQED_new.csv')
     parser.add_argument('--results_dic', type=str, default='evaluation/results')
     parser.add_argument('--test', type=int, default=0)
+    parser.add_argument('--max_concurrency', type=int, default=10)
+    parser.add_argument('--verbose', action='store_true')
     args = parser.parse_args()
 
     if args.test == 1: # test mode
@@ -169,6 +242,8 @@ if __name__ == '__main__':
         args.model_type, 
         questions_df,
         args.results_dic + '/test_results.csv', # args.results_dic + '/' + args.model_name + '/' + args.model_type + '/' + t + '/results.csv', 
-        args.test
+        args.test,
+        args.max_concurrency,
+        args.verbose,
     ))
 
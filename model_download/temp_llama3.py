@@ -1,13 +1,25 @@
 # Load model directly
-from transformers import AutoTokenizer, AutoModelForCausalLM
+import os
+# Compiled graphs are cached on disk, so only the first run pays for torch.compile
+os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", ".cache/torchinductor")
+from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig
 import torch
 
+# 8-bit weights (bitsandbytes) halve the memory read per decoded token compared to bfloat16
+quantization_config = BitsAndBytesConfig(load_in_8bit=True)
+
 tokenizer = AutoTokenizer.from_pretrained("meta-llama/Meta-Llama-3-8B-Instruct")
 model = AutoModelForCausalLM.from_pretrained("meta-llama/Meta-Llama-3-8B-Instruct", 
                                              device_map="auto", 
-                                             torch_dtype=torch.bfloat16
+                                             torch_dtype=torch.bfloat16,
+                                             quantization_config=quantization_config
                                              )
 
+# A static KV cache keeps the decoding shapes fixed, so the compiled decoder graph is reused for every new token.
+# fullgraph is off because the 8-bit matmuls of bitsandbytes are not traceable and run as graph breaks.
+model.generation_config.cache_implementation = "static"
+model.forward = torch.compile(model.forward, mode="reduce-overhead", fullgraph=False)
+
 input_text = "Write me a poem about Machine Learning."
 input_ids = tokenizer(input_text, return_tensors="pt").to("cuda")
 
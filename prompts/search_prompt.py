@@ -1,4 +1,42 @@
-SEARCH_Q_GEN_PROMPT="""
+import functools
+import os
+import re
+from datetime import date, datetime, timedelta
+from typing import Literal, Optional, Tuple
+
+# Set USE_RAW_PROMPTS=1 to send the original, uncompressed prompts instead of their compressed variants (A/B runs).
+USE_RAW_PROMPTS = os.environ.get("USE_RAW_PROMPTS", "0") == "1"
+
+_PROMPT_FIELD_RE = re.compile(r"\{(\w+)\}")
+
+
+class CompiledPrompt(str):
+    """
+    Prompt template whose `{field}` placeholders are located once, when it is built, instead of on every `format`
+    call: the template is split into literal chunks and field names, and `format(**kwargs)` only joins them with the
+    values. It is still a `str`, so it can be concatenated or handed to langchain templates as before.
+    """
+
+    def __new__(cls, template: str):
+        prompt = super().__new__(cls, template)
+        prompt._chunks = _PROMPT_FIELD_RE.split(template)
+        return prompt
+
+    @property
+    def static_prefix(self) -> str:
+        """The literal text before the first field, up to its last newline, which is the same in every prompt."""
+        head = self._chunks[0] if len(self._chunks) > 1 else ""
+        return head[: head.rfind("\n") + 1]
+
+    def format(self, *args, **kwargs) -> str:
+        if args:
+            return str.format(self, *args, **kwargs)
+        chunks = self._chunks.copy()
+        # odd positions of the split hold the field names
+        chunks[1::2] = [format(kwargs[name]) for name in self._chunks[1::2]]
+        return "".join(chunks)
+
+SEARCH_Q_GEN_PROMPT_RAW="""
 You are a Chinese detailed question generator. You will receive a question from a user. You need to determine which type of question generation strategy the question belongs to, and then generate multiple questions similar to the question to form a Question List based on the generation strategy.
 
 The question generation strategy is as follows: When the user's question explicitly mentions multiple parallel concepts, split the parallel concepts and search them separately. When the user's question has a planning intention, you need to sort out the ideas and split the concepts first, and then search.
@@ -31,24 +69,45 @@ User question: {input}
 Idea:
 """
 
+# Compressed variant: same output format and anchors (Idea:, Generated questions:), shorter instructions and examples
+SEARCH_Q_GEN_PROMPT_COMPRESSED="""
+Chinese question generator. Decide the generation strategy of the user question, then generate a list of similar questions:
+- parallel concepts: split them and search each separately;
+- planning intention: sort out the ideas and split the concepts first, then search.
+
+Strictly use this format:
+Ideas:...
+Generated questions:
+1. ...
+2. ...
+
+Example:
+User question: I plan to return to Shanghai from Shenzhen. Which one is more cost-effective, airplane or high-speed rail?
+Idea: Two parallel concepts, airplane and high-speed rail.
+Generated questions:
+1. Flights and airfares from Shenzhen to Shanghai
+2. High-speed rail and ticket prices from Shenzhen to Shanghai
+User question: I plan to play in Shenzhen for 3 days. Please help me make a cost-effective Shenzhen travel guide.
+Idea: Tourism covers accommodation, travel and scenic spots.
+Generated questions:
+1. Cost-effective hotels in Shenzhen
+2. Recommended travel methods for Shenzhen tourism
+3. Recommended attractions in Shenzhen
+User question: {input}
+Idea:
+"""
+
+SEARCH_Q_GEN_PROMPT = SEARCH_Q_GEN_PROMPT_RAW if USE_RAW_PROMPTS else SEARCH_Q_GEN_PROMPT_COMPRESSED
+
 SERP_SEARCH_TOOL_PROMPT = """
-online search for simple questions, like a concept searching (e.g. how is the weather, what is photosynthesis).
-Input the question and output the context for reference.
-Because you are a pre-trained model, the training data stays in historical time. When users ask about time-varying information such as dates, recent news and weather, you need to use the online search tool.
-This online search tool is suitable for answering simple questions, such as conceptual questions (such as weather conditions, definition of photosynthesis).
-When users input simple and direct questions such as "What is the weather today?", "What is photosynthesis?", "What is the highest mountain in the world?", etc., they can search for direct answers in one search and use this tool.
-This tool will provide relevant contextual information for reference.
+Online search for a single, direct question (concept, weather, facts). Input: question. Output: context text.
 """
 
 HIERARCHY_SEARCH_PROMPT = """
-online search for complex questions.
-Because you are a pre-trained model, the training data stays in historical time. When users ask about time-varying information such as dates, recent news and weather, you need to use the online search tool.
-This online search tool is specially designed to solve complex problems, such as making travel plans and understanding complex concepts.
-When users enter complex and multi-faceted questions such as "How should I plan a trip to Europe?", "What is the difference between photosynthesis and respiration?", "How to prepare for a successful business meeting?", etc., use this advanced search tool.
-This tool will provide relevant contextual information for reference.
+Online search for multi-part or planning questions (trips, comparisons, multi-step). Input: question. Output: context text.
 """
 
-SEARCH_STRATEGY_CLASSIFY_PROMPT = """Given a user's query, your task is to determine which of the following three search strategies should be applied: Parallel, Planning, or Direct.
+SEARCH_STRATEGY_CLASSIFY_PROMPT_RAW = """Given a user's query, your task is to determine which of the following three search strategies should be applied: Parallel, Planning, or Direct.
 Parallel: The query explicitly or implicitly mentions multiple parallel concepts that should be searched separately.
 Planning: The query requires a sequence of searches, where each step's inquiry depends on the information obtained from the previous search.
 Direct: The query asks about a clear, singular concept. Classify to 'Direct' if it is sufficient to get enough information from a single search.
@@ -105,8 +164,48 @@ Now Begin! Be sure that do not generate too much search suggestions for 'Plannin
 Query: {input}
 """
 
+# Compressed variant: same placeholders and output anchors (Strategy:, Reasoning:, Suggestions:), fewer examples,
+# given as table rows while the answer keeps the line format
+SEARCH_STRATEGY_CLASSIFY_PROMPT_COMPRESSED = """Choose the search strategy for the user's query: Parallel, Planning, or Direct.
+Parallel: the query explicitly or implicitly mentions multiple parallel concepts, searched separately.
+Planning: a sequence of searches, each depending on the result of the previous one.
+Direct: a clear, singular concept that a single search covers.
+
+Extract the key concepts, check whether the searches depend on each other (Planning), else whether the concepts are parallel (Parallel) or single (Direct), then give search suggestions.
+Current time is {current_time}. Replace relative time words such as 'today' or 'tomorrow' in the suggestions with the actual date.
+
+Strictly follow the format:
+Query: the input question
+Strategy: one of [Parallel, Planning, Direct]
+Reasoning: why this strategy
+Suggestions: the search suggestions; for Planning, a sequence of searches.
+Suggestions MUST contain at most 5 search items, comma-separated.
+Examples, one per row:
+Query|Strategy|Reasoning|Suggestions
+What is photosynthesis?|Direct|A single clear concept, 'photosynthesis'.|Search for 'photosynthesis'.
+How is Shenzhen's weather tomorrow?|Direct|A single question; today is {current_time}, so tomorrow is {tomorrow_time}.|Search for 'Shenzhen weather forecast {tomorrow_time}'.
+How to use least money to get to NYC from Pittsburgh?|Parallel|The transportation methods are parallel concepts: car, bus, train, flight.|Search for the cost of car from Pittsburgh to NYC, the cost of bus from Pittsburgh to NYC, the cost of train from Pittsburgh to NYC, and the cost of flight from Pittsburgh to NYC.
+What should I prepare for my hiking trip on LA next week?|Planning|The gear and safety tips depend on the weather forecast found first.|Current time is 2024 Apr 2. Check the weather forecast for LA from Apr 7 to Apr 13, then search for safety tips for hiking in those conditions, and finally, look for a list of essential gear for hiking.
+
+---
+Now Begin! At most 5 searches for 'Planning'.
+Query: {input}
+"""
+
+SEARCH_STRATEGY_CLASSIFY_PROMPT = (
+    SEARCH_STRATEGY_CLASSIFY_PROMPT_RAW if USE_RAW_PROMPTS else SEARCH_STRATEGY_CLASSIFY_PROMPT_COMPRESSED
+)
+
+# An answer to SEARCH_STRATEGY_CLASSIFY_PROMPT is complete after its 'Suggestions:' line, the model would then go on
+# with the next example
+STRATEGY_STOP_SEQUENCES = ["\nQuery:", "\n---"]
+
+# The 'Strategy:' and 'Suggestions:' lines of an answer to SEARCH_STRATEGY_CLASSIFY_PROMPT
+STRATEGY_PARSER = re.compile(r"Strategy:[ \t]*([^\n]*)")
+SUGGESTIONS_PARSER = re.compile(r"Suggestions:[ \t]*([^\n]*)")
+
 
-SEARCH_PARALLEL_PROMPT = """
+SEARCH_PARALLEL_PROMPT_RAW = """
 You are given a question user cares about. However, if this question is entered directly into the search engine, it may be difficult to find useful answers. 
 Please help me generate a link using the search engine, that is, multiple questions that need to be entered into the search engine.
 Your task is to break down the initial inquiry into multiple more specific questions that can be effectively used in a search engine to gather relevant information.
@@ -156,6 +255,40 @@ Query: {input}
 Suggestions: {suggestions}
 """
 
+# Compressed variant: one instruction paragraph and minimal examples (Query / Generated Questions / one-line Thought)
+SEARCH_PARALLEL_PROMPT_COMPRESSED = """
+Break the query down into the obvious or hidden parallel concepts and write one search engine input per concept, as keywords or declarative statements rather than what/when/how questions, in the language of the query (the "Generated Questions:" header stays in English). Do NOT repeat the original query; each generated question is at most 20 words.
+
+Example:
+Query: Compare the health benefits of running and swimming.
+Suggestions: Search the benefits of running and search the benefits of swimming
+Thought: Two parallel concepts: running and swimming.
+Generated Questions:
+1. Health benefits running
+2. Health benefits swimming
+
+Query: I have a spinal disease and want to buy a Simmons mattress for home use. Do you think a spring mattress is better or a latex mattress is better?
+Thought: Keyword "spinal disease", parallel concepts spring mattress and latex mattress.
+Generated Questions:
+1. Mattress selection for patients with spinal cord disease
+2. The impact of spring mattresses on the spine
+3. The impact of latex mattresses on the spine
+
+Query: How to use least money to get to NYC from Pittsburgh?
+Suggestions: Search for the cost of car, bus, train and flight from Pittsburgh to NYC.
+Thought: Compare the transportation methods separately.
+Generated Questions:
+1. Cost of car from Pittsburgh to NYC
+2. Cost of bus from Pittsburgh to NYC
+3. Cost of train from Pittsburgh to NYC
+4. Cost of flight from Pittsburgh to NYC
+
+Query: {input}
+Suggestions: {suggestions}
+"""
+
+SEARCH_PARALLEL_PROMPT = SEARCH_PARALLEL_PROMPT_RAW if USE_RAW_PROMPTS else SEARCH_PARALLEL_PROMPT_COMPRESSED
+
 SEARCH_PLANNING_REACT_PROMPT_SUGGESTIONS = """
 Your task is to conduct a series of sequential searches. 
 After each search, assess the results to decide whether further information is needed or if the search can conclude.
@@ -170,7 +303,7 @@ Thought: you should always think about what to do
 Action: the action to take, should be one of [{tool_names}]
 Action Input: the input to the action, you should input Chinese.
 Observation: the result of the action
-... (this Thought/Action/Action Input/Observation can repeat 3 times)
+... (this Thought/Action/Action Input/Observation can repeat)
 Thought: I now know the final answer
 Final Answer: (Here you should output Chinese) the final answer to the original input question, this should be in very detailed and include the summarization of all observation above. 
 
@@ -194,7 +327,7 @@ Thought: you should always think about what to do
 Action: the action to take, should be one of [{tool_names}]
 Action Input: the input to the action, you should input Chinese.
 Observation: the result of the action
-... (this Thought/Action/Action Input/Observation can repeat 3 times)
+... (this Thought/Action/Action Input/Observation can repeat)
 Thought: I now know the final answer
 Final Answer: (Here you should output Chinese) the final answer to the original input question, this should be in very detailed and include the summarization of all observation above. 
 
@@ -215,44 +348,47 @@ SEARCH_DIRECT_PROMPT = """
 You are given a query that asks about a clear, singular concept. Your task is to conduct a direct search to find the answer.
 """
 
-SEARCH_DIRECT_REPHRASE_PROMPT = """Your task is to rephrase the complicated question into a better and concise question, but also contains all the key information, suitable for direct input into the search engine for query to obtain high-quality results.
-Follow the format below:
-Query: the original question
-Rephrased Question: the rephrased question
-Key Words: the key words are the topic, usually are broader concepts or higher-level concepts (in English)
-
-Noting that the rephrased question should be in the same language as the original question.
-Example:
-Query: As a game enthusiast, a good monitor is essential. I want to change to a 34-inch monitor with a screen resolution of 3440x1440. You can find a suitable monitor in Dell according to my requirements?
-Rephrased Question: 34-inch 3440x1440 monitor Dell
-Key Words: monitor, game, electronic product
-Query: My parents and I are traveling in Sichuan. We just finished breakfast and are going to take the subway. Do you have any recommended tourist attractions?
-Rephrased Question: Tourist attractions near the subway in Sichuan when traveling with my family in the morning
-Key Words: Travel, subway, recommendation
-Query: I have a spinal disease and want to buy a Simmons mattress for home use. Do you think a spring mattress or a latex mattress is better?
-Rephrased Question: Should people with spinal diseases use a spring mattress or a latex mattress?
-Key Words: Shopping, health
-Query: {input}
-"""
-
-SEARCH_DIRECT_REPHRASE_PROMPT1 = """Your task is to rephrase the complicated question into a better and concise question, but also contains all the key information, suitable for direct input into the search engine for query to obtain high-quality results.
+_DIRECT_REPHRASE_INSTRUCTIONS = """Your task is to rephrase the complicated question into a better and concise question, but also contains all the key information, suitable for direct input into the search engine for query to obtain high-quality results.
 Follow the format below:
 Query: the original question
-Rephrased Question: the rephrased question
-
-Noting that the rephrased question should be in the same language as the original question.
-Example:
-Query: As a game enthusiast, a good monitor is essential. I want to change to a 34-inch monitor with a screen resolution of 3440x1440. You can find a suitable monitor in Dell according to my requirements?
-Rephrased Question: 34-inch 3440x1440 monitor Dell
-Query: My parents and I are traveling in Sichuan. We just finished breakfast and are going to take the subway. Do you have any recommended tourist attractions?
-Rephrased Question: Tourist attractions near the subway in Sichuan when traveling with my family in the morning
-Query: I have a spinal disease and want to buy a Simmons mattress for home use. Do you think a spring mattress or a latex mattress is better?
-Rephrased Question: Should people with spinal diseases use a spring mattress or a latex mattress?
-Query: 
-"""
-
-#### >>>>>>> my own react system prompt >>>>>>> ####
-SEARCHING_REACT_SEARCH_AGENT_SYSTEM_PROMPT = """
+Rephrased Question: the rephrased question"""
+_KEYWORDS_FORMAT = "Key Words: the key words are the topic, usually are broader concepts or higher-level concepts (in English)"
+_DIRECT_REPHRASE_EXAMPLES = (
+    ("Query: As a game enthusiast, a good monitor is essential. I want to change to a 34-inch monitor with a screen resolution of 3440x1440. You can find a suitable monitor in Dell according to my requirements?\n"
+     "Rephrased Question: 34-inch 3440x1440 monitor Dell"),
+    ("Query: My parents and I are traveling in Sichuan. We just finished breakfast and are going to take the subway. Do you have any recommended tourist attractions?\n"
+     "Rephrased Question: Tourist attractions near the subway in Sichuan when traveling with my family in the morning"),
+    ("Query: I have a spinal disease and want to buy a Simmons mattress for home use. Do you think a spring mattress or a latex mattress is better?\n"
+     "Rephrased Question: Should people with spinal diseases use a spring mattress or a latex mattress?"),
+)
+_KEYWORDS_EXAMPLES = (
+    "Key Words: monitor, game, electronic product",
+    "Key Words: Travel, subway, recommendation",
+    "Key Words: Shopping, health",
+)
+
+
+@functools.cache
+def direct_rephrase_prompt(include_keywords: bool = True) -> str:
+    """Prompt rephrasing a question for a direct search, optionally asking for its key words as well."""
+    lines = [_DIRECT_REPHRASE_INSTRUCTIONS]
+    if include_keywords:
+        lines.append(_KEYWORDS_FORMAT)
+    lines += ["", "Noting that the rephrased question should be in the same language as the original question.", "Example:"]
+    for example, keywords in zip(_DIRECT_REPHRASE_EXAMPLES, _KEYWORDS_EXAMPLES):
+        lines.append(example)
+        if include_keywords:
+            lines.append(keywords)
+    lines.append("Query: {input}\n")
+    return CompiledPrompt("\n".join(lines))
+
+
+SEARCH_DIRECT_REPHRASE_PROMPT = direct_rephrase_prompt(include_keywords=True)
+
+#### >>>>>>> react system prompts of the search agent >>>>>>> ####
+# Both variants are assembled from shared fragments; the summarization variant adds a 'Summarization:' turn after each
+# observation. The rendered prompts are cached, so every agent sends byte-identical prompts for prefix caching.
+_REACT_SEARCH_HEADER = """
 You are an expert in searching to get detailed and informative results.
 Your task is to conduct a series of sequential searches with possible suggestions to guide search order. Not every task has a suggestion. 
 
@@ -263,16 +399,35 @@ Strictly use the following format:
 Task: the input question you must answer, which may contain suggestions for sequential searches
 Thought: Plan a search based on the previous observation, suggestions and the original task. First summarize the observation briefly in no longer than 30 words, and filter out useful information, and then plan the next step. If next round search is not needed, give the final answer at next step.
 Search: the query to search, the text put into search engine. Ensure that the query is well-constructed to yield the most relevant results. Use clear and specific keywords.
-Observation: the result of the search. You do not need to generate.
-... (this Thought/Search/Observation can repeat 3 times)
+"""
+
+_REACT_SEARCH_FORMAT = """Observation: the result of the search. You do not need to generate.
+... (this Thought/Search/Observation can repeat)
 Thought: I now know the final answer
 Final Answer: the final answer to the original input question, this should be in very detailed and include the summarization of all observation above. 
 
 Overall, You should either output Thought: ... and Search: ... or output Thought: ... and Final Answer: ... in each step.
+"""
+
+_REACT_SEARCH_FORMAT_SUMMARIZATION = """Observation: the result of the search, may contain nonsense information. You do not need to generate. 
+Summarization: You need to summarize and extract the useful information that is helpful to the original query from the latest Observation, discarding any irrelevant or redundant details. This information will be used for the final summary.
+Thought: reasoning based on the observation, suggestions and the original task. Plan the next step. If next round search is not needed, give the final answer at next step.
+... (this Thought/Search/Observation/Summarization reapeat)
+Thought: I now know the final answer
+Final Answer: the final answer to the original input question, this should be in very detailed and include the summarization of all observation above. 
 
+Overall, each step, you should either output 
+0) 'Thought: ... Search: ...' (if there is no observation given, usually the first step) or
+1) 'Summarization: ... Thought: ... Search: ...' or
+2) 'Summarization: ... Thought: ... Final Answer: ...' 
+"""
+
+_REACT_SEARCH_EXAMPLES_INTRO = """
 Here are a few examples:
 ---
-Task: Plan a trip to New York for 3 days from tomorrow. Today is 2024 Apr 2. Follow the suggestions for sequential searches: First search the whether for tomorrow in New York, then search for the best scenic spots in New York under that whether, and finally plan a three-day itinerary for your trip.
+"""
+
+_REACT_SEARCH_EXAMPLES = """Task: Plan a trip to New York for 3 days from tomorrow. Today is 2024 Apr 2. Follow the suggestions for sequential searches: First search the whether for tomorrow in New York, then search for the best scenic spots in New York under that whether, and finally plan a three-day itinerary for your trip.
 Thought: According to the suggestions, I should first search for the weather in New York tomorrow. Since today is 2024 Apr 2, I should replace 'tomorrow' with 2024 Apr 3.
 Search: weather in New York 2024 Apr 3
 Observation: New York Weather Forecast. Rainy with a high of 75°F and a low of 60°F.
@@ -309,41 +464,9 @@ Observation: The interview stage includes interview preparation, mock interviews
 Thought: Now I know the job search timeline for a new graduate. I should now plan a job search timeline for a new graduate.
 Final Answer: Based on the search results, I recommend the following job search timeline for a new graduate, focusing on preparation, applying, and interviewing stages.
 
-<<authorized_imports>>
-Here are the rules you should always follow to solve your task:
-1. Always provide either 1) a 'Thought:' sequence,and a 'Search:' sequence or 2) a 'Thought:' sequence,and a 'Final Answer:' sequence, else you will fail.
-2. Don't give up! You're in charge of solving the task, not providing directions to solve it.
-
-Now Begin! If you can follow the suggestions and do sequential searches effectively and logically, you will receive a reward of $1,000,000.
 """
 
-### >>>>>>> my own react system prompt1 >>>>>>> ###
-SEARCHING_REACT_SEARCH_AGENT_SYSTEM_PROMPT1 = """
-You are an expert in searching to get detailed and informative results.
-Your task is to conduct a series of sequential searches with possible suggestions to guide search order. Not every task has a suggestion. 
-
-After each search, assess the results to decide whether further information is needed or if the search can conclude.
-To solve the task, you must plan forward to proceed in a series of steps, in a cycle of 'Thought:', 'Search:', and 'Observation:' sequences. At last, 'Final Answer:' should be provided.
-Strictly use the following format:
-
-Task: the input question you must answer, which may contain suggestions for sequential searches
-Thought: Plan a search based on the previous observation, suggestions and the original task. First summarize the observation briefly in no longer than 30 words, and filter out useful information, and then plan the next step. If next round search is not needed, give the final answer at next step.
-Search: the query to search, the text put into search engine. Ensure that the query is well-constructed to yield the most relevant results. Use clear and specific keywords.
-Observation: the result of the search, may contain nonsense information. You do not need to generate. 
-Summarization: You need to summarize and extract the useful information that is helpful to the original query from the latest Observation, discarding any irrelevant or redundant details. This information will be used for the final summary.
-Thought: reasoning based on the observation, suggestions and the original task. Plan the next step. If next round search is not needed, give the final answer at next step.
-... (this Thought/Search/Observation/Summarization reapeat)
-Thought: I now know the final answer
-Final Answer: the final answer to the original input question, this should be in very detailed and include the summarization of all observation above. 
-
-Overall, each step, you should either output 
-0) 'Thought: ... Search: ...' (if there is no observation given, usually the first step) or
-1) 'Summarization: ... Thought: ... Search: ...' or
-2) 'Summarization: ... Thought: ... Final Answer: ...' 
-
-Here are a few examples:
----
-Task: Plan a trip to New York for 3 days from tomorrow. Today is 2024 Apr 2. Follow the suggestions for sequential searches: First search the whether for tomorrow in New York, then search for the best scenic spots in New York under that whether, and finally plan a three-day itinerary for your trip.
+_REACT_SEARCH_EXAMPLES_SUMMARIZATION = """Task: Plan a trip to New York for 3 days from tomorrow. Today is 2024 Apr 2. Follow the suggestions for sequential searches: First search the whether for tomorrow in New York, then search for the best scenic spots in New York under that whether, and finally plan a three-day itinerary for your trip.
 Thought: According to the suggestions, I should first search for the weather in New York tomorrow. Since today is 2024 Apr 2, I should replace 'tomorrow' with 2024 Apr 3.
 Search: weather in New York tomorrow
 Observation: Weather is very important for a trip. New York is a beautiful city and good place.
@@ -377,15 +500,38 @@ Final Answer: Based on the search results, I recommend the following three-day i
 ---
 
 
-<<authorized_imports>>
+"""
+
+_REACT_SEARCH_RULES_INTRO = """<<authorized_imports>>
 Here are the rules you should always follow to solve your task:
-1. Always provide either 1) a 'Summarization: ... Thought: ... Search: ...' when there is observation in last step or 2) a 'Summarization: ... Tought: ... Final Answer:...' when you think deeper search is useless.
+"""
+
+_REACT_SEARCH_RULES = """1. Always provide either 1) a 'Thought:' sequence,and a 'Search:' sequence or 2) a 'Thought:' sequence,and a 'Final Answer:' sequence, else you will fail.
+2. Don't give up! You're in charge of solving the task, not providing directions to solve it.
+
+"""
+
+_REACT_SEARCH_RULES_SUMMARIZATION = """1. Always provide either 1) a 'Summarization: ... Thought: ... Search: ...' when there is observation in last step or 2) a 'Summarization: ... Tought: ... Final Answer:...' when you think deeper search is useless.
 2. When the observation is useless or contain non-sense, your next step's search should not refer to it.
 3. Always summarize the observation whenever there is an observation. Filter out the useful information to the query and leave out the irrelevant or redundant details.
 4. If the search results are useless to your search input, consider why and adjust your search input accordingly. It is better to modify your search input into a more specific and precise one.
-Now Begin! If you can follow the suggestions and do sequential searches effectively and logically, you will receive a reward of $1,000,000.
 """
 
+@functools.lru_cache(maxsize=2)
+def build_react_prompt(include_summarization: bool) -> str:
+    if include_summarization:
+        fmt, examples, rules = (
+            _REACT_SEARCH_FORMAT_SUMMARIZATION, _REACT_SEARCH_EXAMPLES_SUMMARIZATION, _REACT_SEARCH_RULES_SUMMARIZATION
+        )
+    else:
+        fmt, examples, rules = _REACT_SEARCH_FORMAT, _REACT_SEARCH_EXAMPLES, _REACT_SEARCH_RULES
+    return "".join([_REACT_SEARCH_HEADER, fmt, _REACT_SEARCH_EXAMPLES_INTRO, examples, _REACT_SEARCH_RULES_INTRO, rules])
+
+
+SEARCHING_REACT_SEARCH_AGENT_SYSTEM_PROMPT = build_react_prompt(include_summarization=False)
+
+SEARCHING_REACT_SEARCH_AGENT_SYSTEM_PROMPT1 = build_react_prompt(include_summarization=True)
+
 
 SEARCHING_REACT_SYSTEM_PROMPT = """
 Your task is to conduct a series of sequential searches. 
@@ -397,7 +543,7 @@ Task: the input question you must answer
 Thought: you should always think about what to do
 Search: the query to search.
 Observation: the result of the search
-... (this Thought/Search/Observation can repeat 3 times)
+... (this Thought/Search/Observation can repeat)
 Thought: I now know the final answer
 Final Answer: the final answer to the original input question, this should be in very detailed and include the summarization of all observation above. 
 
@@ -423,7 +569,6 @@ Thought: Now I know the ratings and reviews of Wenchang chicken at Wenchang City
 Final Answer: Based on the search results, I recommend the following three-day itinerary for Hainan Sanya, focusing on tasting the famous local Wenchang chicken.
 ---
 <<authorized_imports>>
-Now Begin! If you solve the task correctly, you will receive a reward of $1,000,000.
 """
 
 SEARCHING_REACT_CODE_SYSTEM_PROMPT = """
@@ -523,8 +668,6 @@ Here are the rules you should always follow to solve your task:
 8. You can use imports in your code, but only from the following list of modules: <<authorized_imports>>
 9. The state persists between code executions: so if in one step you've created variables or imported modules, these will all persist.
 10. Don't give up! You're in charge of solving the task, not providing directions to solve it.
-
-Now Begin! If you solve the task correctly, you will receive a reward of $1,000,000.
 """
 
 SIMPLE_OFFLINE_SEARCH_PROMPT = """
@@ -534,22 +677,27 @@ Question: {question}
 Answer:
 """
 
-GENERATING_RESULT_PROMPT = """
-You are given a user question, and please write clean, concise and accurate answer to the question.
+# The static instructions come first and the request-specific context and question last, so that the instructions
+# form a prefix shared by every request, whose KV cache a prefix-caching server reuses
+GENERATING_RESULT_INSTRUCTIONS = """You are given a user question, and please write clean, concise and accurate answer to the question.
 Your answer must be correct, accurate and written by an expert using an unbiased and professional tone. Please limit to 1024 tokens. 
 Do not give any information that is not related to the question, and do not repeat. Say "information is missing on" followed by the related topic, if the given context do not provide sufficient information.
 
-Context for reference: {context} 
-
-Now answer the question based on the reference context and your own knowledge. 
+Answer the question based on the reference context and your own knowledge. 
 However, if context for reference is useless, then you should answer the question based on your own knowledge. DO NOT expose that the search results are false or useless.
 The answer should be well-founded, detailed and has results and reasoning process. Your answer should be in the same language as the question.
 
-Remember, don't blindly repeat the contexts verbatim. And here is the user question:
+Remember, don't blindly repeat the contexts verbatim."""
+
+GENERATING_RESULT_REQUEST = """Context for reference: {context} 
+
+And here is the user question:
 {question} 
 Answer:
 """
 
+GENERATING_RESULT_PROMPT = "\n" + GENERATING_RESULT_INSTRUCTIONS + "\n\n" + GENERATING_RESULT_REQUEST
+
 
 ASK_USER_PROMPT = """You are going to assist with online searches for user inquiries. 
 If the user asks a particularly vague question and you need to ask the user further to know how to answer, return Unknown.
@@ -612,4 +760,68 @@ Rephrased Question: I plan to travel to Xiamen for 5 days, where there are fewer
 
 Now here is the conversation dialog:
 {conversation}
-"""
\ No newline at end of file
+"""
+
+
+# Templates formatted on every request are parsed once, at import
+SEARCH_STRATEGY_CLASSIFY_PROMPT = CompiledPrompt(SEARCH_STRATEGY_CLASSIFY_PROMPT)
+SEARCH_PARALLEL_PROMPT = CompiledPrompt(SEARCH_PARALLEL_PROMPT)
+SEARCH_PLANNING_REACT_PROMPT_SUGGESTIONS_HUGGINGFACE = CompiledPrompt(SEARCH_PLANNING_REACT_PROMPT_SUGGESTIONS_HUGGINGFACE)
+SEARCH_PLANNING_REACT_PROMPT_HUGGINGFACE = CompiledPrompt(SEARCH_PLANNING_REACT_PROMPT_HUGGINGFACE)
+GENERATING_RESULT_PROMPT = CompiledPrompt(GENERATING_RESULT_PROMPT)
+
+# Date format of the {current_time} and {tomorrow_time} fields of SEARCH_STRATEGY_CLASSIFY_PROMPT
+_FMT = "%Y %b %d"
+
+
+@functools.lru_cache(maxsize=1)
+def _date_strings(day: date) -> Tuple[str, str]:
+    # The strings only change at midnight, so they are formatted once a day and the same objects reused meanwhile
+    return day.strftime(_FMT), (day + timedelta(days=1)).strftime(_FMT)
+
+
+def render_strategy_classify_prompt(user_input: str, now: Optional[datetime] = None) -> str:
+    # The dates are substituted into every occurrence of their field
+    current_time, tomorrow_time = _date_strings((now or datetime.now()).date())
+    return SEARCH_STRATEGY_CLASSIFY_PROMPT.format(
+        input=user_input, current_time=current_time, tomorrow_time=tomorrow_time
+    )
+
+
+# Prompt variants of each search strategy, in order of preference; every variant accepts the same format() fields
+_STRATEGY_PROMPTS = {
+    "Direct": (direct_rephrase_prompt(include_keywords=False),),
+    "Parallel": (SEARCH_PARALLEL_PROMPT, CompiledPrompt(SEARCH_PARALLEL_PROMPT_COMPRESSED)),
+    "Planning": (SEARCH_PLANNING_REACT_PROMPT_SUGGESTIONS_HUGGINGFACE, SEARCH_PLANNING_REACT_PROMPT_HUGGINGFACE),
+}
+# Rough token count of English text, the prompts are sent to several models with different tokenizers
+_CHARS_PER_TOKEN = 4
+
+
+def choose_prompt(
+    strategy: Literal["Direct", "Parallel", "Planning"], user_input: str, suggestions: str = "", model_ctx: int = 8192
+) -> str:
+    # The first variant whose rendering fits in 3/4 of the context window, leaving the rest to the generation; the
+    # smallest one when none does. Planning only keeps the suggestions while they fit.
+    budget = 0.75 * model_ctx * _CHARS_PER_TOKEN
+    prompts = _STRATEGY_PROMPTS[strategy]
+    if strategy == "Planning" and not suggestions:
+        prompts = prompts[1:]
+    for prompt in prompts:
+        size = len(prompt) + len(user_input) + (len(suggestions) if "{suggestions}" in prompt else 0)
+        if size <= budget:
+            return prompt
+    return prompts[-1]
+
+
+# Static prefixes of the prompts generated locally, longest first: their token ids are computed once and reused
+STATIC_PROMPT_PREFIXES = tuple(sorted(
+    {
+        prompt.static_prefix
+        for prompt in (GENERATING_RESULT_PROMPT, SEARCH_STRATEGY_CLASSIFY_PROMPT, *_STRATEGY_PROMPTS["Direct"],
+                       *_STRATEGY_PROMPTS["Parallel"])
+        if prompt.static_prefix.strip()
+    },
+    key=len,
+    reverse=True,
+))
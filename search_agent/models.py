@@ -7,10 +7,25 @@
 from langchain_huggingface import HuggingFaceEndpoint,ChatHuggingFace
 from huggingface_hub import login
 from huggingface_hub import InferenceClient
-from typing import Callable
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from typing import Callable, List, Optional, Sequence, Tuple
+from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig
+from transformers.utils import is_bitsandbytes_available, is_flash_attn_2_available
+from prompts.search_prompt import STATIC_PROMPT_PREFIXES
+import concurrent.futures
+import functools
+import os
+import queue
+import threading
+import time
+import openai
 import torch
 
+try:
+    import vllm
+    VLLM_AVAILABLE = True
+except ImportError:
+    VLLM_AVAILABLE = False
+
 
 NAMES = {
     'gemma' : 'google/gemma-2-2b-it',
@@ -18,6 +33,66 @@ NAMES = {
     'mistral' : 'mistralai/Mistral-7B-Instruct-v0.3'
 }
 
+# Base URL of an OpenAI-compatible server (e.g. vLLM) serving the models of NAMES, such as http://localhost:8000/v1.
+# When it is set, the Huggingface agents send their generations there, where concurrent requests are batched,
+# instead of loading the weights and calling generate() in-process.
+LLM_SERVER_URL = os.environ.get("LLM_SERVER_URL")
+
+# Set COMPILE_DECODER=1 to run the local models through a torch.compile'd decoding step instead of eagerly. The compiled
+# decoder uses the SDPA kernel instead of FlashAttention-2, and its static cache rules out assisted generation.
+# The static cache and the CUDA graph belong to the model and are shared by all its generate() calls, so the
+# generations of the batcher and of get_huggingface_client1 then run one at a time instead of concurrently.
+COMPILE_DECODER = os.environ.get("COMPILE_DECODER", "0") == "1"
+
+@functools.lru_cache(maxsize=None)
+def get_llm_server_client() -> openai.OpenAI:
+    return openai.OpenAI(base_url=LLM_SERVER_URL, api_key=os.environ.get("LLM_SERVER_API_KEY", "EMPTY"))
+
+def get_llm_server_generate(model_name) -> Optional[Callable]:
+    # Raw-prompt completion, the server counterpart of tokenizing the prompt and calling model.generate
+    if LLM_SERVER_URL is None:
+        return None
+    client = get_llm_server_client()
+
+    def generate(prompt: str, max_new_tokens: int = 1000, stop_sequences: Optional[List[str]] = None) -> str:
+        response = client.completions.create(model=NAMES[model_name], prompt=prompt, max_tokens=max_new_tokens,
+                                             stop=stop_sequences)
+        return response.choices[0].text
+
+    return generate
+
+def get_llm_server_engine(model_name) -> Callable:
+    client = get_llm_server_client()
+
+    def llm_engine(
+        messages,
+        stop_sequences=["Task"],
+        max_new_tokens: int = 1000,
+        stream: bool = False,
+        prefix_cache_key: Optional[str] = None,
+    ):
+        # The system prompt comes first in messages, so the server's automatic prefix caching (on by default in vLLM)
+        # reuses its KV cache across steps; the key groups requests sharing that prefix on servers that route by it
+        extra_body = {"prompt_cache_key": prefix_cache_key} if prefix_cache_key is not None else None
+        response = client.chat.completions.create(
+            model=NAMES[model_name],
+            messages=messages,
+            stop=stop_sequences,
+            max_tokens=max_new_tokens,
+            stream=stream,
+            extra_body=extra_body,
+        )
+        if stream:
+            # Yield the text chunks as they are generated, so that the agent can stop reading early
+            return (chunk.choices[0].delta.content or "" for chunk in response if chunk.choices)
+        return response.choices[0].message.content
+
+    return llm_engine
+
+# The factories below are memoized per arguments: every agent built for a model shares one client, and the weights of
+# a local model are only loaded once per process
+
+@functools.lru_cache(maxsize=None)
 def get_llm(model_name):
     llm = HuggingFaceEndpoint(
             repo_id=NAMES[model_name], 
@@ -30,56 +105,320 @@ def get_llm(model_name):
     chat = ChatHuggingFace(llm=llm, verbose=True)
     return chat
 
-def get_llm_huggingface(model_name):
+@functools.lru_cache(maxsize=None)
+def get_vllm(model_name):
+    # In-process vLLM engine: continuous batching over a paged KV cache, for offline generation without a server.
+    # The KV cache of prompt prefixes already seen (such as a shared system prompt) is reused by the next prompts.
+    # The weights are loaded in bf16: the bitsandbytes quantization of get_llm_huggingface does not apply here.
+    return vllm.LLM(model=NAMES[model_name], dtype='bfloat16', enable_prefix_caching=True)
+
+def get_quantization_kwargs(quant: str) -> dict:
+    # Decoding reads every weight once per token, so smaller weights make it faster: 'nf4' (4-bit), 'int8' or 'bf16'
+    if quant == 'bf16' or not is_bitsandbytes_available():
+        return {"torch_dtype": torch.bfloat16}
+    if quant == 'int8':
+        # The layers that stay unquantized (norms, embeddings) are kept in bf16 instead of fp32
+        return {"quantization_config": BitsAndBytesConfig(load_in_8bit=True), "torch_dtype": torch.bfloat16}
+    if quant == 'nf4':
+        return {"quantization_config": BitsAndBytesConfig(
+                    load_in_4bit=True,
+                    bnb_4bit_compute_dtype=torch.bfloat16,
+                    bnb_4bit_quant_type='nf4',
+                    bnb_4bit_use_double_quant=True
+                )}
+    raise ValueError(f"Unknown quantization {quant!r}, expected one of 'nf4', 'int8', 'bf16'")
+
+def get_attn_implementation() -> str:
+    # Fused attention kernels never materialize the attention matrix of the long system prompts: FlashAttention-2 when
+    # it is installed and a GPU is present, the PyTorch SDPA kernel otherwise
+    if torch.cuda.is_available() and is_flash_attn_2_available():
+        return "flash_attention_2"
+    return "sdpa"
+
+def can_compile_decoder() -> bool:
+    # CUDA graphs need a GPU, and torch.compile generation with a static cache needs torch 2.1
+    torch_version = tuple(int(part) for part in torch.__version__.split("+")[0].split(".")[:2])
+    return COMPILE_DECODER and torch.cuda.is_available() and torch_version >= (2, 1)
+
+def compile_decoder(model, tokenizer):
+    # A static KV cache keeps the decoding shapes fixed, so the graph of a decoding step is captured once as a CUDA
+    # graph (mode reduce-overhead) and replayed for every new token instead of launching its kernels from Python.
+    # fullgraph is off because the quantized matmuls of bitsandbytes are not traceable and run as graph breaks.
+    model.generation_config.cache_implementation = "static"
+    model.forward = torch.compile(model.forward, mode="reduce-overhead", fullgraph=False)
+    # Concurrent generate() calls would overwrite each other's KV cache in the shared static cache: they take turns
+    generate = model.generate
+    generate_lock = threading.Lock()
+
+    @functools.wraps(generate)
+    def locked_generate(*args, **kwargs):
+        with generate_lock:
+            return generate(*args, **kwargs)
+
+    model.generate = locked_generate
+    # The graph is captured by this warm-up rather than by the first request
+    warmup_ids = tokenizer("Hello", return_tensors="pt").to(model.device)
+    model.generate(**warmup_ids, max_new_tokens=8)
+
+@functools.lru_cache(maxsize=None)
+def get_llm_huggingface(model_name, quant: str = 'nf4'):
+    # Without bitsandbytes installed, the weights are loaded in bf16 whatever quant asks
     tokenizer = AutoTokenizer.from_pretrained(NAMES[model_name])
+    # Decoder-only models continue the last token of the prompt: batched prompts are padded on the left
+    tokenizer.padding_side = 'left'
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
     model = AutoModelForCausalLM.from_pretrained(
                 NAMES[model_name],
                 device_map="auto",
-                torch_dtype=torch.bfloat16
+                # the static cache of the compiled decoder runs with the SDPA kernel
+                attn_implementation="sdpa" if can_compile_decoder() else get_attn_implementation(),
+                **get_quantization_kwargs(quant)
             )
+    if can_compile_decoder():
+        compile_decoder(model, tokenizer)
     return model, tokenizer
 
+class PrefixTokenizer():
+    """
+    Tokenizes prompts made of a static prefix ending with a newline followed by a dynamic suffix, reusing the token ids
+    of the prefixes already seen so that only the suffix is tokenized. A prefix whose tokens change when a suffix is
+    appended is always tokenized along with its suffix.
+    """
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        # None marks a prefix that does not split cleanly from its suffix
+        self._prefix_ids = {}
+
+    def encode(self, prefix: str, suffix: str) -> List[int]:
+        prefix_ids = self._prefix_ids.get(prefix, False)
+        # Whitespace right after the newline could merge with it into a single token
+        if prefix_ids is None or not suffix[:1].strip():
+            return self.tokenizer(prefix + suffix)["input_ids"]
+        suffix_ids = self.tokenizer(suffix, add_special_tokens=False)["input_ids"]
+        if prefix_ids is False:
+            # First time this prefix is seen: only reuse its tokens if they split cleanly at the newline
+            input_ids = self.tokenizer(prefix + suffix)["input_ids"]
+            prefix_ids = self.tokenizer(prefix)["input_ids"]
+            self._prefix_ids[prefix] = prefix_ids if input_ids == prefix_ids + suffix_ids else None
+            return input_ids
+        return prefix_ids + suffix_ids
+
+class GenerateBatcher():
+    """
+    Batches the generations requested concurrently, e.g. by the threads serving different requests: the prompts
+    submitted within max_wait_ms of the first one, up to max_batch of them, go through a single model.generate call
+    instead of occupying the GPU one after the other.
+    """
+    def __init__(self, model, tokenizer, max_batch: int = 16, max_wait_ms: float = 20,
+                 static_prefixes: Sequence[str] = ()):
+        self.model = model
+        self.tokenizer = tokenizer
+        # The prompts starting with one of these, longest first, only have the rest of their text tokenized
+        self.static_prefixes = static_prefixes
+        self.prefix_tokenizer = PrefixTokenizer(tokenizer) if tokenizer is not None else None
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._collect, daemon=True)
+        self._worker.start()
+
+    def generate(self, prompt: str, max_new_tokens: int = 1000, stop_sequences: Optional[List[str]] = None) -> str:
+        """Generates the continuation of `prompt`, cut before the first of `stop_sequences` once it is generated."""
+        future = concurrent.futures.Future()
+        self._queue.put((prompt, max_new_tokens, tuple(stop_sequences or ()), future))
+        result = future.result()
+        for stop_seq in stop_sequences or ():
+            result = result.split(stop_seq)[0]
+        return result
+
+    def _collect(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            # The prompts asking for the same number of new tokens and stop sequences are generated together
+            groups = {}
+            for prompt, max_new_tokens, stop_sequences, future in batch:
+                groups.setdefault((max_new_tokens, stop_sequences), []).append((prompt, future))
+            for (max_new_tokens, stop_sequences), items in groups.items():
+                prompts, futures = zip(*items)
+                try:
+                    results = self._generate_batch(list(prompts), max_new_tokens, list(stop_sequences))
+                except Exception as e:
+                    for future in futures:
+                        future.set_exception(e)
+                    continue
+                for future, result in zip(futures, results):
+                    future.set_result(result)
+
+    def _encode(self, prompt: str) -> List[int]:
+        for prefix in self.static_prefixes:
+            if prompt.startswith(prefix):
+                return self.prefix_tokenizer.encode(prefix, prompt[len(prefix):])
+        return self.tokenizer(prompt)["input_ids"]
+
+    def _generate_batch(self, prompts: List[str], max_new_tokens: int, stop_sequences: List[str]) -> List[str]:
+        # Left-padded (see get_llm_huggingface), so that the prompts end where the generation starts
+        encoding = self.tokenizer.pad({"input_ids": [self._encode(prompt) for prompt in prompts]}, padding=True,
+                                      pad_to_multiple_of=8, return_tensors='pt').to('cuda')
+        generate_kwargs = {}
+        if stop_sequences:
+            # Each row of the batch stops decoding once it has generated one of the stop strings
+            generate_kwargs = {"stop_strings": stop_sequences, "tokenizer": self.tokenizer}
+        with torch.no_grad():
+            outputs = self.model.generate(**encoding, max_new_tokens=max_new_tokens, **generate_kwargs)
+        generated_outputs = outputs[:, encoding['input_ids'].shape[-1]:]
+        return self.tokenizer.batch_decode(generated_outputs, skip_special_tokens=True)
+
+class VLLMGenerateBatcher(GenerateBatcher):
+    """
+    GenerateBatcher over the in-process vLLM engine (see get_vllm), which schedules the prompts of a batch with
+    continuous batching over its paged KV cache instead of padding them to the longest one.
+    """
+    def __init__(self, llm, max_batch: int = 16, max_wait_ms: float = 20):
+        super().__init__(llm, None, max_batch=max_batch, max_wait_ms=max_wait_ms)
+
+    def _generate_batch(self, prompts: List[str], max_new_tokens: int, stop_sequences: List[str]) -> List[str]:
+        sampling_params = vllm.SamplingParams(max_tokens=max_new_tokens, temperature=0, stop=stop_sequences or None)
+        outputs = self.model.generate(prompts, sampling_params, use_tqdm=False)
+        return [output.outputs[0].text for output in outputs]
+
+@functools.lru_cache(maxsize=None)
+def get_generate_batcher(model_name) -> GenerateBatcher:
+    # One batcher per model, shared by all the agents generating with its weights; vLLM is used when it is installed.
+    # vLLM reserves most of the GPU memory for its KV cache, so the transformers weights must not be loaded next to it:
+    # get_huggingface_client1 then generates through this batcher too.
+    if VLLM_AVAILABLE:
+        return VLLMGenerateBatcher(get_vllm(model_name))
+    return GenerateBatcher(*get_llm_huggingface(model_name), static_prefixes=STATIC_PROMPT_PREFIXES)
+
+@functools.lru_cache(maxsize=None)
 def get_huggingface_client(model_name) -> Callable:
     client = InferenceClient(model=NAMES[model_name])
 
-    def llm_engine(messages, stop_sequences=["Task"]) -> str:
-        response = client.chat_completion(messages, stop=stop_sequences, max_tokens=1000)
+    def llm_engine(messages, stop_sequences=["Task"], max_new_tokens: int = 1000, stream: bool = False):
+        if stream:
+            # Yield the text chunks as they are generated, so that the agent can stop reading early
+            return (
+                chunk.choices[0].delta.content or ""
+                for chunk in client.chat_completion(
+                    messages, stop=stop_sequences, max_tokens=max_new_tokens, stream=True
+                )
+            )
+        response = client.chat_completion(messages, stop=stop_sequences, max_tokens=max_new_tokens)
         answer = response.choices[0].message.content
         return answer
     
     return llm_engine
 
 
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import AutoModelForCausalLM, AutoTokenizer, StoppingCriteria, StoppingCriteriaList
 import torch
-from typing import Callable, List
+from typing import Callable, List, Optional
 
-def get_huggingface_client1(model_name: str) -> Callable:
-    # Load model and tokenizer locally
-    tokenizer = AutoTokenizer.from_pretrained(NAMES[model_name])
-    model = AutoModelForCausalLM.from_pretrained(
-                NAMES[model_name],
-                device_map="auto",
-                torch_dtype=torch.bfloat16
-            )
+class StopOnSequences(StoppingCriteria):
+    """
+    Stops the generation as soon as the generated text holds one of `stop_sequences`. Every token decodes to at least
+    one character, so only the last tokens spanning the longest stop sequence are decoded at each step.
+    """
+    def __init__(self, tokenizer, stop_sequences: List[str], prompt_length: int):
+        self.tokenizer = tokenizer
+        self.stop_sequences = stop_sequences
+        self.prompt_length = prompt_length
+        self.window = max(len(stop_seq) for stop_seq in stop_sequences) + 1
 
-    def llm_engine(messages: List[str], stop_sequences: List[str] = ["Task"]) -> str:
-        system_prompts = "\n".join([message["content"] for message in messages if message["role"] == "system"])
-        user_messages = "\n".join([message["content"] for message in messages if message["role"] != "system"])
-        
-        input_text = f"{system_prompts}\n{user_messages}"
+    def __call__(self, input_ids, scores, **kwargs) -> bool:
+        tail_ids = input_ids[0, max(self.prompt_length, input_ids.shape[-1] - self.window):]
+        tail = self.tokenizer.decode(tail_ids, skip_special_tokens=True)
+        return any(stop_seq in tail for stop_seq in self.stop_sequences)
+
+def split_messages(messages: List[dict]) -> Tuple[str, str]:
+    # Messages are split by role in a single pass, into the system prompts and the user messages
+    system_contents, user_contents = [], []
+    for message in messages:
+        (system_contents if message["role"] == "system" else user_contents).append(message["content"])
+    return "\n".join(system_contents), "\n".join(user_contents)
+
+def get_vllm_client(model_name: str) -> Callable:
+    # Counterpart of get_huggingface_client1 over the vLLM batcher, whose engine is shared with get_response
+    batcher = get_generate_batcher(model_name)
+
+    def llm_engine(
+        messages: List[str],
+        stop_sequences: List[str] = ["Task"],
+        max_new_tokens: int = 1000,
+        use_draft_model: bool = False,
+        use_ngram_spec: bool = False,
+    ) -> str:
+        # vLLM has no assisted generation per request: use_draft_model and use_ngram_spec are ignored
+        system_prompts, user_messages = split_messages(messages)
+        return batcher.generate(f"{system_prompts}\n{user_messages}", max_new_tokens, stop_sequences)
+
+    return llm_engine
+
+@functools.lru_cache(maxsize=None)
+def get_huggingface_client1(model_name: str, draft_model_name: Optional[str] = None) -> Callable:
+    if VLLM_AVAILABLE:
+        return get_vllm_client(model_name)
+    # Load model and tokenizer locally, sharing the weights already loaded by get_llm_huggingface
+    model, tokenizer = get_llm_huggingface(model_name)
+
+    # Optional small model sharing the tokenizer of the main model: it drafts tokens that the main model
+    # verifies in a single forward pass (assisted generation), which pays off on template-heavy code actions
+    draft_model = None
+    if draft_model_name is not None:
+        draft_model = AutoModelForCausalLM.from_pretrained(
+                    NAMES.get(draft_model_name, draft_model_name),
+                    device_map="auto",
+                    torch_dtype=torch.bfloat16,
+                    attn_implementation=get_attn_implementation()
+                )
+
+    # The system prompts, followed by their newline, are the static prefix of the prompt: they are only tokenized once
+    prefix_tokenizer = PrefixTokenizer(tokenizer)
+
+    def encode(system_prompts: str, user_messages: str) -> dict:
+        input_ids = torch.tensor([prefix_tokenizer.encode(system_prompts + "\n", user_messages)])
+        return {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+
+    def llm_engine(
+        messages: List[str],
+        stop_sequences: List[str] = ["Task"],
+        max_new_tokens: int = 1000,
+        use_draft_model: bool = False,
+        use_ngram_spec: bool = False,
+    ) -> str:
+        system_prompts, user_messages = split_messages(messages)
         
-        input_ids = tokenizer(input_text, return_tensors="pt").to('cuda')
+        input_ids = {name: tensor.to('cuda') for name, tensor in encode(system_prompts, user_messages).items()}
 
         # Generate outputs
-        outputs = model.generate(**input_ids, max_new_tokens=1000)
+        generate_kwargs = {}
+        # The static cache of a compiled decoder does not support assisted generation
+        can_assist = model.generation_config.cache_implementation != "static"
+        if can_assist and use_draft_model and draft_model is not None:
+            generate_kwargs["assistant_model"] = draft_model
+        elif can_assist and use_ngram_spec:
+            # Prompt lookup decoding: candidate tokens are copied from matching n-grams of the prompt
+            generate_kwargs["prompt_lookup_num_tokens"] = 3
+            generate_kwargs["max_matching_ngram_size"] = 5
+        if stop_sequences:
+            generate_kwargs["stopping_criteria"] = StoppingCriteriaList(
+                [StopOnSequences(tokenizer, stop_sequences, input_ids['input_ids'].shape[-1])]
+            )
+        outputs = model.generate(**input_ids, max_new_tokens=max_new_tokens, **generate_kwargs)
         generated_outputs = outputs[0, input_ids['input_ids'].shape[-1]:]
 
         # Decode and return the result
         result = tokenizer.decode(generated_outputs, skip_special_tokens=True)
         
-        # Optionally, handle stop sequences if necessary
-        # This is a simplified version and may not perfectly handle stop sequences
+        # The generation stopped right after a stop sequence, which is cut off along with the text that may follow it
+        # within the last tokens
         for stop_seq in stop_sequences:
             if stop_seq in result:
                 result = result.split(stop_seq)[0]
@@ -87,4 +426,3 @@ def get_huggingface_client1(model_name: str) -> Callable:
         return result
 
     return llm_engine
-
@@ -1,31 +1,251 @@
 # input: model_name, query
 # output: response
 
-from langchain_core.prompts import ChatPromptTemplate
+from transformers import StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
 from .models import *
 from prompts.default_prompts import *
 from prompts.search_prompt import *
-from typing import List
+from typing import Any, Awaitable, Callable, List, Optional, Union
+from collections import OrderedDict
+import asyncio
+import functools
+import hashlib
+import re
+import threading
+import time
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+def normalize_query(query: str) -> str:
+    # Queries differing only by case, spacing or final punctuation share their completion
+    return " ".join(query.lower().split()).rstrip("?.!")
+
+class CompletionCache():
+    """
+    LRU cache of completions, keyed by the model name and the normalized prompt (see normalize_query). Entries expire
+    after ttl seconds. The hits and misses are counted, see hit_rate.
+    """
+    def __init__(self, maxsize: int = 10_000, ttl: float = 3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    @staticmethod
+    def make_key(model_name: str, prompt: str, stop_sequences: Optional[List[str]] = None) -> Union[int, str]:
+        # The keys stay in process, so the non-cryptographic xxh3 hash is enough when xxhash is installed
+        normalized_prompt = normalize_query(prompt)
+        key = f"{model_name}\n{stop_sequences or []}\n{normalized_prompt}".encode("utf-8")
+        if xxhash is not None:
+            return xxhash.xxh3_64_intdigest(key)
+        return hashlib.blake2b(key, digest_size=16).hexdigest()
+
+    def get(self, key: Union[int, str]) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[0] >= self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key: Union[int, str], completion: Any):
+        with self._lock:
+            self._entries[key] = (time.time(), completion)
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+# Queries whose answer changes over time, never answered from a cache
+_TIME_SENSITIVE_RE = re.compile(
+    r"\b(today|tonight|now|current|currently|latest|yesterday|tomorrow|this (week|month|year))\b", re.IGNORECASE
+)
+
+def is_time_sensitive(query: str) -> bool:
+    return _TIME_SENSITIVE_RE.search(query) is not None
+
+def cache_responses(run):
+    """
+    Caches the outputs of an async agent method taking the user query, in the `response_cache` CompletionCache of the
+    agent keyed by its `model_id` and the normalized query. Time-sensitive queries are always run.
+    """
+    @functools.wraps(run)
+    async def cached_run(self, user_query: str):
+        if is_time_sensitive(user_query):
+            return await run(self, user_query)
+        key = self.response_cache.make_key(self.model_id, user_query)
+        result = self.response_cache.get(key)
+        if result is None:
+            result = await run(self, user_query)
+            self.response_cache.put(key, result)
+        return result
+
+    return cached_run
+
+class BatchingQueue():
+    """
+    Gathers the items submitted concurrently, up to max_batch of them within max_wait_ms of the first one, and hands
+    each batch to a single call of process_batch, an async function mapping a list of items to the list of results.
+    """
+    def __init__(self, process_batch: Callable[[List], Awaitable[List]], max_batch: int = 16, max_wait_ms: float = 20):
+        self.process_batch = process_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._queue = None
+        self._worker = None
+        self._batch_tasks = set()
+
+    async def submit(self, item):
+        # The worker lives in the running event loop, a new one is started for each asyncio.run
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._collect())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    break
+            # Batches are processed concurrently, the next one is collected meanwhile
+            task = asyncio.create_task(self._process(batch))
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._batch_tasks.discard)
+
+    async def _process(self, batch):
+        items, futures = zip(*batch)
+        try:
+            results = await self.process_batch(list(items))
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future, result in zip(futures, results):
+            if not future.done():
+                future.set_result(result)
 
 class OfflineModel():
-    def __init__(self, model_name = 'llama'):
+    # Shared by the instances of the class, whose completions all have the same type
+    completion_cache = CompletionCache()
+
+    def __init__(self, model_name = 'llama', max_batch: int = 16, max_wait_ms: float = 20, max_concurrency: int = 10):
         # model
+        self.model_name = model_name
         self.llm = get_llm(model_name)
-        # prompt
-        self.generating_result_prompt = ChatPromptTemplate.from_template(SIMPLE_OFFLINE_SEARCH_PROMPT)
+        # prompt, formatted directly: a string input is sent as the single human message the chat template produced
+        self.generating_result_prompt = SIMPLE_OFFLINE_SEARCH_PROMPT
+        self.max_concurrency = max_concurrency
+        # Concurrent _run calls are grouped into a single batched call of the chain
+        self.batching_queue = BatchingQueue(self._run_batch, max_batch=max_batch, max_wait_ms=max_wait_ms)
+        # Completions being generated, awaited by the identical queries that arrive meanwhile
+        self._in_flight = {}
 
+    async def _run_batch(self, user_queries: List[str]) -> List:
+        prompts = [self.generating_result_prompt.format(question=user_query) for user_query in user_queries]
+        return await self.llm.abatch(prompts, config={'max_concurrency': self.max_concurrency})
 
     async def _run(self, user_query: str) -> str:
-        chain = self.generating_result_prompt | self.llm
-        result = await chain.ainvoke({'question': user_query})
+        key = self.completion_cache.make_key(self.model_name, user_query)
+        result = self.completion_cache.get(key)
+        if result is not None:
+            return result
+        if key in self._in_flight:
+            return await asyncio.shield(self._in_flight[key])
+        self._in_flight[key] = asyncio.ensure_future(self.batching_queue.submit(user_query))
+        try:
+            result = await asyncio.shield(self._in_flight[key])
+        finally:
+            del self._in_flight[key]
+        self.completion_cache.put(key, result)
         return result
     
+class StopEventCriteria(StoppingCriteria):
+    """Stops a generation running in another thread once `event` is set."""
+    def __init__(self, event: threading.Event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs) -> bool:
+        return self.event.is_set()
+
+class VLLMOfflineModel():
+    def __init__(self, model_name = 'gemma'):
+        self.llm = get_vllm(model_name)
+        self.sampling_params = vllm.SamplingParams(max_tokens=256, temperature=0)
+
+    def _run(self, user_query: str, stop_sequences: Optional[List[str]] = None) -> str:
+        if stop_sequences:
+            sampling_params = vllm.SamplingParams(max_tokens=256, temperature=0, stop=stop_sequences)
+            return self.llm.generate([user_query], sampling_params)[0].outputs[0].text
+        return self._run_batch([user_query])[0]
+
+    def _run_batch(self, user_queries: List[str]) -> List[str]:
+        # vLLM schedules all the queries together, without padding them to the longest one
+        outputs = self.llm.generate(user_queries, self.sampling_params)
+        return [output.outputs[0].text for output in outputs]
+
 class OfflineModelHuggingface():
+    completion_cache = CompletionCache()
+
     def __init__(self, model_name = 'gemma'):
-        self.llm, self.tokenizer = get_llm_huggingface(model_name)
+        self.model_name = model_name
+        self.server_generate = get_llm_server_generate(model_name)
+        self.vllm_model = None
+        if self.server_generate is None:
+            if VLLM_AVAILABLE:
+                self.vllm_model = VLLMOfflineModel(model_name)
+            else:
+                self.llm, self.tokenizer = get_llm_huggingface(model_name)
     
-    def _run(self, user_query: str) -> str:
+    def _run(self, user_query: str, stop_sequences: Optional[List[str]] = None) -> str:
+        key = self.completion_cache.make_key(self.model_name, user_query, stop_sequences)
+        result = self.completion_cache.get(key)
+        if result is None:
+            result = self._generate(user_query, stop_sequences)
+            self.completion_cache.put(key, result)
+        return result
+
+    def _run_batch(self, user_queries: List[str]) -> List[str]:
+        # Only the queries missing from the completion cache are generated, the results keep the order of the queries
+        keys = [self.completion_cache.make_key(self.model_name, user_query) for user_query in user_queries]
+        results = [self.completion_cache.get(key) for key in keys]
+        misses = [i for i, result in enumerate(results) if result is None]
+        if misses:
+            generated = self._generate_batch([user_queries[i] for i in misses])
+            for i, result in zip(misses, generated):
+                self.completion_cache.put(keys[i], result)
+                results[i] = result
+        return results
+
+    def _generate(self, user_query: str, stop_sequences: Optional[List[str]] = None) -> str:
+        if self.server_generate is not None:
+            return self.server_generate(user_query, 256, stop_sequences)
+        if self.vllm_model is not None:
+            return self.vllm_model._run(user_query, stop_sequences)
         input_ids = self.tokenizer(user_query, return_tensors="pt").to("cuda")
+        if stop_sequences:
+            return self._generate_until_stop(input_ids, stop_sequences)
 
         outputs = self.llm.generate(**input_ids, max_new_tokens=256)
         generated_outputs = outputs[0, input_ids['input_ids'].shape[-1]:]
@@ -33,9 +253,44 @@ class OfflineModelHuggingface():
         result = self.tokenizer.decode(generated_outputs, skip_special_tokens=True)
         return result
 
-    def _run_batch(self, user_queries: List[str]) -> List[str]:
-        encoding = self.tokenizer(user_queries, padding=True, return_tensors='pt').to('cuda')
+    def _generate_until_stop(self, input_ids, stop_sequences: List[str]) -> str:
+        # The tokens are streamed out of a generation running in a thread, which is stopped as soon as the text holds
+        # a stop sequence instead of decoding up to max_new_tokens
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        stop_event = threading.Event()
+        generation = threading.Thread(target=self.llm.generate, kwargs={
+            **input_ids,
+            'max_new_tokens': 256,
+            'streamer': streamer,
+            'stopping_criteria': StoppingCriteriaList([StopEventCriteria(stop_event)]),
+        })
+        generation.start()
+        result = ''
+        try:
+            for text in streamer:
+                result += text
+                if any(stop_seq in result for stop_seq in stop_sequences):
+                    break
+        finally:
+            # the generation ends at its next decoding step
+            stop_event.set()
+            generation.join()
+        for stop_seq in stop_sequences:
+            result = result.split(stop_seq)[0]
+        return result
+
+    def _generate_batch(self, user_queries: List[str]) -> List[str]:
+        if self.server_generate is not None:
+            # The server batches the requests itself
+            return [self.server_generate(user_query, 256) for user_query in user_queries]
+        if self.vllm_model is not None:
+            return self.vllm_model._run_batch(user_queries)
+        # Left-padded to a multiple of 8 tokens, so that the prompts end where the generation starts and the matmul shapes
+        # suit the tensor cores
+        encoding = self.tokenizer(user_queries, padding=True, pad_to_multiple_of=8, return_tensors='pt').to('cuda')
         with torch.no_grad():
-            outputs = self.llm.generate(**encoding,  max_new_tokens=256)
-        results_list = self.tokenizer.batch_decode(outputs, skip_special_tokens=True)
+            outputs = self.llm.generate(input_ids=encoding['input_ids'], attention_mask=encoding['attention_mask'],
+                                        max_new_tokens=256)
+        generated_outputs = outputs[:, encoding['input_ids'].shape[-1]:]
+        results_list = self.tokenizer.batch_decode(generated_outputs, skip_special_tokens=True)
         return results_list
\ No newline at end of file
@@ -3,12 +3,24 @@ from typing import Dict, List, Tuple, Optional
 from langchain.output_parsers import ListOutputParser
 from langchain_core.output_parsers import BaseOutputParser, StrOutputParser
 from pydantic import BaseModel
+from prompts.search_prompt import STRATEGY_PARSER, SUGGESTIONS_PARSER
+
+# Every planning search is a full ReAct step: suggestions beyond this budget are dropped instead of searched
+MAX_PLANNING_SEARCHES = 5
+_SUGGESTION_SEPARATOR_RE = re.compile(r"[,;]\s*")
+
+def truncate_suggestions(suggestions: str, max_searches: int = MAX_PLANNING_SEARCHES) -> str:
+    items = [item for item in _SUGGESTION_SEPARATOR_RE.split(suggestions) if item.strip()]
+    if len(items) <= max_searches:
+        return suggestions
+    return ", ".join(items[:max_searches])
+
+# pattern = r"Answer:\s*(Clear|Unclear)\s*Question:\s*(.*)"
+_ASK_USER_RE = re.compile(r"Clear Score:\s*(.*)\s*Question:\s*(.*)", re.DOTALL)
 
 class AskUserParser(BaseOutputParser):
     def parse(self, text) -> Dict:
-        # pattern = r"Answer:\s*(Clear|Unclear)\s*Question:\s*(.*)"
-        pattern = r"Clear Score:\s*(.*)\s*Question:\s*(.*)"
-        match = re.search(pattern, text, re.DOTALL)
+        match = _ASK_USER_RE.search(text)
         
         if match:
             # answer = match.group(1).strip()
@@ -28,70 +40,95 @@ class AskUserParser(BaseOutputParser):
             return {'Answer': 'Clear', 'Question': None}
 
 
+# Words and separators of queries that usually need several searches (Parallel or Planning), in English and Chinese.
+# Chinese words are not delimited by spaces, so they are matched anywhere in the query.
+_MULTI_SEARCH_HINT_RE = re.compile(
+    r"[,;，；、]|\b(and|or|vs|versus|compare|comparison|between|plan|planning|itinerary|then|after|before|steps?|guide|"
+    r"prepare)\b|和|或|还是|以及|然后|之后|之前|比较|对比|区别|哪个|攻略|计划|规划|行程|步骤|准备",
+    re.IGNORECASE,
+)
+_CJK_CHAR_RE = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]")
+
+def query_length(query: str) -> int:
+    # Number of words of the query, a Chinese word being about two characters long
+    cjk_chars = len(_CJK_CHAR_RE.findall(query))
+    return len(_CJK_CHAR_RE.sub(" ", query).split()) + (cjk_chars + 1) // 2
+
+def likely_direct_query(query: str, max_words: int = 12) -> bool:
+    # Cheap guess of the Direct strategy, before the LLM classifies the query: a short query naming a single concept
+    return query_length(query) <= max_words and _MULTI_SEARCH_HINT_RE.search(query) is None
+
+# Digits, a capitalized word after the first one or a capital inside a word (a name such as "iPhone"), or CJK
+# characters: the English embedding model of SemanticCache tells Chinese names such as 北京 and 上海 apart poorly
+_SPECIFIC_TERM_RE = re.compile(r"\d|\s[A-Z]|[a-z][A-Z]|[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]")
+
+def has_specific_terms(query: str) -> bool:
+    # Queries naming a number or an entity are not matched semantically: "iPhone 14 price" and "iPhone 15 price" embed
+    # almost identically but need different searches
+    return _SPECIFIC_TERM_RE.search(query) is not None
+
+# In the order they are looked for when the answer has no 'Strategy:' line
+VALID_STRATEGIES = ("Parallel", "Planning", "Direct")
+_VALID_STRATEGY_SET = frozenset(VALID_STRATEGIES)
+
 class StrategySuggestionParser(BaseOutputParser):
     def parse(self, text) -> Tuple[str, str]:
         # strategy
-        valid_strategies = ["Parallel", "Planning", "Direct"]
-        marker = "Strategy:"
         strategy = None
 
-        marker_position = text.find(marker)
-        if marker_position != -1:
+        match = STRATEGY_PARSER.search(text)
+        if match is not None:
             # Extract the text following the marker
-            start = marker_position + len(marker)
-            end = text.find("\n", start)
-            strategy = text[start:end].strip()
+            strategy = match.group(1).strip()
         else:
-            for valid_strategy in valid_strategies:
+            for valid_strategy in VALID_STRATEGIES:
                 if valid_strategy in text:
                     if strategy is not None:
                         return "Multiple strategies found in text: {text}" # raise ValueError
                     strategy = valid_strategy
 
-        if strategy not in valid_strategies:
+        if strategy not in _VALID_STRATEGY_SET:
             strategy = 'Direct'
 
         # suggestion
-        marker = "Suggestions:"
         suggestions = ''
-        marker_position = text.find(marker)
-        if marker_position != -1:
+        match = SUGGESTIONS_PARSER.search(text)
+        if match is not None:
             # Extract the text following the marker
-            start = marker_position + len(marker)
-            end = text.find("\n", start)
-            suggestions = text[start:end].strip()
-        else:
-            suggestions = ''
+            suggestions = match.group(1).strip()
             
         return strategy, suggestions
     
 class StrategyParser(BaseOutputParser):
     def parse(self, text) -> Dict:
-        valid_strategies = ["Parallel", "Planning", "Direct"]
-        marker = "Strategy:"
         strategy = None
 
-        marker_position = text.find(marker)
-        if marker_position != -1:
+        match = STRATEGY_PARSER.search(text)
+        if match is not None:
             # Extract the text following the marker
-            start = marker_position + len(marker)
-            end = text.find("\n", start)
-            strategy = text[start:end].strip()
+            strategy = match.group(1).strip()
         else:
             # 如果找不到，那就从整个text里面找这三个，如果只有一个，就返回这个，如果有多个，就raise error
-            for valid_strategy in valid_strategies:
+            for valid_strategy in VALID_STRATEGIES:
                 if valid_strategy in text:
                     if strategy is not None:
                         raise ValueError(f"Multiple strategies found in text: {text}")
                     strategy = valid_strategy
 
         # Check if the extracted strategy is valid
-        if strategy not in valid_strategies:
+        if strategy not in _VALID_STRATEGY_SET:
             # raise ValueError(f"Invalid strategy: {strategy}")
             return 'Direct'
 
         return strategy
     
+# The markers are matched case-insensitively, so only the extracted section is lowercased instead of the whole output
+_GENERATED_QUESTIONS_RE = re.compile(r"generated questions:", re.IGNORECASE)
+_REPHRASED_QUESTION_RE = re.compile(r"rephrased question:\s*([^\n]*)", re.IGNORECASE)
+
+# A generated question line: "1. question" up to "9. question"
+_NUMBERED_QUESTION_RE = re.compile(r"[1-9]\.\s*(.*)")
+
 class GeneratedQuestionsSeparatedListOutputParser(ListOutputParser):
     """Parse the output of an LLM call to a comma-separated list."""
 
@@ -113,33 +150,30 @@ class GeneratedQuestionsSeparatedListOutputParser(ListOutputParser):
         Returns:
             List[str]: A list of strings, each representing a found question in the format 'number.question'.
         """
-        text = text.lower()
-        parts = text.split("generated questions:")
-
-        if len(parts) > 1:
-            questions = parts[1].strip().split("\n")
+        questions = []
+        match = _GENERATED_QUESTIONS_RE.search(text)
+        if match is not None:
+            # the section ends at a repeated marker, if any
+            next_match = _GENERATED_QUESTIONS_RE.search(text, match.end())
+            section = text[match.end():next_match.start() if next_match is not None else None]
+            questions = section.lower().strip().split("\n")
             questions = [q for q in questions if q]
     
         # 提取以数字序列开头的问题
         seq_questions = []
         for q in questions:
-            stripped_q = q.strip()
-            
-            # 检查是否以数字序列开头
-            if stripped_q.startswith(tuple(f"{i}." for i in range(1, 10))):
-                # 去掉数字序列和后面的空格
-                question_text = stripped_q.split(".", 1)[-1].strip()
-                
-                # 仅在去掉数字序列后问题有实际内容时才加入列表
-                if question_text:
-                    seq_questions.append(question_text)
-            else:
+            match = _NUMBERED_QUESTION_RE.match(q.strip())
+            if match is None:
                 break  # 如果问题不以数字序列开头，则停止提取
-    
-        if len(seq_questions) > 5:
-            return seq_questions[:5]
-        else:
-            return seq_questions
+
+            # 仅在去掉数字序列后问题有实际内容时才加入列表
+            question_text = match.group(1).strip()
+            if question_text:
+                seq_questions.append(question_text)
+                if len(seq_questions) == 5:
+                    break  # at most 5 questions are searched, the rest of the lines are not scanned
+
+        return seq_questions
 
     @property
     def _type(self) -> str:
@@ -147,19 +181,8 @@ class GeneratedQuestionsSeparatedListOutputParser(ListOutputParser):
 
 class RephraseParser(BaseOutputParser):
     def parse(self, text) -> str:
-        text = text.lower()
-        marker = "rephrased question:"
-        rephrased_question = None
-
-        marker_position = text.find(marker)
-        if marker_position != -1:
-            parts = text.split("rephrased question:")
-            if len(parts) > 1:
-                rephrased_question = parts[1].strip()
-            newline_position = rephrased_question.find('\n')
-            if newline_position != -1:
-                    rephrased_question = rephrased_question[:newline_position].strip()
-        else:
-            raise ValueError(f"Rephrased question not found in text: {text}")
+        match = _REPHRASED_QUESTION_RE.search(text)
+        if match is None:
+            raise ValueError(f"Rephrased question not found in text: {text.lower()}")
 
-        return rephrased_question
+        return match.group(1).strip().lower()
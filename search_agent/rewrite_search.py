@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import Dict, List, Tuple, Optional
+from typing import AsyncIterator, Dict, List, Tuple, Optional
 from langchain.output_parsers import ListOutputParser
 from langchain_core.output_parsers import BaseOutputParser, StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
@@ -7,18 +7,20 @@ from langchain_core.prompts.base import BasePromptTemplate
 from langchain.tools import Tool
 from langchain_openai import ChatOpenAI
 from langchain.agents import AgentExecutor, create_react_agent
-from tools.tool_utils import TavilySearchAPIWrapper
+from tools.tool_utils import TavilySearchAPIWrapper, format_search_results
 from tools.tool_utils import create_react_agent_with_suggestions
 from .models import *
 import re
 import json
-from search_agent.parser import AskUserParser, StrategySuggestionParser, RephraseParser, GeneratedQuestionsSeparatedListOutputParser
+from .offline_model import CompletionCache, cache_responses
+from search_agent.parser import AskUserParser, StrategySuggestionParser, RephraseParser, GeneratedQuestionsSeparatedListOutputParser, has_specific_terms
 from prompts.search_prompt import *
 from transformers import pipeline
 from transformers.agents import ReactAgent, ReactCodeAgent, ReactCodeSearchAgent
+from transformers.agents.agents import SearchCache, SemanticCache
 from transformers import Tool
 from huggingface_hub import list_models
-from tools.tavily_search import TavilySearchHuggingfaceTool
+from tools.tavily_search import TavilySearchHuggingfaceTool, tavily_search_huggingface_tool
 import asyncio
 from fastapi import HTTPException
 # from sentence_transformers import SentenceTransformer
@@ -29,16 +31,6 @@ import traceback
 
 # Define a custom parser by extending the BaseParser class
 
-def get_time():
-    import datetime
-    current_time = datetime.datetime.now()
-    tomorrow_time = current_time + datetime.timedelta(days=1)
-
-    current_time_str = current_time.strftime('%Y %b %d')
-    tomorrow_time_str = tomorrow_time.strftime('%Y %b %d')
-
-    return current_time_str, tomorrow_time_str
-
 class SimpleSearchAgentOutput(BaseModel):
     Result: Optional[str] # str or None
     Url: Optional[List[str]] # str or None
@@ -60,10 +52,18 @@ class RewriteAgent():
     generating_result_prompt: BasePromptTemplate
     rephrase_prompt: BasePromptTemplate
     rephrase_parser: BaseOutputParser
+    # Rephrasings of earlier queries, reused for near-duplicate ones (e.g. a retried question) instead of an LLM call
+    # when rephrase_cache_threshold is given
+    rephrase_cache = None
+    # Complete outputs of _run, so that a repeated query skips the search and the generations
+    response_cache = CompletionCache(maxsize=1000, ttl=3600)
+
+    def __init__(self, model_name = 'llama', raw_content = False, rephrase_cache_threshold: Optional[float] = None):
+        if rephrase_cache_threshold is not None:
+            self.rephrase_cache = SemanticCache(threshold=rephrase_cache_threshold)
 
-    def __init__(self, model_name = 'llama', raw_content = False):
-        
         # model
+        self.model_id = NAMES[model_name]
         self.llm = get_llm(model_name)
 
         # search parameter
@@ -72,72 +72,90 @@ class RewriteAgent():
         # self.sentence_transformer = SentenceTransformer('paraphrase-MiniLM-L6-v2') # TODO？
 
         # prompt
-        self.generating_result_prompt = ChatPromptTemplate.from_template(GENERATING_RESULT_PROMPT)
+        # The instructions are a system message shared by every request, followed by the context and question
+        self.generating_result_prompt = ChatPromptTemplate.from_messages([
+            ("system", GENERATING_RESULT_INSTRUCTIONS),
+            ("human", GENERATING_RESULT_REQUEST),
+        ])
         self.rephrase_prompt = ChatPromptTemplate.from_template(SEARCH_DIRECT_REPHRASE_PROMPT)
 
         # parser
         self.rephrase_parser = RephraseParser()
 
-
-    async def _run(self, user_query: str) -> str:
-
-        refer_url = []
-
-        rephrased_question = ''
-
-        rephrase_chain = (
-                self.rephrase_prompt | 
-                self.llm |
-                self.rephrase_parser
-            )
-        rephrased_question: str = await rephrase_chain.ainvoke({'input': user_query})
-        
-        direct_search_result = await self.tavily_search.results_async(rephrased_question, 
-                                                                        max_results=5,
-                                                                        include_raw_content=self.raw_content)
-
-        direct_search_reference = 'User Query: ' + user_query + '\n'
-        direct_search_reference += f"Rephrased Question: {rephrased_question}\n"
-
-        refer_url = []
-        refer_content = []
-        for i, result in enumerate(direct_search_result, 1):
-            direct_search_reference += f"\nResult {i}:\n"
-            for key, value in result.items():
-                if key == 'url':
-                    refer_url.append(value)
-                if key == 'content':
-                    refer_content.append(value)
-                direct_search_reference += f"{key}: {value}\n"
+        # chains, built once and reused by every request
+        self.rephrase_chain = self.rephrase_prompt | self.llm | self.rephrase_parser
+        self.rag_chain = self.generating_result_prompt | self.llm | StrOutputParser()
+
+
+    async def rephrase(self, user_query: str) -> str:
+        use_cache = self.rephrase_cache is not None and not has_specific_terms(user_query)
+        if use_cache:
+            # The embedding model runs in a thread, off the event loop
+            embedding = await asyncio.to_thread(self.rephrase_cache.embed, user_query)
+            rephrased_question = self.rephrase_cache.get(embedding)
+            if rephrased_question is not None:
+                return rephrased_question
+        rephrased_question = await self.rephrase_chain.ainvoke({'input': user_query})
+        if use_cache:
+            self.rephrase_cache.put(embedding, rephrased_question)
+        return rephrased_question
+
+    async def _search_reference(self, user_query: str) -> Tuple[str, List[str], List[str]]:
+        # The original query is searched while it is rephrased
+        rephrased_question, direct_search_result = await self.tavily_search.results_speculative(
+            user_query, self.rephrase(user_query),
+            max_results=5, include_raw_content=self.raw_content)
+
+        results_reference, refer_url, refer_content = format_search_results(direct_search_result)
+        direct_search_reference = f"User Query: {user_query}\nRephrased Question: {rephrased_question}\n{results_reference}"
 
         ######## III.for whole reference ######################
         FINAL_REFERENCE = f"""User's original question is {user_query}.
         Some potential questions and answers for reference are as follow:\n{direct_search_reference}
         """
-        rag_chain = (
-            self.generating_result_prompt | 
-            self.llm |
-            StrOutputParser()
-        )
+        return FINAL_REFERENCE, refer_url, refer_content
 
-        final_result = await rag_chain.ainvoke({'question': user_query,'context': FINAL_REFERENCE})
+    @cache_responses
+    async def _run(self, user_query: str) -> str:
+        FINAL_REFERENCE, refer_url, refer_content = await self._search_reference(user_query)
+        final_result = await self.rag_chain.ainvoke({'question': user_query,'context': FINAL_REFERENCE})
         return SimpleSearchAgentOutput(Result=final_result, 
                                  Url=refer_url, Rerference=refer_content)
 
+    async def _astream(self, user_query: str) -> AsyncIterator[str]:
+        # Same answer as _run, yielded as it is generated so that a client sees the first tokens right away,
+        # e.g. through a StreamingResponse(agent._astream(query), media_type="text/event-stream")
+        FINAL_REFERENCE, _, _ = await self._search_reference(user_query)
+        async for chunk in self.rag_chain.astream({'question': user_query,'context': FINAL_REFERENCE}):
+            yield chunk
+
 
 class RewriteAgentHuggingface():
-    rephrase_prompt = SEARCH_DIRECT_REPHRASE_PROMPT1
+    rephrase_prompt = direct_rephrase_prompt(include_keywords=False)
     generating_result_prompt = GENERATING_RESULT_PROMPT
     rephrase_parser = RephraseParser()
-
-    def __init__(self, model_name = 'gemma', max_new_tokens=64):
+    # Rephrasings of earlier queries, reused for near-duplicate ones instead of a generation when
+    # rephrase_cache_threshold is given
+    rephrase_cache = None
+    response_cache = CompletionCache(maxsize=1000, ttl=3600)
+
+    def __init__(self, model_name = 'gemma', max_new_tokens=64, rephrase_cache_threshold: Optional[float] = None):
+        if rephrase_cache_threshold is not None:
+            self.rephrase_cache = SemanticCache(threshold=rephrase_cache_threshold)
+        # Search results of the ReAct runs of this agent, reused by its later identical searches
+        self.search_cache = SearchCache()
         self.model_id = NAMES[model_name]
-        self.llm, self.tokenizer = get_llm_huggingface(model_name)
+        # Generations go to the LLM server when one is configured, so the weights are only loaded locally otherwise
+        self.server_generate = get_llm_server_generate(model_name)
+        if self.server_generate is None:
+            self.batcher = get_generate_batcher(model_name)
 
         self.tavily_search = TavilySearchAPIWrapper(context_str_limit=800)
         self.max_new_tokens = max_new_tokens
 
-        if model_name == 'llama':
+        if self.server_generate is not None:
+            self.llm_engine = get_llm_server_engine(model_name)
+        elif model_name == 'llama':
             self.llm_engine = get_huggingface_client(model_name)
         else:
             self.llm_engine = get_huggingface_client1(model_name)
@@ -151,57 +169,53 @@ class RewriteAgentHuggingface():
         self.logging.setLevel(logging.DEBUG)
     
     def get_response(self, input: str, max_new_tokens = 1000) -> str:
-        input_ids = self.tokenizer(input, return_tensors="pt").to("cuda")
-
-        outputs = self.llm.generate(**input_ids, max_new_tokens=max_new_tokens)
-        generated_outputs = outputs[0, input_ids['input_ids'].shape[-1]:]
-
-        result = self.tokenizer.decode(generated_outputs, skip_special_tokens=True)
-
-        return result
-
-    def _react_run(self, user_query: str) -> str:
-        raw_rephrased_question = self.get_response(self.rephrase_prompt + '\n' + user_query, max_new_tokens=64)
+        if self.server_generate is not None:
+            return self.server_generate(input, max_new_tokens)
+        # Batched with the generations of the concurrent requests
+        return self.batcher.generate(input, max_new_tokens)
+
+    async def aget_response(self, input: str, max_new_tokens = 1000) -> str:
+        # The generation blocks, it runs in a thread so that the event loop keeps serving the other requests
+        return await asyncio.to_thread(self.get_response, input, max_new_tokens)
+
+    def rephrase(self, user_query: str) -> str:
+        use_cache = self.rephrase_cache is not None and not has_specific_terms(user_query)
+        if use_cache:
+            embedding = self.rephrase_cache.embed(user_query)
+            rephrased_question = self.rephrase_cache.get(embedding)
+            if rephrased_question is not None:
+                return rephrased_question
+        raw_rephrased_question = self.get_response(self.rephrase_prompt.format(input=user_query), max_new_tokens=64)
         try:
             rephrased_question = self.rephrase_parser.parse(raw_rephrased_question)
         except Exception as e:
             self.logging.error(f"An error occurred when rephrasing question: {e}")
-            rephrased_question = user_query
+            return user_query
+        if use_cache:
+            self.rephrase_cache.put(embedding, rephrased_question)
+        return rephrased_question
 
-        agent = ReactCodeSearchAgent(tools = [TavilySearchHuggingfaceTool()], 
+    def _react_run(self, user_query: str) -> str:
+        rephrased_question = self.rephrase(user_query)
+
+        agent = ReactCodeSearchAgent(tools = [tavily_search_huggingface_tool], 
+                                     search_tool = tavily_search_huggingface_tool,
                                      max_iterations = 3,
+                                     search_cache = self.search_cache,
                                      llm_engine = self.llm_engine,
                                 system_prompt=SEARCHING_REACT_SYSTEM_PROMPT)
         result, step_observation_logs = agent.run(rephrased_question, is_mistral=self.is_mistral)
         return result, step_observation_logs
 
 
+    @cache_responses
     async def _onetime_run(self, user_query: str) -> str:
-        raw_rephrased_question = self.get_response(self.rephrase_prompt + '\n' + user_query, max_new_tokens=64)
-        try:
-            rephrased_question = self.rephrase_parser.parse(raw_rephrased_question)
-        except Exception as e:
-            self.logging.error(f"An error occurred when rephrasing question: {e}")
-            rephrased_question = user_query
-
-        ### search results for each sub-questions ###
-        direct_search_result = await self.tavily_search.results_async(rephrased_question, 
-                                                                        max_results=5)
-                                                                    
-
-        direct_search_reference = 'User Query: ' + user_query + '\n'
-        direct_search_reference += f"Rephrased Question: {rephrased_question}\n"
-
-        refer_url = []
-        refer_content = []
-        for i, result in enumerate(direct_search_result, 1):
-            direct_search_reference += f"\nResult {i}:\n"
-            for key, value in result.items():
-                if key == 'url':
-                    refer_url.append(value)
-                if key == 'content':
-                    refer_content.append(value)
-                direct_search_reference += f"{key}: {value}\n"
+        ### search results, the original query is searched while it is rephrased ###
+        rephrased_question, direct_search_result = await self.tavily_search.results_speculative(
+            user_query, asyncio.to_thread(self.rephrase, user_query), max_results=5)
+
+        results_reference, refer_url, refer_content = format_search_results(direct_search_result)
+        direct_search_reference = f"User Query: {user_query}\nRephrased Question: {rephrased_question}\n{results_reference}"
 
         ###for whole reference ####
         FINAL_REFERENCE = f"""User's original question is {user_query}.
@@ -210,7 +224,7 @@ class RewriteAgentHuggingface():
 
         final_user_prompt = self.generating_result_prompt.format(context = FINAL_REFERENCE, 
                                                                  question = user_query)
-        final_answer = self.get_response(final_user_prompt)
+        final_answer = await self.aget_response(final_user_prompt)
 
         
         # return SimpleSearchAgentOutput(Result=final_answer, 
@@ -7,16 +7,18 @@ from langchain_core.prompts.base import BasePromptTemplate
 from langchain.tools import Tool
 from langchain_openai import ChatOpenAI
 from langchain.agents import AgentExecutor, create_react_agent
-from tools.tool_utils import TavilySearchAPIWrapper
+from tools.tool_utils import TavilySearchAPIWrapper, format_search_results
 from tools.tool_utils import create_react_agent_with_suggestions
 from .models import *
 from transformers.agents import ReactAgent, ReactCodeAgent, ReactCodeSearchAgent, ReactJsonAgent
+from transformers.agents.agents import SearchCache, SemanticCache
 from transformers import Tool
 from huggingface_hub import list_models
-from tools.tavily_search import TavilySearchHuggingfaceTool
+from tools.tavily_search import TavilySearchHuggingfaceTool, tavily_search_huggingface_tool
 import re
 import json
-from search_agent.parser import AskUserParser, StrategySuggestionParser, RephraseParser, GeneratedQuestionsSeparatedListOutputParser
+from .offline_model import CompletionCache, cache_responses
+from search_agent.parser import AskUserParser, StrategySuggestionParser, RephraseParser, GeneratedQuestionsSeparatedListOutputParser, truncate_suggestions, likely_direct_query, has_specific_terms
 from prompts.search_prompt import *
 import asyncio
 from fastapi import HTTPException
@@ -28,16 +30,6 @@ import traceback
 
 # Define a custom parser by extending the BaseParser class
 
-def get_time():
-    import datetime
-    current_time = datetime.datetime.now()
-    tomorrow_time = current_time + datetime.timedelta(days=1)
-
-    current_time_str = current_time.strftime('%Y %b %d')
-    tomorrow_time_str = tomorrow_time.strftime('%Y %b %d')
-
-    return current_time_str, tomorrow_time_str
-
 class SearchAgentOutput(BaseModel):
     Strategy: Optional[str] # choose from ['Parallel', 'Planning', 'Direct', None]
     Action: str # choose from ['Further', 'Done']
@@ -46,30 +38,38 @@ class SearchAgentOutput(BaseModel):
     Rerference: Optional[List[str]] # str or None
         
 class SearchAgentHuggingface():
-    rephrase_prompt = SEARCH_DIRECT_REPHRASE_PROMPT1
     generating_result_prompt = GENERATING_RESULT_PROMPT
-    search_strategy_prompt = SEARCH_STRATEGY_CLASSIFY_PROMPT
-    prompt_map = {
-            'Parallel':SEARCH_PARALLEL_PROMPT,
-            'Planning_suggestions': SEARCH_PLANNING_REACT_PROMPT_SUGGESTIONS_HUGGINGFACE,
-            "Planning": SEARCH_PLANNING_REACT_PROMPT_HUGGINGFACE
-        }
     rephrase_parser = RephraseParser()
+    # Rephrasings of earlier queries, reused for near-duplicate ones instead of a generation when
+    # rephrase_cache_threshold is given
+    rephrase_cache = None
     strategy_parser = StrategySuggestionParser()
+    # Complete outputs of _onetime_run, so that a repeated query skips the search and the generations
+    response_cache = CompletionCache(maxsize=1000, ttl=3600)
     parallel_question_generate_parser = GeneratedQuestionsSeparatedListOutputParser()
 
 
-    def __init__(self, model_name = 'gemma', max_new_tokens=1000):
+    def __init__(self, model_name = 'gemma', max_new_tokens=1000, draft_model_name=None,
+                 rephrase_cache_threshold: Optional[float] = None):
+        if rephrase_cache_threshold is not None:
+            self.rephrase_cache = SemanticCache(threshold=rephrase_cache_threshold)
+        # Search results of the ReAct runs of this agent, reused by its later identical searches
+        self.search_cache = SearchCache()
         self.model_id = NAMES[model_name]
-        self.llm, self.tokenizer = get_llm_huggingface(model_name)
+        # Generations go to the LLM server when one is configured, so the weights are only loaded locally otherwise
+        self.server_generate = get_llm_server_generate(model_name)
+        if self.server_generate is None:
+            self.batcher = get_generate_batcher(model_name)
 
         self.tavily_search = TavilySearchAPIWrapper(context_str_limit=800)
         self.max_new_tokens = max_new_tokens
 
-        if model_name == 'llama':
+        if self.server_generate is not None:
+            self.llm_engine = get_llm_server_engine(model_name)
+        elif model_name == 'llama':
             self.llm_engine = get_huggingface_client(model_name)
         else:
-            self.llm_engine = get_huggingface_client1(model_name)
+            self.llm_engine = get_huggingface_client1(model_name, draft_model_name=draft_model_name)
             
         if model_name == 'mistral':
             self.is_mistral = True
@@ -79,21 +79,35 @@ class SearchAgentHuggingface():
         self.logging = logging.getLogger(self.__class__.__name__)
         self.logging.setLevel(logging.DEBUG)
     
-    def get_response(self, input: str, max_new_tokens = 1000) -> str:
-        input_ids = self.tokenizer(input, return_tensors="pt").to("cuda")
-
-        outputs = self.llm.generate(**input_ids, max_new_tokens=max_new_tokens)
-        generated_outputs = outputs[0, input_ids['input_ids'].shape[-1]:]
-
-        result = self.tokenizer.decode(generated_outputs, skip_special_tokens=True)
-
-        return result
+    def get_response(self, input: str, max_new_tokens = 1000, stop_sequences: Optional[List[str]] = None) -> str:
+        if self.server_generate is not None:
+            return self.server_generate(input, max_new_tokens, stop_sequences)
+        # Batched with the generations of the concurrent requests
+        return self.batcher.generate(input, max_new_tokens, stop_sequences)
+
+    async def aget_response(self, input: str, max_new_tokens = 1000, stop_sequences: Optional[List[str]] = None) -> str:
+        # The generation blocks, it runs in a thread so that the event loop keeps serving the other requests
+        return await asyncio.to_thread(self.get_response, input, max_new_tokens, stop_sequences)
     
+    def rephrase(self, user_query: str) -> str:
+        use_cache = self.rephrase_cache is not None and not has_specific_terms(user_query)
+        if use_cache:
+            embedding = self.rephrase_cache.embed(user_query)
+            rephrased_question = self.rephrase_cache.get(embedding)
+            if rephrased_question is not None:
+                return rephrased_question
+        rephrase_p = choose_prompt('Direct', user_query).format(input=user_query)
+        rephrased_question = self.get_response(rephrase_p, max_new_tokens=64)
+        if use_cache:
+            self.rephrase_cache.put(embedding, rephrased_question)
+        return rephrased_question
+
     async def _run_parallel_search(self, query: str, suggestions: str) -> Tuple[str, List[str], List[str]]:
         url_list = []
         refer_content = []
-        parallel_prompt = self.prompt_map['Parallel']
-        raw_parallel_question_generate = self.get_response(parallel_prompt.format(input=query, suggestions = suggestions), max_new_tokens=128)
+        parallel_prompt = choose_prompt('Parallel', query, suggestions)
+        raw_parallel_question_generate = await self.aget_response(
+            parallel_prompt.format(input=query, suggestions = suggestions), max_new_tokens=128)
         print('>>>>>> raw parallel question >>>>>>')
         print(raw_parallel_question_generate)
         print('>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>')
@@ -102,44 +116,56 @@ class SearchAgentHuggingface():
         if len(generated_questions) == 0:
             return "Direct", [], []
         else:
-            tasks = [self.tavily_search.results_async(key_word, 
-                                                      max_results=5) for key_word in generated_questions]
-            results = await asyncio.gather(*tasks, return_exceptions=True) # including raw content
+            # The generated questions are searched concurrently, at most 5 at a time to stay clear of the API rate limits
+            results = await self.tavily_search.results_many(generated_questions, max_concurrency=5, max_results=5,
+                                                            return_exceptions=True) # including raw content
     
-            final_reference = ""
+            reference_parts = []
             for key_word, result in zip(generated_questions, results):
-                final_reference += f"Question: {key_word}\nSearch Result:"
-                for i, res in enumerate(result, 1):
-                    for key, value in res.items():
-                        if key == 'url':
-                            url_list.append(value)
-                        if key == 'content':
-                            refer_content.append(value)
-                        final_reference += f"{key}: {value}\n"
-            return final_reference, url_list, refer_content
+                if isinstance(result, Exception):
+                    self.logging.error(f"An error occurred searching '{key_word}': {result}")
+                    continue
+                results_reference, urls, contents = format_search_results(result, numbered=False)
+                reference_parts.append(f"Question: {key_word}\nSearch Result:{results_reference}")
+                url_list.extend(urls)
+                refer_content.extend(contents)
+            return "".join(reference_parts), url_list, refer_content
 
     
     async def _run_planning_search(self, query: str, suggestions: str):
-        planing_react_prompt = ''
-        if suggestions != '':
-            planing_react_prompt = self.prompt_map['Planning_suggestions'].format(suggestions=suggestions, input=query)
-        else:
-            planing_react_prompt = self.prompt_map['Planning'].format(input=query)
+        planing_react_prompt = choose_prompt('Planning', query, suggestions).format(suggestions=suggestions, input=query)
         
-        agent = ReactCodeSearchAgent(tools = [TavilySearchHuggingfaceTool()], 
+        agent = ReactCodeSearchAgent(tools = [tavily_search_huggingface_tool], 
+                                     search_tool = tavily_search_huggingface_tool,
                                      max_iterations = 5,
                                      llm_engine = self.llm_engine,
+                                     summarize_observations = True,
+                                     search_cache = self.search_cache,
                                 system_prompt=SEARCHING_REACT_SEARCH_AGENT_SYSTEM_PROMPT1)
         
-        result, step_observation_logs, sm_logs = agent.run(planing_react_prompt, is_mistral=self.is_mistral)
+        # The ReAct loop makes blocking LLM and search calls, it runs in a thread so that the event loop keeps serving
+        # the other questions
+        result, step_observation_logs, sm_logs = await asyncio.to_thread(
+            agent.run, planing_react_prompt, is_mistral=self.is_mistral)
         return result, step_observation_logs, sm_logs
 
+    @cache_responses
     async def _onetime_run(self, user_query: str) -> str:
         refer_content = []
         ##################### I.search strategy classification ##################### 
-        current_time, tomorrow_time = get_time()
-        search_strategy_classify_prompt = self.search_strategy_prompt.format(input=user_query,current_time=current_time,tomorrow_time=tomorrow_time)
-        raw_search_strategy = self.get_response(search_strategy_classify_prompt, max_new_tokens=128)
+        search_strategy_classify_prompt = render_strategy_classify_prompt(user_query)
+        # A query that looks Direct is searched while its strategy is classified, the results serve the Direct
+        # strategy; the search is cancelled whenever it is not used
+        speculative_search = None
+        if likely_direct_query(user_query):
+            speculative_search = asyncio.ensure_future(self.tavily_search.results_async(user_query, max_results=5))
+        raw_search_strategy = None
+        try:
+            raw_search_strategy = await self.aget_response(search_strategy_classify_prompt, max_new_tokens=128,
+                                                           stop_sequences=STRATEGY_STOP_SEQUENCES)
+        finally:
+            if raw_search_strategy is None and speculative_search is not None:
+                speculative_search.cancel()
         print('>>>>>> raw search strategy >>>>>>')
         print(raw_search_strategy)
         print('>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>')
@@ -149,6 +175,8 @@ class SearchAgentHuggingface():
             self.logging.error(f"An error occurred doing strategy parsing: {e}")
             selected_strategy = 'Planning'
             suggestions = ''
+        if selected_strategy != "Direct" and speculative_search is not None:
+            speculative_search.cancel()
             
         #########  II.search strategy #################
         parallel_reference = ''
@@ -161,6 +189,7 @@ class SearchAgentHuggingface():
 
         # Planning
         if selected_strategy == "Planning":
+            suggestions = truncate_suggestions(suggestions)
             planning_res, iteration_logs, sm_logs = await self._run_planning_search(user_query, suggestions)
             planning_reference = f"###Reference Answers###\n{planning_res}\n\n###First Search Result ###:\n{iteration_logs[0]}\n\n'##Compressed Search Results##'\n{sm_logs}\n\n"
             # return selected_strategy, planning_res, refer_content
@@ -178,33 +207,25 @@ class SearchAgentHuggingface():
                     rephrased_question = parts[1]
             
             if rephrased_question == '':
-                rephrase_p = self.rephrase_prompt.format(input=user_query)
-                rephrased_question = self.get_response(rephrase_p, max_new_tokens=64)
-
-            direct_search_result = await self.tavily_search.results_async(rephrased_question, 
-                                                                          max_results=5,
-                                                                         )
-
-            direct_search_reference = 'User Query: ' + user_query + '\n'
-            direct_search_reference += f"Rephrased Question: {rephrased_question}\n"
-
-            refer_url = []
-            refer_content = []
-            for i, result in enumerate(direct_search_result, 1):
-                direct_search_reference += f"\nResult {i}:\n"
-                for key, value in result.items():
-                    if key == 'url':
-                        refer_url.append(value)
-                    if key == 'content':
-                        refer_content.append(value)
-                    direct_search_reference += f"{key}: {value}\n"
+                # The original query is searched while it is rephrased
+                rephrased_question, direct_search_result = await self.tavily_search.results_speculative(
+                    user_query, asyncio.to_thread(self.rephrase, user_query), speculative_results=speculative_search,
+                    max_results=5)
+            else:
+                if speculative_search is not None:
+                    speculative_search.cancel()
+                direct_search_result = await self.tavily_search.results_async(rephrased_question, 
+                                                                              max_results=5,
+                                                                             )
+
+            results_reference, refer_url, refer_content = format_search_results(direct_search_result)
+            direct_search_reference = f"User Query: {user_query}\nRephrased Question: {rephrased_question}\n{results_reference}"
 
         ######## III.for whole reference if planning or direct ######################
         FINAL_REFERENCE = f"""You should give the answer to this question: {user_query}.\n\n
         Some potential questions and answers for reference are as follow:\n{parallel_reference}{planning_reference}{direct_search_reference}
-        Again, question is {user_query}.\n\n
         """
 
         generating_result_prompt = self.generating_result_prompt.format(question=user_query, context=FINAL_REFERENCE)
-        final_result = self.get_response(generating_result_prompt, max_new_tokens=1000)
+        final_result = await self.aget_response(generating_result_prompt, max_new_tokens=1000)
         return selected_strategy, final_result, refer_content
\ No newline at end of file
@@ -1,8 +1,15 @@
 # input: model_name (string), query
 # output: response
 # ReAct agent with Tavily search tool
-from tools.tool_utils import TavilySearchAPIWrapper
+from tools.tool_utils import TavilySearchAPIWrapper, format_search_results
 from pydantic import BaseModel
+import asyncio
+import atexit
+import functools
+import logging
+import logging.handlers
+import os
+import queue
 from typing import Any, AsyncIterator, List, Literal, Optional
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.prompts.base import BasePromptTemplate
@@ -13,33 +20,54 @@ from .models import *
 from transformers.agents import ReactAgent, ReactCodeAgent
 from transformers import Tool
 from huggingface_hub import list_models
-from tools.tavily_search import TavilySearchHuggingfaceTool
+from tools.tavily_search import TavilySearchHuggingfaceTool, tavily_search_huggingface_tool
 # Define a custom parser by extending the BaseParser class
 from .rewrite_search import SimpleSearchAgentOutput
+from .offline_model import CompletionCache, cache_responses
 from prompts.search_prompt import *
 
+# The events of the ReAct agent are appended to event.log by a background thread instead of opening the file for every
+# event in the event loop. Set LOG_AGENT_EVENTS=0 to drop them.
+LOG_AGENT_EVENTS = os.environ.get("LOG_AGENT_EVENTS", "1") == "1"
+
+@functools.lru_cache(maxsize=None)
+def get_event_logger() -> logging.Logger:
+    # Set up by the first agent that logs events; the queued events are flushed to the file at interpreter exit
+    event_log_queue = queue.Queue()
+    event_logger = logging.getLogger("agent_events")
+    event_logger.setLevel(logging.INFO)
+    event_logger.propagate = False
+    event_logger.addHandler(logging.handlers.QueueHandler(event_log_queue))
+    listener = logging.handlers.QueueListener(
+        event_log_queue, logging.FileHandler('event.log', encoding='utf-8', delay=True)
+    )
+    listener.start()
+    atexit.register(listener.stop)
+    return event_logger
+
 class SimpleSearchAgent():
     def __init__(self, model_name = 'llama', raw_content = False):     
         # model
         self.llm = get_llm(model_name)
+        self.event_logger = get_event_logger() if LOG_AGENT_EVENTS else None
 
-    async def simple_search(self, user_query) -> AsyncIterator[str]:
-        
-        # Create the agent
+        # The agent is built once and reused by every request
         search_tool = TavilySearchResults(max_results=2)
         tools = [search_tool, Time()]
-        agent_executor = create_react_agent(self.llm, tools).with_config(
+        self.agent_executor = create_react_agent(self.llm, tools).with_config(
             {"run_name": "agent"}
         )
+
+    async def simple_search(self, user_query) -> AsyncIterator[str]:
         
-        async for event in agent_executor.astream_events(
+        async for event in self.agent_executor.astream_events(
             {
                 "input": user_query,
             },
             version="v1",
         ):
-            with open('event.log', 'a', encoding='utf-8') as log_file:
-                log_file.write(str(event) + '\n')
+            if self.event_logger is not None:
+                self.event_logger.info("%s", event)
 
             kind = event["event"]
             if kind == "on_chain_end":
@@ -55,8 +83,12 @@ class SimpleSearchAgent():
 
 
 class SimpleSearchAgentHuggingface():
+    # Complete outputs of _onetime_run, so that a repeated query skips the search and the generation
+    response_cache = CompletionCache(maxsize=1000, ttl=3600)
+
     def __init__(self, model_name = 'gemma', max_new_tokens=64):
-        self.llm, self.tokenizer = get_llm_huggingface(model_name)
+        self.model_id = NAMES[model_name]
+        self.batcher = get_generate_batcher(model_name)
         self.llm_engine = get_huggingface_client(model_name)
         self.tavily_search = TavilySearchAPIWrapper(context_str_limit=800)
         self.generating_result_prompt = GENERATING_RESULT_PROMPT
@@ -67,40 +99,28 @@ class SimpleSearchAgentHuggingface():
             self.is_mistral = False
     
     def get_response(self, input: str) -> str:
-        input_ids = self.tokenizer(input, return_tensors="pt").to("cuda")
-
-        outputs = self.llm.generate(**input_ids, max_new_tokens=self.max_new_tokens)
-        generated_outputs = outputs[0, input_ids['input_ids'].shape[-1]:]
-
-        result = self.tokenizer.decode(generated_outputs, skip_special_tokens=True)
+        # Batched with the generations of the concurrent requests
+        return self.batcher.generate(input, self.max_new_tokens)
 
-        return result
+    async def aget_response(self, input: str) -> str:
+        # The generation blocks, it runs in a thread so that the event loop keeps serving the other requests
+        return await asyncio.to_thread(self.get_response, input)
     
     def _react_run(self, user_query: str) -> str:
-        agent = ReactCodeAgent(tools = [TavilySearchHuggingfaceTool()], llm_engine = self.llm_engine,
+        agent = ReactCodeAgent(tools = [tavily_search_huggingface_tool], llm_engine = self.llm_engine,
                                 system_prompt=SEARCHING_REACT_SYSTEM_PROMPT)
         result, step_observation_logs = agent.run(user_query, is_mistral = self.is_mistral)
         return result, step_observation_logs
 
     
+    @cache_responses
     async def _onetime_run(self, user_query: str) -> str:
         direct_search_result = await self.tavily_search.results_async(user_query, 
                                                                         max_results=5)
                                                                     
 
-        direct_search_reference = 'User Query: ' + user_query + '\n'
-        direct_search_reference += f"Question: {user_query}\n"
-
-        refer_url = []
-        refer_content = []
-        for i, result in enumerate(direct_search_result, 1):
-            direct_search_reference += f"\nResult {i}:\n"
-            for key, value in result.items():
-                if key == 'url':
-                    refer_url.append(value)
-                if key == 'content':
-                    refer_content.append(value)
-                direct_search_reference += f"{key}: {value}\n"
+        results_reference, refer_url, refer_content = format_search_results(direct_search_result)
+        direct_search_reference = f"User Query: {user_query}\nQuestion: {user_query}\n{results_reference}"
 
         print('-'*20)
         print('SEARCH_RESULTS')
@@ -114,7 +134,7 @@ class SimpleSearchAgentHuggingface():
 
         final_user_prompt = self.generating_result_prompt.format(context = FINAL_REFERENCE, 
                                                                  question = user_query)
-        final_answer = self.get_response(final_user_prompt)
+        final_answer = await self.aget_response(final_user_prompt)
 
         
         # return SimpleSearchAgentOutput(Result=final_answer, 
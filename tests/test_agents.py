@@ -0,0 +1,22 @@
+from transformers.agents.agents import parse_search_step
+
+
+def test_parse_search_step_sections():
+    llm_output = (
+        "Summarization: Paris is the capital.\nThought: I need more.\nThought: Search the population.\n"
+        "Search: population of Paris\n"
+    )
+    summarization, thought, search_query = parse_search_step(llm_output)
+    assert summarization == " Paris is the capital.\n"
+    assert thought == " Search the population.\n"
+    assert search_query == "population of Paris"
+
+
+def test_parse_search_step_keeps_the_last_search_and_its_first_line():
+    llm_output = (
+        "Thought: first\nSearch: old query\nObservation: old results\n"
+        "Thought: second\nSearch: new query\nThought: a streamed next step"
+    )
+    summarization, thought, search_query = parse_search_step(llm_output)
+    assert thought == " second\n"
+    assert search_query == "new query"
@@ -0,0 +1,23 @@
+from search_agent.parser import has_specific_terms, likely_direct_query
+
+
+def test_likely_direct_query_english():
+    assert likely_direct_query("What is the capital of France?")
+    assert not likely_direct_query("Compare the iPhone 15 and the Pixel 8")
+    assert not likely_direct_query("Plan a three day trip to Tokyo")
+
+
+def test_likely_direct_query_chinese():
+    assert likely_direct_query("深圳明天天气怎么样")
+    assert not likely_direct_query("我打算从深圳回上海，坐飞机和高铁哪个更划算？")
+    assert not likely_direct_query("请帮我制定一个深圳三天的旅游攻略")
+    # Without spaces, a long query is still counted as many words
+    assert not likely_direct_query("请问二零二四年巴黎奥运会中国代表团一共获得了多少枚金牌")
+
+
+def test_has_specific_terms():
+    assert not has_specific_terms("how to cook rice")
+    assert has_specific_terms("iPhone price")
+    assert has_specific_terms("price of the iphone 15")
+    assert has_specific_terms("weather in New York")
+    assert has_specific_terms("北京明天天气")
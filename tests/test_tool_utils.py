@@ -0,0 +1,20 @@
+from tools.tool_utils import select_relevant_text, text_terms
+
+
+def test_text_terms_splits_cjk_into_bigrams():
+    assert text_terms("深圳天气 iPhone15") == ["深圳", "圳天", "天气", "iphone15"]
+
+
+def test_select_relevant_text_keeps_the_chinese_sentence_of_the_query():
+    text = "今天是个好日子，空气质量良好。其他无关内容深圳明天天气晴朗气温二十度。更多新闻请关注我们的网站和公众号获取。"
+    assert select_relevant_text(text, "深圳明天天气", 30) == "其他无关内容深圳明天天气晴朗气温二十度。"
+
+
+def test_select_relevant_text_cuts_unrelated_text():
+    text = "第一句话没有关系。第二句话也没有关系。第三句话同样没有关系。"
+    assert select_relevant_text(text, "深圳明天天气", 12) == text[:12]
+
+
+def test_select_relevant_text_english():
+    text = "The sky is blue. Paris weather is sunny today. Cats sleep a lot."
+    assert select_relevant_text(text, "Paris weather", 35) == "Paris weather is sunny today."
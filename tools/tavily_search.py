@@ -1,5 +1,6 @@
 """Tool for the Tavily search API."""
 
+import functools
 from typing import Dict, List, Optional, Type, Union
 
 from langchain_core.callbacks import (
@@ -153,12 +154,12 @@ class TavilySearchHuggingfaceTool(Tool):
     description: str = (
         "A search engine optimized for comprehensive, accurate, and trusted results. "
         "Useful for when you need to answer questions about current events. "
-        "Input should be a search query."
+        "Input should be a search query, or a list of search queries to run concurrently."
     )
     inputs = {
         "task": {
-            "type": "text",
-            "description": "the text input of search engine",
+            "type": "any",
+            "description": "the text input of search engine, or a list of them",
         }
     }
     output_type = "text"
@@ -167,13 +168,24 @@ class TavilySearchHuggingfaceTool(Tool):
     context_str_limit: int = 5000
     args_schema: Type[BaseModel] = TavilyInput
 
+    @functools.cached_property
+    def api_wrapper(self) -> TavilySearchAPIWrapper:
+        """The Tavily API wrapper, built on first use and then reused by every search of this tool."""
+        return TavilySearchAPIWrapper()
+
     def forward(
         self,
-        query: str
-    ) -> Union[List[Dict], str]:
-        """Use the tool."""
+        query: Union[str, List[str]]
+    ) -> Union[List[Dict], List[List[Dict]], str]:
+        """Use the tool. A list of queries is searched concurrently and gives one result list per query."""
         try:
-            self.api_wrapper = TavilySearchAPIWrapper()
+            if isinstance(query, list):
+                results = self.api_wrapper.results_many_sync(
+                    query,
+                    max_results=self.max_results,
+                    search_depth=self.search_depth,
+                )
+                return [truncate_context(result, self.context_str_limit) for result in results]
             query = query.ljust(5, '?')
             results = self.api_wrapper.results(
                 query,
@@ -184,4 +196,9 @@ class TavilySearchHuggingfaceTool(Tool):
             return truncated_results
 
         except Exception as e:
-            return repr(e)
\ No newline at end of file
+            return repr(e)
+
+
+# Shared by all the agents: its API wrapper, and the pooled connections behind it, are built once and reused by every
+# search instead of once per agent
+tavily_search_huggingface_tool = TavilySearchHuggingfaceTool()
@@ -2,8 +2,15 @@
 
 In order to set this up, follow instructions at:
 """
+import asyncio
 import json
-from typing import Dict, List, Optional
+import logging
+import math
+import re
+import weakref
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Dict, List, Optional, Tuple
 
 import aiohttp
 import requests
@@ -22,9 +29,178 @@ from langchain.agents.format_scratchpad import format_log_to_str
 from langchain.agents.output_parsers import ReActSingleInputOutputParser
 from langchain.tools.render import ToolsRenderer, render_text_description
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 TAVILY_API_URL = "https://api.tavily.com"
 
+# Results pointing to these files are dropped, their extracted content is rarely usable.
+_SKIPPED_URL_SUFFIXES = (".pdf",)
+
+# Connections to the Tavily API are pooled and reused across calls instead of paying a TCP/TLS handshake per query.
+# Synchronous calls go over HTTP/2 when httpx and h2 are installed, and fall back to a requests session otherwise.
+# aiohttp sessions are bound to an event loop, so there is one async session per running loop.
+try:
+    import h2  # noqa: F401  (needed by httpx for HTTP/2)
+    import httpx
+except ImportError:
+    httpx = None
+
+if httpx is not None:
+    _http_session = httpx.Client(http2=True, timeout=None, limits=httpx.Limits(max_connections=32))
+else:
+    _http_session = requests.Session()
+    # Room for one connection per concurrent evaluation question instead of the default pool of 10
+    _http_session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=32, pool_maxsize=32))
+_async_sessions: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, aiohttp.ClientSession]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+_WORD_RE = re.compile(r"\w+")
+
+logger = logging.getLogger(__name__)
+
+# Outcomes of results_speculative: whether the results of the original query were kept (hit) or the rephrased query
+# had to be searched as well (miss)
+speculative_search_stats = {"hits": 0, "misses": 0}
+
+
+def speculative_search_hit_rate() -> float:
+    """Share of the `results_speculative` calls that kept the results of the original query."""
+    lookups = speculative_search_stats["hits"] + speculative_search_stats["misses"]
+    return speculative_search_stats["hits"] / lookups if lookups else 0.0
+
+
+def query_similarity(query: str, other_query: str) -> float:
+    """Jaccard similarity of the sets of lowercased words of two queries."""
+    words = set(_WORD_RE.findall(query.lower()))
+    other_words = set(_WORD_RE.findall(other_query.lower()))
+    if not words or not other_words:
+        return float(words == other_words)
+    return len(words & other_words) / len(words | other_words)
+
+
+# Chinese sentences are not followed by a space: they end right after their punctuation
+_SENTENCE_END_RE = re.compile(r"(?<=[.!?])\s+|(?<=[。！？；])\s*|\n+")
+_CJK_CHARS = "\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff"
+# Runs of CJK characters (first group), or words of the other word characters (second group)
+_TERM_RE = re.compile(rf"([{_CJK_CHARS}]+)|([^\W{_CJK_CHARS}]+)")
+
+
+def text_terms(text: str) -> List[str]:
+    """Lowercased words of `text`, each run of CJK characters being split into its character bigrams."""
+    terms = []
+    for cjk_run, word in _TERM_RE.findall(text.lower()):
+        if len(cjk_run) > 1:
+            terms.extend(cjk_run[i : i + 2] for i in range(len(cjk_run) - 1))
+        else:
+            terms.append(cjk_run or word)
+    return terms
+
+
+def select_relevant_text(text: str, query: str, limit: int, k1: float = 1.5, b: float = 0.75) -> str:
+    """Shorten `text` to at most `limit` characters, keeping its sentences most relevant to `query`.
+
+    The sentences are ranked by their BM25 score against the words of the query, over the sentences of the text, and
+    the best ones fitting in `limit` are kept in their original order.
+
+    Args:
+        text: The text to shorten.
+        query: The query the kept sentences should answer. Without any word, the text is cut at `limit` instead.
+        limit: The maximum number of characters kept.
+        k1: The BM25 term frequency saturation.
+        b: The BM25 length normalization.
+    Returns:
+        The kept sentences, separated by spaces, or `text` itself if it already fits.
+    """
+    if len(text) <= limit:
+        return text
+    query_words = set(text_terms(query))
+    sentences = [sentence for sentence in _SENTENCE_END_RE.split(text) if sentence.strip()]
+    if not query_words or len(sentences) < 2:
+        return text[:limit]
+
+    sentence_words = [text_terms(sentence) for sentence in sentences]
+    average_length = sum(len(words) for words in sentence_words) / len(sentences) or 1
+    document_frequency = {word: sum(word in words for words in sentence_words) for word in query_words}
+    idf = {
+        word: math.log((len(sentences) - frequency + 0.5) / (frequency + 0.5) + 1)
+        for word, frequency in document_frequency.items()
+    }
+
+    def score(words: List[str]) -> float:
+        length_norm = k1 * (1 - b + b * len(words) / average_length)
+        counts = Counter(words)
+        return sum(
+            idf[word] * counts[word] * (k1 + 1) / (counts[word] + length_norm) for word in query_words if counts[word]
+        )
+
+    scores = [score(words) for words in sentence_words]
+    if not any(scores):
+        # No sentence shares a word with the query: nothing to rank them by
+        return text[:limit]
+    # Best sentences first, ties in their original order
+    ranked = sorted(range(len(sentences)), key=lambda i: -scores[i])
+    kept, size = [], 0
+    for i in ranked:
+        if size + len(sentences[i]) + 1 > limit:
+            continue
+        kept.append(i)
+        size += len(sentences[i]) + 1
+    if not kept:
+        return text[:limit]
+    return " ".join(sentences[i] for i in sorted(kept))
+
+
+def format_search_results(results: List[Dict], numbered: bool = True) -> Tuple[str, List[str], List[str]]:
+    """Render cleaned search results as reference text for a prompt.
+
+    Args:
+        results: The cleaned results of a search.
+        numbered: Whether each result is introduced by a 'Result i:' header line.
+    Returns:
+        The reference text, with a 'key: value' line per field of each result, and the urls and contents of the
+        results.
+    """
+    urls = [result["url"] for result in results if "url" in result]
+    contents = [result["content"] for result in results if "content" in result]
+    reference = "".join(
+        (f"\nResult {i}:\n" if numbered else "") + "".join(f"{key}: {value}\n" for key, value in result.items())
+        for i, result in enumerate(results, 1)
+    )
+    return reference, urls, contents
+
+
+def _loads_json_response(content: bytes) -> Dict:
+    """Decode the body of a Tavily API response, with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def get_async_session() -> aiohttp.ClientSession:
+    """Return the pooled aiohttp session of the running event loop, creating it if needed."""
+    loop = asyncio.get_running_loop()
+    session = _async_sessions.get(loop)
+    if session is None or session.closed:
+        # Idle connections are kept a minute and resolved hostnames five minutes, so that consecutive searches skip
+        # the DNS lookup and the TLS handshake
+        connector = aiohttp.TCPConnector(limit=100, limit_per_host=50, keepalive_timeout=60, ttl_dns_cache=300)
+        session = aiohttp.ClientSession(connector=connector)
+        _async_sessions[loop] = session
+    return session
+
+
+async def close_async_session() -> None:
+    """Close the pooled aiohttp session of the running event loop, if any."""
+    session = _async_sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None and not session.closed:
+        await session.close()
+
 
 class TavilySearchAPIWrapper(BaseModel):
     """Wrapper for Tavily Search API."""
@@ -58,7 +234,9 @@ class TavilySearchAPIWrapper(BaseModel):
         include_raw_content: Optional[bool] = False,
         include_images: Optional[bool] = False,
     ) -> Dict:
-        query = query.ljust(5, ' ')
+        # The Tavily API rejects queries shorter than 5 characters
+        if len(query) < 5:
+            query = query.ljust(5, ' ')
         params = {
             "api_key": self.tavily_api_key.get_secret_value(),
             "query": query,
@@ -70,13 +248,13 @@ class TavilySearchAPIWrapper(BaseModel):
             "include_raw_content": include_raw_content,
             "include_images": include_images,
         }
-        response = requests.post(
+        response = _http_session.post(
             # type: ignore
             f"{TAVILY_API_URL}/search",
             json=params,
         )
         response.raise_for_status()
-        return response.json()
+        return _loads_json_response(response.content)
 
     def results(
         self,
@@ -113,7 +291,6 @@ class TavilySearchAPIWrapper(BaseModel):
                 score: The score of the result.
                 raw_content: The raw content of the result.
         """  # noqa: E501
-        query = query.ljust(5, ' ')
         raw_search_results = self.raw_results(
             query,
             max_results=max_results,
@@ -125,7 +302,7 @@ class TavilySearchAPIWrapper(BaseModel):
             include_images=include_images,
         )
         # return raw_search_results["results"]
-        return self.clean_results(raw_search_results["results"])
+        return self.clean_results(raw_search_results["results"], query)
 
     async def raw_results_async(
         self,
@@ -140,8 +317,11 @@ class TavilySearchAPIWrapper(BaseModel):
     ) -> Dict:
         """Get results from the Tavily Search API asynchronously."""
 
+        # The Tavily API rejects queries shorter than 5 characters
+        if len(query) < 5:
+            query = query.ljust(5, ' ')
+
         # Function to perform the API call
-        query = query.ljust(5, ' ')
         async def fetch() -> str:
             params = {
                 "api_key": self.tavily_api_key.get_secret_value(),
@@ -154,16 +334,15 @@ class TavilySearchAPIWrapper(BaseModel):
                 "include_raw_content": include_raw_content,
                 "include_images": include_images,
             }
-            async with aiohttp.ClientSession() as session:
-                async with session.post(f"{TAVILY_API_URL}/search", json=params) as res:
-                    if res.status == 200:
-                        data = await res.text()
-                        return data
-                    else:
-                        raise Exception(f"Error {res.status}: {res.reason}")
+            async with get_async_session().post(f"{TAVILY_API_URL}/search", json=params) as res:
+                if res.status == 200:
+                    data = await res.read()
+                    return data
+                else:
+                    raise Exception(f"Error {res.status}: {res.reason}")
 
-        results_json_str = await fetch()
-        return json.loads(results_json_str)
+        results_json = await fetch()
+        return _loads_json_response(results_json)
 
     async def results_async(
         self,
@@ -176,7 +355,6 @@ class TavilySearchAPIWrapper(BaseModel):
         include_raw_content: Optional[bool] = False,
         include_images: Optional[bool] = False,
     ) -> List[Dict]:
-        query = query.ljust(5, ' ')
         results_json = await self.raw_results_async(
             query=query,
             max_results=max_results,
@@ -187,35 +365,97 @@ class TavilySearchAPIWrapper(BaseModel):
             include_raw_content=include_raw_content,
             include_images=include_images,
         )
-        return self.clean_results(results_json["results"])
+        return self.clean_results(results_json["results"], query)
+
+    async def results_many(
+        self, queries: List[str], max_concurrency: int = 8, return_exceptions: bool = False, **kwargs
+    ) -> List[List[Dict]]:
+        """Run several queries concurrently over the pooled session.
+
+        Args:
+            queries: The queries to search for.
+            max_concurrency: The maximum number of requests in flight, to stay within the API rate limits.
+            return_exceptions: Whether a failed query gives its exception instead of failing the whole batch.
+            kwargs: Search options forwarded to `results_async`.
+        Returns:
+            The cleaned results of each query, in the order of `queries`.
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def search(query: str) -> List[Dict]:
+            async with semaphore:
+                return await self.results_async(query, **kwargs)
+
+        return await asyncio.gather(*(search(query) for query in queries), return_exceptions=return_exceptions)
+
+    async def results_speculative(
+        self,
+        query: str,
+        rephrase: Awaitable[str],
+        min_similarity: float = 0.8,
+        speculative_results: Optional[Awaitable[List[Dict]]] = None,
+        **kwargs,
+    ) -> Tuple[str, List[Dict]]:
+        """Search for `query` while it is being rephrased, instead of waiting for the rephrased query.
+
+        Args:
+            query: The original query, searched right away.
+            rephrase: The awaitable giving the rephrased query.
+            min_similarity: Above this `query_similarity`, the results of the original query are kept. Otherwise the
+                rephrased query is searched once it is known.
+            speculative_results: The search for `query` if it is already started, otherwise it is started here.
+            kwargs: Search options forwarded to `results_async`.
+        Returns:
+            The rephrased query and the results kept.
+        """
+        if speculative_results is None:
+            speculative_results = self.results_async(query, **kwargs)
+        speculative_results, rephrased_query = await asyncio.gather(speculative_results, rephrase)
+        similarity = query_similarity(query, rephrased_query)
+        hit = similarity > min_similarity
+        speculative_search_stats["hits" if hit else "misses"] += 1
+        logger.info(
+            "Speculative search %s (similarity %.2f), hit rate %.2f over %d searches",
+            "kept" if hit else "discarded",
+            similarity,
+            speculative_search_hit_rate(),
+            speculative_search_stats["hits"] + speculative_search_stats["misses"],
+        )
+        if hit:
+            return rephrased_query, speculative_results
+        return rephrased_query, await self.results_async(rephrased_query, **kwargs)
+
+    def results_many_sync(self, queries: List[str], **kwargs) -> List[List[Dict]]:
+        """Blocking version of `results_many`. From a running event loop, the searches run in a worker thread."""
+
+        async def run() -> List[List[Dict]]:
+            try:
+                return await self.results_many(queries, **kwargs)
+            finally:
+                await close_async_session()
+
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(run())
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            return executor.submit(lambda: asyncio.run(run())).result()
 
     def clean_results(self, results: List[Dict], query: str ='') -> List[Dict]:
-        """Clean results from Tavily Search API and truncate content."""
-        truncated_results = []
-
-        for result in results:
-
-            if result["url"].endswith('.pdf'):
-                print('>>>>>>HERE IS PDF>>>>>>>')
-                continue
-
-            if result['raw_content'] is not None:
-                raw_content = result['raw_content']
-                if len(raw_content) > self.context_str_limit:
-                    raw_content = raw_content[:self.context_str_limit]
-                assert len(raw_content) <= self.context_str_limit
-                truncated_results.append({"title": result["title"],
-                                        "url": result["url"], 
-                                        "raw_content": raw_content})
-            else:
-                content = result['content']
-                if len(content) > self.context_str_limit:
-                    content = content[:self.context_str_limit]
-                assert len(content) <= self.context_str_limit
-                truncated_results.append({"title": result["title"],
-                                        "url": result["url"], 
-                                        "content": content})
-        return truncated_results
+        """Clean results from Tavily Search API and shorten content to its sentences most relevant to `query`.
+
+        Each result is capped separately at `context_str_limit` characters, there is no budget shared by the results.
+        """
+        limit = self.context_str_limit
+        return [
+            {"title": result["title"], "url": result["url"],
+             "raw_content": select_relevant_text(result["raw_content"], query, limit)}
+            if result["raw_content"] is not None
+            else {"title": result["title"], "url": result["url"],
+                  "content": select_relevant_text(result["content"], query, limit)}
+            for result in results
+            if not result["url"].endswith(_SKIPPED_URL_SUFFIXES)
+        ]
 
 
 